@@ -0,0 +1,51 @@
+"""Compare copy_from() reading a StringIO built in advance against
+copy_from_iter() streaming the rows.
+
+Usage: python benchmarks/bench_copy.py [rows]
+"""
+import datetime
+import sys
+from cStringIO import StringIO
+
+import psycopg2ct
+
+from benchutil import dsn, report, timeit
+
+
+def main():
+    nrows = len(sys.argv) > 1 and int(sys.argv[1]) or 200000
+
+    conn = psycopg2ct.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("""CREATE TEMP TABLE bench_copy
+        (id int, data text, value float, ts timestamp)""")
+    now = datetime.datetime.now()
+    rows = [(i, 'row\t%d' % i, i / 3.0, now) for i in xrange(nrows)]
+
+    def stringio():
+        cur.execute("TRUNCATE bench_copy")
+        f = StringIO()
+        for row in rows:
+            f.write('%d\t%s\t%r\t%s\n' % (
+                row[0], row[1].replace('\t', '\\t'), row[2],
+                row[3].isoformat()))
+        f.seek(0)
+        cur.copy_from(f, 'bench_copy', size=65536)
+
+    def iterable(size):
+        def func():
+            cur.execute("TRUNCATE bench_copy")
+            cur.copy_from_iter('bench_copy', iter(rows), size=size)
+        return func
+
+    report('copy_from(StringIO)', nrows, timeit(stringio))
+    for size in (8192, 65536, 1 << 20):
+        report('copy_from_iter, size=%d' % size, nrows,
+            timeit(iterable(size)))
+
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
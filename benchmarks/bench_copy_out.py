@@ -0,0 +1,68 @@
+"""Measure the COPY OUT throughput of copy_to() with different buffer sizes,
+of the write_buffer() interface and of copy_to_iter().
+
+Usage: python benchmarks/bench_copy_out.py [rows]
+"""
+import sys
+
+import psycopg2ct
+
+from benchutil import dsn, report, timeit
+
+
+class NullFile(object):
+    """Discard the data, counting the bytes and the writes."""
+
+    def __init__(self):
+        self.size = self.writes = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.writes += 1
+
+
+class NullBufferFile(NullFile):
+    def write_buffer(self, view):
+        self.size += len(view)
+        self.writes += 1
+
+
+def main():
+    nrows = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+
+    conn = psycopg2ct.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("""CREATE TEMP TABLE bench_copy_out AS
+        SELECT i AS id, 'row ' || i AS data, i / 3.0 AS value, now() AS ts
+        FROM generate_series(1, %s) AS i""", (nrows,))
+
+    def copy_to(file_class, size):
+        def func():
+            f = file_class()
+            cur.copy_to(f, 'bench_copy_out', size=size)
+            func.file = f
+        return func
+
+    for size in (8192, 65536, 1 << 20, 4 << 20):
+        func = copy_to(NullFile, size)
+        elapsed = timeit(func)
+        report('copy_to, size=%d' % size, nrows, elapsed)
+        report('', func.file.size >> 20, elapsed, 'MB')
+
+    func = copy_to(NullBufferFile, 1 << 20)
+    elapsed = timeit(func)
+    report('copy_to, write_buffer', nrows, elapsed)
+    report('', func.file.size >> 20, elapsed, 'MB')
+
+    def iterate():
+        for row in cur.copy_to_iter('bench_copy_out'):
+            pass
+
+    report('copy_to_iter', nrows, timeit(iterate))
+
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
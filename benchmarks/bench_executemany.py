@@ -0,0 +1,57 @@
+"""Compare executemany() executing a query per parameters set against the
+batched executemany() and extras.execute_values().
+
+Usage: python benchmarks/bench_executemany.py [rows]
+"""
+import sys
+
+import psycopg2ct
+from psycopg2ct import compat
+compat.register()
+from psycopg2ct import extras
+
+from benchutil import dsn, report, timeit
+
+
+def main():
+    nrows = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+
+    conn = psycopg2ct.connect(dsn)
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE bench_executemany (id int, data text)")
+    rows = [(i, 'row %d' % i) for i in xrange(nrows)]
+
+    def run(query, page_size):
+        def func():
+            cur.execute("TRUNCATE bench_executemany")
+            cur.executemany(query, rows, page_size=page_size)
+            assert cur.rowcount == nrows
+        return func
+
+    insert = "INSERT INTO bench_executemany VALUES (%s, %s)"
+    update = "UPDATE bench_executemany SET data = %s WHERE id = %s"
+
+    for page_size in (1, 100, 1000):
+        name = 'insert, page_size=%d' % page_size
+        report(name, nrows, timeit(run(insert, page_size)))
+        print '%30s %10d round trips' % ('', (nrows - 1) // page_size + 1)
+
+    def values():
+        cur.execute("TRUNCATE bench_executemany")
+        extras.execute_values(cur,
+            "INSERT INTO bench_executemany VALUES %s", rows)
+    report('execute_values', nrows, timeit(values))
+
+    cur.executemany(insert, rows, page_size=1000)
+    args = [(data, i) for i, data in rows[:nrows // 10]]
+    for page_size in (1, 100):
+        def updates():
+            cur.executemany(update, args, page_size=page_size)
+        report('update, page_size=%d' % page_size, len(args), timeit(updates))
+
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
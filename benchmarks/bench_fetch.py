@@ -0,0 +1,61 @@
+"""Compare the rows/sec of the batch row builder against the per-cell path.
+
+Usage: python benchmarks/bench_fetch.py [rows]
+"""
+import sys
+
+import psycopg2ct
+from psycopg2ct._impl import libpq
+from psycopg2ct._impl import typecasts
+
+from benchutil import dsn, report, timeit
+
+
+QUERY = """
+SELECT i, i::bigint * 1000, i / 3.0, 'row ' || i, now(), i % 2 = 0
+FROM generate_series(1, %d) AS i
+"""
+
+
+def per_cell_rows(cur):
+    """The row building loop used before the batch engine: three ctypes
+    calls per cell and a dispatch through typecast() for every value."""
+    rows = []
+    for row_num in xrange(cur._rowcount):
+        row = [None] * cur._nfields
+        for i in xrange(cur._nfields):
+            val = libpq.PQgetvalue(cur._pgres, row_num, i)
+            if not val and libpq.PQgetisnull(cur._pgres, row_num, i):
+                val = None
+            else:
+                length = libpq.PQgetlength(cur._pgres, row_num, i)
+                val = typecasts.typecast(cur._casts[i], val, length, cur)
+            row[i] = val
+        rows.append(tuple(row))
+    return rows
+
+
+def main():
+    nrows = len(sys.argv) > 1 and int(sys.argv[1]) or 200000
+
+    conn = psycopg2ct.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(QUERY % nrows)
+
+    def batch():
+        cur._rownumber = 0
+        cur.fetchall()
+
+    def blocks():
+        cur._rownumber = 0
+        while cur.fetchmany(1000):
+            pass
+
+    report('per cell', nrows, timeit(lambda: per_cell_rows(cur)))
+    report('fetchall (batch)', nrows, timeit(batch))
+    report('fetchmany(1000) (batch)', nrows, timeit(blocks))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Helpers shared by the benchmark scripts.
+
+The database is configured with the same environment variables as the test
+suite (PSYCOPG2_TESTDB, PSYCOPG2_TESTDB_HOST, ...).
+"""
+import os
+import time
+
+
+dbname = os.environ.get('PSYCOPG2_TESTDB', 'psycopg2_test')
+dbhost = os.environ.get('PSYCOPG2_TESTDB_HOST', None)
+dbport = os.environ.get('PSYCOPG2_TESTDB_PORT', None)
+dbuser = os.environ.get('PSYCOPG2_TESTDB_USER', None)
+dbpass = os.environ.get('PSYCOPG2_TESTDB_PASSWORD', None)
+
+dsn = 'dbname=%s' % dbname
+if dbhost is not None:
+    dsn += ' host=%s' % dbhost
+if dbport is not None:
+    dsn += ' port=%s' % dbport
+if dbuser is not None:
+    dsn += ' user=%s' % dbuser
+if dbpass is not None:
+    dsn += ' password=%s' % dbpass
+
+
+def timeit(func, repeat=3):
+    """Return the best wall clock time of `repeat` calls to `func`."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, count, elapsed, unit='rows'):
+    print '%-30s %10d %s in %8.3fs  %12.0f %s/sec' % (
+        name, count, unit, elapsed, count / elapsed, unit)
@@ -6,6 +6,7 @@ from psycopg2ct import tz
 from psycopg2ct._impl.adapters import Binary, Date, Time, Timestamp
 from psycopg2ct._impl.adapters import DateFromTicks, TimeFromTicks
 from psycopg2ct._impl.adapters import TimestampFromTicks
+from psycopg2ct._impl import connection as _connection
 from psycopg2ct._impl.connection import _connect
 from psycopg2ct._impl.exceptions import *
 from psycopg2ct._impl.typecasts import BINARY, DATETIME, NUMBER, ROWID, STRING
@@ -77,6 +78,28 @@ def connect(dsn=None,
     library: the list of supported parameter depends on the library version.
 
     """
+    dsn = _get_dsn(dsn, database, user, password, host, port, **kwargs)
+    return _connect(dsn,
+        connection_factory=connection_factory, async=async)
+
+
+def _connect_many(count, *args, **kwargs):
+    """Create `count` database connections concurrently.
+
+    The arguments are the ones of connect(), plus a `timeout` in seconds
+    for the whole operation. If a connection fails all of them are closed.
+
+    """
+    connection_factory = kwargs.pop('connection_factory', None)
+    timeout = kwargs.pop('timeout', None)
+    dsn = _get_dsn(*args, **kwargs)
+    return _connection._connect_many(dsn, count,
+        connection_factory=connection_factory, timeout=timeout)
+
+
+def _get_dsn(dsn=None, database=None, user=None, password=None, host=None,
+             port=None, **kwargs):
+    """Return the connection string for the arguments of connect()"""
     if dsn is None:
         # Note: reproducing the behaviour of the previous C implementation:
         # keyword are silently swallowed if a DSN is specified. I would have
@@ -103,8 +126,7 @@ def connect(dsn=None,
         if not dsn:
             raise InterfaceError('missing dsn and no parameters')
 
-    return _connect(dsn,
-        connection_factory=connection_factory, async=async)
+    return dsn
 
 
 __all__ = filter(lambda k: not k.startswith('_'), locals().keys())
@@ -284,3 +284,91 @@ except NameError:
 
 for k, v in built_in_adapters.iteritems():
     adapters[(k, ISQLQuote)] = v
+
+
+# Formatters of the values which can be sent separately from the query, see
+# the cursor `server_params` attribute. They return (oid, value, format) and
+# are only used if the built-in adapter is the one registered for the type.
+
+def _int_param(value, conn):
+    if -0x80000000 <= value <= 0x7fffffff:
+        return 23, str(value), 0
+    if -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+        return 20, str(value), 0
+    return 1700, str(value), 0
+
+
+def _float_param(value, conn):
+    if math.isnan(value):
+        return 701, 'NaN', 0
+    elif math.isinf(value):
+        return 701, value > 0 and 'Infinity' or '-Infinity', 0
+    return 701, repr(value), 0
+
+
+def _decimal_param(value, conn):
+    if value.is_finite():
+        return 1700, str(value), 0
+    return 1700, 'NaN', 0
+
+
+def _datetime_param(value, conn):
+    if value.tzinfo is not None:
+        return 1184, value.isoformat(), 0
+    return 1114, value.isoformat(), 0
+
+
+def _time_param(value, conn):
+    if value.tzinfo is not None:
+        return 1266, value.isoformat(), 0
+    return 1083, value.isoformat(), 0
+
+
+def _interval_param(value, conn):
+    return 1186, '%d days %d.%06d seconds' % (
+        value.days, value.seconds, value.microseconds), 0
+
+
+def _unicode_param(value, conn):
+    return 0, value.encode(conn._py_enc), 0
+
+
+param_formatters = {
+    bool: lambda value, conn: (16, value and 't' or 'f', 0),
+    str: lambda value, conn: (0, value, 0),
+    unicode: _unicode_param,
+    bytearray: lambda value, conn: (17, str(value), 1),
+    buffer: lambda value, conn: (17, str(value), 1),
+    int: _int_param,
+    long: _int_param,
+    float: _float_param,
+    datetime.date: lambda value, conn: (1082, value.isoformat(), 0),
+    datetime.datetime: _datetime_param,
+    datetime.time: _time_param,
+    datetime.timedelta: _interval_param,
+    decimal.Decimal: _decimal_param,
+}
+
+try:
+    param_formatters[memoryview] = \
+        lambda value, conn: (17, value.tobytes(), 1)
+except NameError:
+    # Python 2.6
+    pass
+
+
+def _getparam(param, conn):
+    """Return the parameter as (oid, value, format) to be sent separately
+    from the query, or None if it must be merged into the query as literal.
+
+    """
+    if param is None:
+        return 0, None, 0
+
+    obj_type = type(param)
+    formatter = param_formatters.get(obj_type)
+    if formatter is None:
+        return None
+    if adapters.get((obj_type, ISQLQuote)) is not built_in_adapters[obj_type]:
+        return None
+    return formatter(param, conn)
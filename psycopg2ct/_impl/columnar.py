@@ -0,0 +1,106 @@
+"""Column oriented fetching of a PGresult into NumPy arrays.
+
+NumPy is an optional dependency: the module can be imported without it but
+`build_arrays()` raises ImportError.
+"""
+from itertools import imap
+
+from psycopg2ct._impl import libpq
+from psycopg2ct._impl import typecasts
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Columns filled directly into typed arrays, as long as the cursor uses the
+# default typecaster for them: oid -> (typecaster, dtype, parse function)
+_native_types = {
+    21: (typecasts.INTEGER, 'int16', int),
+    23: (typecasts.INTEGER, 'int32', int),
+    20: (typecasts.LONGINTEGER, 'int64', long),
+    700: (typecasts.FLOAT, 'float32', float),
+    701: (typecasts.FLOAT, 'float64', float),
+    16: (typecasts.BOOLEAN, 'bool', lambda value: value == 't'),
+    1082: (typecasts.DATE, 'datetime64[D]', None),
+    1114: (typecasts.DATETIME, 'datetime64[us]', None),
+}
+
+# Value used in place of NULL in typed arrays, it is hidden by the mask
+_null_values = {
+    'bool': 'f',
+    'datetime64[D]': 'NaT',
+    'datetime64[us]': 'NaT',
+}
+
+
+def build_arrays(cursor, start, end):
+    """Return a masked array for every column of the cursor result.
+
+    Only the rows from `start` to `end` are used. The mask of every array
+    is set where the value is NULL.
+
+    """
+    if numpy is None:
+        raise ImportError("numpy is required to fetch numpy arrays")
+
+    arrays = []
+    for col in xrange(cursor._nfields):
+        values, mask = _raw_column(cursor, col, start, end)
+        oid = cursor.description[col].type_code
+
+        data = None
+        native = _native_types.get(oid)
+        if native is not None and cursor._casts[col] is native[0]:
+            data = _native_array(values, mask, native[1], native[2])
+        if data is None:
+            data = _object_array(cursor, col, values, mask)
+
+        arrays.append(numpy.ma.masked_array(data, mask=mask))
+    return arrays
+
+
+def _raw_column(cursor, col, start, end):
+    """Return the strings of a result column and its null mask."""
+    pgres = cursor._pgres
+    getvalue = cursor._getvalue
+    getisnull = libpq.PQgetisnull
+
+    values = [getvalue(pgres, row_num, col)
+        for row_num in xrange(start, end)]
+    mask = [not val and bool(getisnull(pgres, row_num, col))
+        for row_num, val in zip(xrange(start, end), values)]
+    return values, mask
+
+
+def _native_array(values, mask, dtype, parse):
+    """Fill a typed array from the raw strings.
+
+    Return None if the values can't be represented with the dtype, e.g.
+    for infinite dates.
+
+    """
+    null = _null_values.get(dtype, '0')
+    if True in mask:
+        values = [m and null or val for val, m in zip(values, mask)]
+
+    try:
+        if parse is None:
+            return numpy.array(values, dtype=dtype)
+        return numpy.fromiter(imap(parse, values), dtype, len(values))
+    except (ValueError, OverflowError):
+        return None
+
+
+def _object_array(cursor, col, values, mask):
+    """Fill an object array using the column typecaster."""
+    caster = cursor._casters[col]
+    data = numpy.empty(len(values), dtype=object)
+    for i, val in enumerate(values):
+        if mask[i]:
+            val = None
+        elif caster is not None:
+            val = caster(val, len(val), cursor)
+        data[i] = val
+    return data
@@ -1,4 +1,7 @@
+import os
+import select
 import threading
+import time
 import weakref
 from functools import wraps
 
@@ -7,9 +10,10 @@ from psycopg2ct._impl import encodings as _enc
 from psycopg2ct._impl import exceptions
 from psycopg2ct._impl import libpq
 from psycopg2ct._impl import util
-from psycopg2ct._impl.cursor import Cursor
+from psycopg2ct._impl.cursor import Cursor, _prepare_query, _prepared_params
 from psycopg2ct._impl.lobject import LargeObject
 from psycopg2ct._impl.notify import Notify
+from psycopg2ct._impl.pipeline import Pipeline
 from psycopg2ct._impl.xid import Xid
 
 
@@ -36,6 +40,7 @@ def check_closed(func):
     def check_closed_(self, *args, **kwargs):
         if self.closed:
             raise exceptions.InterfaceError('connection already closed')
+        self._check_pid()
         return func(self, *args, **kwargs)
     return check_closed_
 
@@ -93,6 +98,12 @@ class Connection(object):
         self._closed = False
         self._cancel = None
         self._typecasts = {}
+        self._query_cache = util.LRUCache(128)
+        self._statements = {}
+        self._statement_cache = util.LRUCache(100)
+        self._statement_num = 0
+        self._prepare_counts = util.LRUCache(1000)
+        self._prepare_threshold = None
         self._tpc_xid = None
         self._notifies = []
         self._autocommit = False
@@ -101,6 +112,9 @@ class Connection(object):
         self._lock = threading.RLock()
         self.notices = []
 
+        # The process owning the libpq connection
+        self._pid = os.getpid()
+
         # The number of commits/rollbacks done so far
         self._mark = 0
 
@@ -108,6 +122,11 @@ class Connection(object):
         self._async_status = consts.ASYNC_DONE
         self._async_cursor = None
 
+        # The state of a COPY run by poll(), and the state returned by poll()
+        # during a _wait()
+        self._copy_steps = None
+        self._poll_state = None
+
         self_ref = weakref.ref(self)
         self._notice_callback = libpq.PQnoticeProcessor(
             lambda arg, message: self_ref()._process_notice(arg, message))
@@ -150,8 +169,10 @@ class Connection(object):
     def __del__(self):
         self._close()
 
-    @check_closed
     def close(self):
+        # Allowed in a forked child too, to drop an inherited connection
+        if self.closed:
+            raise exceptions.InterfaceError('connection already closed')
         return self._close()
 
     @check_closed
@@ -171,7 +192,11 @@ class Connection(object):
     def reset(self):
         with self._lock:
             self._execute_command(
-                "ABORT; RESET ALL; SET SESSION AUTHORIZATION DEFAULT;")
+                "ABORT; RESET ALL; SET SESSION AUTHORIZATION DEFAULT; "
+                "DEALLOCATE ALL;")
+            self._statements.clear()
+            self._statement_cache.clear()
+            self._prepare_counts.clear()
             self.status = consts.STATUS_READY
             self._mark += 1
             self._autocommit = False
@@ -284,7 +309,8 @@ class Connection(object):
     def get_transaction_status(self):
         return libpq.PQtransactionStatus(self._pgconn)
 
-    def cursor(self, name=None, cursor_factory=Cursor, withhold=False):
+    def cursor(self, name=None, cursor_factory=Cursor, withhold=False,
+               lazy=False):
         cur = cursor_factory(self, name)
 
         if not isinstance(cur, Cursor):
@@ -299,6 +325,9 @@ class Connection(object):
                 raise exceptions.ProgrammingError(
                     "withhold=True can be specified only for named cursors")
 
+        if lazy:
+            cur.lazy = True
+
         if name and self._async:
             raise exceptions.ProgrammingError(
                 "asynchronous connections cannot produce named cursors")
@@ -346,6 +375,92 @@ class Connection(object):
     def notifies(self):
         return self._notifies
 
+    @check_closed
+    @check_async
+    def prepare(self, name, sql):
+        """Create the server side prepared statement `name` for a query.
+
+        The query placeholders use the same syntax of the cursor execute()
+        method. The statement can be executed by the cursor
+        execute_prepared() method until deallocate() is called.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        if isinstance(name, unicode):
+            name = name.encode(self._py_enc)
+        if isinstance(sql, unicode):
+            sql = sql.encode(self._py_enc)
+        self._statements[name] = self._prepare_statement(name, sql)
+
+    @check_closed
+    @check_async
+    def deallocate(self, name):
+        """Drop a prepared statement created by prepare().
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        if isinstance(name, unicode):
+            name = name.encode(self._py_enc)
+        if name not in self._statements:
+            raise exceptions.ProgrammingError(
+                'prepared statement "%s" does not exist' % name)
+        self._execute_command('DEALLOCATE "%s"' % name.replace('"', '""'))
+        del self._statements[name]
+
+    @property
+    def prepare_threshold(self):
+        """The number of executions after which a query is prepared.
+
+        The queries executed with parameters by the cursors are prepared on
+        the server once they were executed this number of times; None, the
+        default, disables the automatic preparation. The statements are kept
+        in `statement_cache` and the least recently used are deallocated
+        when it is full. A query is prepared with the types of its
+        parameters, and again for every other combination of types used;
+        queries made of several statements are not prepared.
+
+        Named cursors and asynchronous connections don't use prepared
+        statements.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._prepare_threshold
+
+    @prepare_threshold.setter
+    def prepare_threshold(self, value):
+        if value is not None:
+            value = int(value)
+            if value < 0:
+                raise ValueError("prepare_threshold must be None or >= 0")
+        self._prepare_threshold = value
+
+    @property
+    def statement_cache(self):
+        """The cache of the statements prepared automatically.
+
+        The `hits` and `misses` attributes count the lookups in the cache,
+        `maxsize` can be set to change the number of statements kept.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._statement_cache
+
+    @property
+    def query_cache(self):
+        """The cache of the parsed queries executed with parameters.
+
+        The `hits` and `misses` attributes count the lookups in the cache,
+        `maxsize` can be set to change the number of queries kept.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._query_cache
+
     @property
     @check_closed
     def protocol_version(self):
@@ -409,12 +524,31 @@ class Connection(object):
     def tpc_recover(self):
         return Xid.tpc_recover(self)
 
+    @check_closed
+    def pipeline(self):
+        """Return a Pipeline to send several queries in a single round trip.
+
+        Queue the queries with the pipeline execute(cursor, query, params)
+        method and send them with sync(), or using the pipeline as a context
+        manager.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return Pipeline(self)
+
     def lobject(self, oid=0, mode='', new_oid=0, new_file=None,
                 lobject_factory=LargeObject):
         obj = lobject_factory(self, oid, mode, new_oid, new_file)
         return obj
 
     def poll(self):
+        self._check_pid()
+        if self._poll_state is not None:
+            # Waiting in _wait(): ask once for the state, then return
+            state, self._poll_state = self._poll_state, consts.POLL_OK
+            return state
+
         if self.status == consts.STATUS_SETUP:
             self.status = consts.STATUS_CONNECTING
             return consts.POLL_WRITE
@@ -427,6 +561,9 @@ class Connection(object):
 
         if self.status in (consts.STATUS_READY, consts.STATUS_BEGIN,
                            consts.STATUS_PREPARED):
+            if self._copy_steps is not None:
+                return self._poll_copy()
+
             res = self._poll_query()
 
             if res == consts.POLL_OK and self._async and self._async_cursor:
@@ -443,8 +580,14 @@ class Connection(object):
                 curs._pgres = util.pq_get_last_result(self._pgconn)
                 try:
                     curs._pq_fetch()
-                finally:
+                except:
                     self._async_cursor = None
+                    raise
+
+                # A COPY goes on in the following polls
+                if self._copy_steps is not None:
+                    return self._poll_copy()
+                self._async_cursor = None
             return res
 
         return consts.POLL_ERROR
@@ -518,6 +661,21 @@ class Connection(object):
 
         return consts.POLL_ERROR
 
+    def _poll_copy(self):
+        """Advance the COPY of the asynchronous cursor"""
+        try:
+            return self._copy_steps.next()
+        except StopIteration:
+            res = consts.POLL_OK
+        except:
+            self._copy_steps = None
+            self._async_cursor = None
+            raise
+
+        self._copy_steps = None
+        self._async_cursor = None
+        return res
+
     def _poll_setup_async(self):
         """Advance to the next state during an async connection setup
 
@@ -568,6 +726,13 @@ class Connection(object):
 
         return consts.POLL_ERROR
 
+    def _set_sync(self):
+        """Make synchronous an asynchronous connection completely set up,
+        as if it was created by _connect_sync()."""
+        util.pq_set_non_blocking(self._pgconn, 0, True)
+        self._async = False
+        self._autocommit = False
+
     def _setup(self):
         self._equote = self._get_equote()
         self._get_encoding()
@@ -597,15 +762,83 @@ class Connection(object):
                 pgres = self._execute_green(command)
             else:
                 pgres = libpq.PQexec(self._pgconn, command)
+            self._check_command_result(pgres)
 
-            if not pgres:
-                raise self._create_exception()
-            try:
-                pgstatus = libpq.PQresultStatus(pgres)
-                if pgstatus != libpq.PGRES_COMMAND_OK:
-                    raise self._create_exception(pgres=pgres)
-            finally:
-                libpq.PQclear(pgres)
+    def _check_command_result(self, pgres):
+        """Raise an exception if the command failed, clear the result"""
+        if not pgres:
+            raise self._create_exception()
+        try:
+            pgstatus = libpq.PQresultStatus(pgres)
+            if pgstatus != libpq.PGRES_COMMAND_OK:
+                raise self._create_exception(pgres=pgres)
+        finally:
+            libpq.PQclear(pgres)
+
+    def _prepare_statement(self, name, sql, oids=None):
+        """Prepare the query on the server.
+
+        `oids` are the types of the parameters: if not specified they are
+        inferred by the server. Return the statement name, the query sent
+        and the keys of the parameters in the order of the query
+        placeholders.
+
+        """
+        query, keys = _prepare_query(sql, self)
+        with self._lock:
+            if oids:
+                types = (libpq.c_uint * len(oids))(*oids)
+                args = (self._pgconn, name, query, len(oids), types)
+            else:
+                args = (self._pgconn, name, query, 0, None)
+            if _green_callback:
+                pgres = self._send_green(libpq.PQsendPrepare, args)
+            else:
+                pgres = libpq.PQprepare(*args)
+            self._check_command_result(pgres)
+        return name, query, keys
+
+    def _get_auto_statement(self, sql, parameters):
+        """Return the statement prepared for a query executed by a cursor
+        and the parameters to pass to it.
+
+        The query is prepared once it was executed `prepare_threshold` times
+        with parameters of the same types, return None until then or if the
+        query can't be prepared.
+
+        """
+        if self.get_transaction_status() \
+                == consts.TRANSACTION_STATUS_INERROR:
+            # Neither PREPARE nor DEALLOCATE would work
+            return None
+
+        query, keys = _prepare_query(sql, self)
+        if ';' in query.rstrip().rstrip(';'):
+            # Only a single statement can be prepared
+            return None
+        params = _prepared_params(keys, parameters, self)
+        if params is None:
+            # Some value can only be merged into the query
+            return None
+
+        # The same query executed with other types is another statement
+        key = (sql, tuple([oid for oid, value, format in params]))
+        stmt = self._statement_cache.get(key)
+        if stmt is not None:
+            return stmt, params
+
+        count = self._prepare_counts.get(key, 0)
+        if count < self._prepare_threshold:
+            self._prepare_counts.set(key, count + 1)
+            return None
+
+        self._prepare_counts.pop(key)
+        self._statement_num += 1
+        stmt = self._prepare_statement(
+            '_psycopg2ct_%d' % self._statement_num, sql, key[1])
+        for query, discarded in self._statement_cache.set(key, stmt):
+            self._execute_command('DEALLOCATE "%s"' % discarded[0])
+        return stmt, params
 
     def _execute_tpc_command(self, command, xid):
         cmd = '%s %s' % (command, util.quote_string(self, str(xid)))
@@ -614,13 +847,22 @@ class Connection(object):
 
     def _execute_green(self, query):
         """Execute version for green threads"""
+        return self._send_green(libpq.PQsendQuery, (self._pgconn, query))
+
+    def _send_green(self, send, args, fetch=util.pq_get_last_result):
+        """Send a query calling `send` with `args` and wait for the result
+        using the wait callback.
+
+        Return the result retrieved by `fetch`, by default the last one.
+
+        """
         if self._async_cursor:
             raise exceptions.ProgrammingError(
                 "a single async query can be executed on the same connection")
 
         self._async_cursor = True
 
-        if not libpq.PQsendQuery(self._pgconn, query):
+        if not send(*args):
             self._async_cursor = None
             return
 
@@ -628,7 +870,7 @@ class Connection(object):
 
         try:
             _green_callback(self)
-            return util.pq_get_last_result(self._pgconn)
+            return fetch(self._pgconn)
         except:
             util.pq_clear_async(self._pgconn)
             raise
@@ -636,6 +878,15 @@ class Connection(object):
             self._async_cursor = None
             self._async_status = consts.ASYNC_DONE
 
+    def _wait(self, state):
+        """Wait with the wait callback until the connection is ready for
+        `state`, either POLL_READ or POLL_WRITE."""
+        self._poll_state = state
+        try:
+            _green_callback(self)
+        finally:
+            self._poll_state = None
+
     def _finish_tpc(self, command, fallback, xid):
         if xid:
             # committing/aborting a received transaction.
@@ -664,6 +915,14 @@ class Connection(object):
             self.status = consts.STATUS_READY
             self._tpc_xid = None
 
+    def _check_pid(self):
+        """Raise InterfaceError if the connection was inherited from the
+        parent of a fork: its socket is shared with the parent."""
+        if self._pid != os.getpid():
+            raise exceptions.InterfaceError(
+                "connection created in the parent of a fork: "
+                "it can only be closed")
+
     def _close(self):
         self._closed = True
 
@@ -672,7 +931,18 @@ class Connection(object):
             self._cancel = None
 
         if self._pgconn:
-            libpq.PQfinish(self._pgconn)
+            if self._pid == os.getpid():
+                libpq.PQfinish(self._pgconn)
+            else:
+                # Inherited from a forked parent: PQfinish() would terminate
+                # the parent's session. Only close our copy of the socket,
+                # leaking the PGconn structure.
+                fd = libpq.PQsocket(self._pgconn)
+                if fd >= 0:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
             self._pgconn = None
 
     def _commit(self):
@@ -769,6 +1039,64 @@ class Connection(object):
         return bool(_green_callback)
 
 
+def _connect_many(dsn, count, connection_factory=None, timeout=None):
+    """Open `count` synchronous connections to `dsn` concurrently.
+
+    The connections are started as asynchronous ones and polled together
+    until they are set up. If one of them fails, or `timeout` seconds pass,
+    all of them are closed and the error is raised.
+
+    """
+    if connection_factory is None:
+        connection_factory = Connection
+
+    conns = []
+    try:
+        for i in xrange(count):
+            conns.append(connection_factory(dsn, async=True))
+        _poll_all(conns, timeout)
+        for conn in conns:
+            conn._set_sync()
+    except:
+        for conn in conns:
+            conn._close()
+        raise
+
+    return conns
+
+
+def _poll_all(conns, timeout=None):
+    """Poll the asynchronous connections until all of them are ready."""
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    states = dict((conn, conn.poll()) for conn in conns)
+    while True:
+        for conn, state in states.items():
+            if state == consts.POLL_OK:
+                del states[conn]
+            elif state not in (consts.POLL_READ, consts.POLL_WRITE):
+                raise exceptions.OperationalError(
+                    "bad state from poll: %s" % state)
+        if not states:
+            return
+
+        readers = [conn for conn, state in states.iteritems()
+            if state == consts.POLL_READ]
+        writers = [conn for conn, state in states.iteritems()
+            if state == consts.POLL_WRITE]
+        if timeout is None:
+            ready = select.select(readers, writers, [])
+        else:
+            ready = select.select(readers, writers, [],
+                max(0, deadline - time.time()))
+            if not ready[0] and not ready[1]:
+                raise exceptions.OperationalError("timeout expired")
+
+        for conn in ready[0] + ready[1]:
+            states[conn] = conn.poll()
+
+
 def _connect(dsn, connection_factory=None, async=False):
     if connection_factory is None:
         connection_factory = Connection
@@ -0,0 +1,519 @@
+"""Conversion of Python rows to and from the COPY formats."""
+import datetime
+import decimal
+import re
+import struct
+import uuid
+
+from psycopg2ct._impl import typecasts
+from psycopg2ct._impl.adapters import param_formatters
+from psycopg2ct._impl.exceptions import DataError, NotSupportedError
+
+
+# Characters to escape in the COPY text format, the delimiter is added per
+# reader
+_text_escapes = {
+    '\\': '\\\\',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t',
+}
+
+
+class CopyRowsReader(object):
+    """A file-like object reading the rows of an iterable in COPY text
+    format.
+
+    Every row is a sequence of values: None is written as `null`, the
+    builtin types are converted like the query parameters and the other
+    objects with str(). The data is only produced when read.
+
+    """
+
+    def __init__(self, rows, conn, sep='\t', null='\\N'):
+        self._rows = iter(rows)
+        self._conn = conn
+        self._sep = sep
+        self._null = null
+        self._pending = ''
+        self._trailer = ''
+
+        escapes = dict(_text_escapes)
+        escapes.setdefault(sep, '\\' + sep)
+        self._escapes = escapes
+        self._special = re.compile(
+            '[%s]' % ''.join(map(re.escape, escapes)))
+
+    def read(self, size=-1):
+        """Return at most `size` bytes, or all the remaining data if `size`
+        is negative."""
+        parts = [self._pending]
+        length = len(self._pending)
+        format_row = self._format_row
+        rows = self._rows
+        while size < 0 or length < size:
+            try:
+                line = format_row(rows.next())
+            except StopIteration:
+                # Append the end of the data once
+                parts.append(self._trailer)
+                self._trailer = ''
+                break
+            parts.append(line)
+            length += len(line)
+
+        data = ''.join(parts)
+        if 0 <= size < len(data):
+            self._pending = data[size:]
+            return data[:size]
+        self._pending = ''
+        return data
+
+    def readline(self, size=-1):
+        if not self._pending:
+            for row in self._rows:
+                self._pending = self._format_row(row)
+                break
+
+        end = self._pending.find('\n') + 1 or len(self._pending)
+        if 0 <= size < end:
+            end = size
+        line = self._pending[:end]
+        self._pending = self._pending[end:]
+        return line
+
+    def _format_row(self, row):
+        formatters = param_formatters
+        special = self._special
+        conn = self._conn
+
+        values = []
+        for value in row:
+            if value is None:
+                values.append(self._null)
+                continue
+
+            formatter = formatters.get(type(value))
+            if formatter is not None:
+                oid, value, format = formatter(value, conn)
+                if format:
+                    # Binary strings are written as hex encoded bytea
+                    value = '\\x' + value.encode('hex')
+            elif isinstance(value, unicode):
+                value = value.encode(conn._py_enc)
+            else:
+                value = str(value)
+
+            if special.search(value) is not None:
+                value = special.sub(self._escape, value)
+            values.append(value)
+
+        return self._sep.join(values) + '\n'
+
+    def _escape(self, match):
+        return self._escapes[match.group()]
+
+
+_text_unescape_re = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+_text_unescapes = {
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    'v': '\v',
+}
+
+
+def _unescape(match):
+    value = match.group(1)
+    if value in _text_unescapes:
+        return _text_unescapes[value]
+    elif value[0] == 'x' and len(value) > 1:
+        return chr(int(value[1:], 16))
+    elif value[0] in '01234567':
+        return chr(int(value, 8) & 0xFF)
+    return value
+
+
+class TextCopyDecoder(object):
+    """Parse a COPY text stream into rows, with the typecasters of the
+    cursor for the columns types `oids`.
+
+    The data can be fed in chunks of any size.
+
+    """
+
+    def __init__(self, oids, cursor, sep='\t', null='\\N'):
+        self._casters = [typecasts.cast_function(cursor._get_cast(oid))
+            for oid in oids]
+        self._cursor = cursor
+        self._sep = sep
+        self._null = null
+        self._buffer = ''
+        self._field_re = re.compile(r'((?:[^\\%s]|\\.)*)(%s|$)' % (
+            re.escape(sep), re.escape(sep)))
+
+        #: The rows parsed by write()
+        self.rows = []
+
+    def write(self, data):
+        """Parse a chunk of data appending the rows to `rows`."""
+        self.rows.extend(self.feed(data))
+
+    def feed(self, data):
+        """Parse a chunk of data and return the rows completed by it."""
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split('\n')
+        self._buffer = lines.pop()
+        return [self.parse_line(line) for line in lines]
+
+    def parse_line(self, line):
+        """Return the row of a line, without the newline."""
+        casters = self._casters
+        cursor = self._cursor
+        null = self._null
+        unescape = _text_unescape_re.sub
+
+        if '\\' in line:
+            row = self._split_escaped(line)
+        else:
+            row = line.split(self._sep)
+        if len(row) != len(casters):
+            raise DataError("the row has %d values, expected %d" % (
+                len(row), len(casters)))
+
+        for i, caster in enumerate(casters):
+            value = row[i]
+            if value == null:
+                row[i] = None
+                continue
+            if '\\' in value:
+                value = unescape(_unescape, value)
+            if caster is not None:
+                value = caster(value, len(value), cursor)
+            row[i] = value
+        return tuple(row)
+
+    def _split_escaped(self, line):
+        """Split a line on the separators not escaped by a backslash."""
+        match = self._field_re.match
+        fields = []
+        pos = 0
+        while True:
+            field = match(line, pos)
+            fields.append(field.group(1))
+            if not field.group(2):
+                return fields
+            pos = field.end()
+
+
+# Binary format
+#
+# The fields of the binary format are encoded according to the type of the
+# table column: the encoders are the counterpart of the binary typecasters.
+
+_BINARY_SIGNATURE = 'PGCOPY\n\377\r\n\0'
+_binary_header = struct.Struct('!11sii')
+_int2 = struct.Struct('!h')
+_int4 = typecasts._int4
+_NULL_FIELD = _int4.pack(-1)
+
+
+def _binary_packer(fmt, convert=None):
+    """Return an encoder packing a single value with `fmt`."""
+    pack = struct.Struct(fmt).pack
+    if convert is None:
+        return lambda value, conn: pack(value)
+    return lambda value, conn: pack(convert(value))
+
+
+def format_binary_string(value, conn):
+    if isinstance(value, unicode):
+        return value.encode(conn._py_enc)
+    return str(value)
+
+
+def format_binary_bytea(value, conn):
+    tobytes = getattr(value, 'tobytes', None)
+    if tobytes is not None:
+        # memoryview
+        return tobytes()
+    return str(value)
+
+
+def format_binary_boolean(value, conn):
+    return value and '\x01' or '\x00'
+
+
+def format_binary_date(value, conn):
+    if value == datetime.date.max:
+        days = typecasts._DATE_INFINITY
+    elif value == datetime.date.min:
+        days = -typecasts._DATE_INFINITY - 1
+    else:
+        days = (value - typecasts._PG_EPOCH_DATE).days
+    return _int4.pack(days)
+
+
+def _micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _time_micros(value):
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 \
+        + value.microsecond
+
+
+def format_binary_time(value, conn):
+    return typecasts._int8.pack(_time_micros(value))
+
+
+def format_binary_timetz(value, conn):
+    offset = value.utcoffset()
+    if offset is None:
+        raise DataError("can't write a naive time to a timetz column")
+    return typecasts._time_tz.pack(
+        _time_micros(value), -(offset.days * 86400 + offset.seconds))
+
+
+def format_binary_timestamp(value, conn):
+    if value == datetime.datetime.max:
+        micros = typecasts._TIMESTAMP_INFINITY
+    elif value == datetime.datetime.min:
+        micros = -typecasts._TIMESTAMP_INFINITY - 1
+    else:
+        micros = _micros(value - typecasts._PG_EPOCH)
+    return typecasts._int8.pack(micros)
+
+
+def format_binary_timestamptz(value, conn):
+    """The timestamp is sent in UTC, naive datetimes are refused"""
+    offset = value.utcoffset()
+    if offset is None:
+        if value in (datetime.datetime.max, datetime.datetime.min):
+            return format_binary_timestamp(value, conn)
+        raise DataError(
+            "can't write a naive datetime to a timestamptz column")
+    return format_binary_timestamp(
+        value.replace(tzinfo=None) - offset, conn)
+
+
+def format_binary_interval(value, conn):
+    return typecasts._interval.pack(
+        value.seconds * 1000000 + value.microseconds, value.days, 0)
+
+
+def format_binary_numeric(value, conn):
+    """Encode a number as a list of base 10000 digits"""
+    if not isinstance(value, decimal.Decimal):
+        if isinstance(value, float):
+            value = repr(value)
+        value = decimal.Decimal(value)
+
+    if value.is_nan():
+        return typecasts._numeric_header.pack(0, 0, typecasts._NUMERIC_NAN, 0)
+    elif value.is_infinite():
+        return typecasts._numeric_header.pack(0, 0,
+            value > 0 and typecasts._NUMERIC_PINF or typecasts._NUMERIC_NINF,
+            0)
+
+    sign, digits, exponent = value.as_tuple()
+    digits = ''.join(map(str, digits))
+    dscale = max(0, -exponent)
+    if exponent >= 0:
+        integer, fraction = digits + '0' * exponent, ''
+    else:
+        digits = digits.rjust(-exponent, '0')
+        integer, fraction = digits[:exponent], digits[exponent:]
+
+    # Align the groups of 4 digits on the decimal point
+    integer = integer.rjust((len(integer) + 3) // 4 * 4, '0')
+    fraction = fraction.ljust((len(fraction) + 3) // 4 * 4, '0')
+    groups = [int(integer[i:i + 4]) for i in xrange(0, len(integer), 4)]
+    weight = len(groups) - 1
+    groups.extend([int(fraction[i:i + 4])
+        for i in xrange(0, len(fraction), 4)])
+
+    while groups and not groups[0]:
+        del groups[0]
+        weight -= 1
+    while groups and not groups[-1]:
+        del groups[-1]
+    if not groups:
+        weight = 0
+
+    return typecasts._numeric_header.pack(len(groups), weight,
+        sign and typecasts._NUMERIC_NEG or 0, dscale) + \
+        struct.pack('!%dH' % len(groups), *groups)
+
+
+def format_binary_uuid(value, conn):
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(value)
+    return value.bytes
+
+
+binary_encoders = {}
+
+
+def _binary_encoder(oids, encoder):
+    """Shortcut to register internal binary encoders"""
+    for oid in oids:
+        binary_encoders[oid] = encoder
+
+
+_binary_encoder([19, 18, 25, 1042, 1043, 705], format_binary_string)
+_binary_encoder([17], format_binary_bytea)
+_binary_encoder([16], format_binary_boolean)
+_binary_encoder([21], _binary_packer('!h', int))
+_binary_encoder([23], _binary_packer('!i', int))
+_binary_encoder([20], _binary_packer('!q', long))
+_binary_encoder([26], _binary_packer('!I', long))
+_binary_encoder([700], _binary_packer('!f', float))
+_binary_encoder([701], _binary_packer('!d', float))
+_binary_encoder([1700], format_binary_numeric)
+_binary_encoder([1082], format_binary_date)
+_binary_encoder([1083], format_binary_time)
+_binary_encoder([1266], format_binary_timetz)
+_binary_encoder([1114], format_binary_timestamp)
+_binary_encoder([1184], format_binary_timestamptz)
+_binary_encoder([1186], format_binary_interval)
+_binary_encoder([2950], format_binary_uuid)
+
+
+class BinaryCopyRowsReader(CopyRowsReader):
+    """A file-like object reading the rows of an iterable in COPY binary
+    format.
+
+    `oids` are the types of the table columns, which determine how the
+    values are encoded.
+
+    """
+
+    def __init__(self, rows, oids, conn):
+        self._rows = iter(rows)
+        self._conn = conn
+        self._pending = _binary_header.pack(_BINARY_SIGNATURE, 0, 0)
+        self._trailer = _int2.pack(-1)
+
+        self._encoders = []
+        for oid in oids:
+            try:
+                self._encoders.append(binary_encoders[oid])
+            except KeyError:
+                raise NotSupportedError(
+                    "binary COPY doesn't support the type with oid %d" % oid)
+        self._field_count = _int2.pack(len(oids))
+
+    def readline(self, size=-1):
+        raise NotSupportedError("the binary COPY data has no lines")
+
+    def _format_row(self, row):
+        if len(row) != len(self._encoders):
+            raise DataError("the row has %d values, expected %d" % (
+                len(row), len(self._encoders)))
+
+        conn = self._conn
+        pack_length = _int4.pack
+
+        fields = [self._field_count]
+        for encoder, value in zip(self._encoders, row):
+            if value is None:
+                fields.append(_NULL_FIELD)
+            else:
+                value = encoder(value, conn)
+                fields.append(pack_length(len(value)))
+                fields.append(value)
+        return ''.join(fields)
+
+
+class BinaryCopyDecoder(object):
+    """Parse a COPY binary stream into rows, with the binary typecasters
+    of the columns types `oids`.
+
+    The data can be fed in chunks of any size.
+
+    """
+
+    def __init__(self, oids, cursor):
+        self._casters = [typecasts.cast_function(
+            typecasts.binary_types.get(oid, typecasts.BINARY_UNKNOWN))
+            for oid in oids]
+        self._cursor = cursor
+        self._buffer = ''
+        self._in_header = True
+
+        #: True when the end of the data was parsed
+        self.done = False
+
+        #: The rows parsed by write()
+        self.rows = []
+
+    def write(self, data):
+        """Parse a chunk of data appending the rows to `rows`."""
+        self.rows.extend(self.feed(data))
+
+    def feed(self, data):
+        """Parse a chunk of data and return the rows completed by it."""
+        if self._buffer:
+            data = self._buffer + data
+        end = len(data)
+        pos = 0
+
+        if self._in_header:
+            if end < _binary_header.size:
+                self._buffer = data
+                return []
+            signature, flags, extension = _binary_header.unpack_from(data)
+            if signature != _BINARY_SIGNATURE:
+                raise DataError("invalid binary COPY signature")
+            pos = _binary_header.size + extension
+            if end < pos:
+                self._buffer = data
+                return []
+            self._in_header = False
+
+        casters = self._casters
+        cursor = self._cursor
+        unpack_length = _int4.unpack_from
+
+        rows = []
+        while pos + 2 <= end and not self.done:
+            nfields = _int2.unpack_from(data, pos)[0]
+            if nfields == -1:
+                self.done = True
+                pos += 2
+                break
+
+            # Parse the row only if it is complete
+            fields = []
+            field_pos = pos + 2
+            for i in xrange(nfields):
+                if field_pos + 4 > end:
+                    break
+                length = unpack_length(data, field_pos)[0]
+                field_pos += 4
+                if length < 0:
+                    fields.append((i, None, 0))
+                    continue
+                if field_pos + length > end:
+                    break
+                fields.append((i, data[field_pos:field_pos + length], length))
+                field_pos += length
+            else:
+                row = [None] * nfields
+                for i, value, length in fields:
+                    if value is not None:
+                        caster = casters[i]
+                        if caster is not None:
+                            value = caster(value, length, cursor)
+                        row[i] = value
+                rows.append(tuple(row))
+                pos = field_pos
+                continue
+            break
+
+        self._buffer = data[pos:]
+        return rows
@@ -1,15 +1,21 @@
 from collections import namedtuple
 from functools import wraps
 from io import TextIOBase
+from itertools import islice
+import re
+import sys
 import weakref
 
 from psycopg2ct import tz
+from psycopg2ct._impl import columnar
 from psycopg2ct._impl import consts
+from psycopg2ct._impl import copyio
 from psycopg2ct._impl import exceptions
 from psycopg2ct._impl import libpq
 from psycopg2ct._impl import typecasts
 from psycopg2ct._impl import util
-from psycopg2ct._impl.adapters import _getquoted
+from psycopg2ct._impl.adapters import _getparam, _getquoted
+from psycopg2ct._impl.result import LazyResult
 from psycopg2ct._impl.exceptions import InterfaceError, ProgrammingError
 
 
@@ -90,6 +96,9 @@ class Cursor(object):
         self._lastrowid = 0
         self._name = name.replace('"', '""') if name is not None else name
         self._withhold = False
+        self._lazy = False
+        self._binary = False
+        self._server_params = False
         self._no_tuples = True
         self._rowcount = -1
         self._rownumber = 0
@@ -97,8 +106,10 @@ class Cursor(object):
         self._statusmessage = None
         self._typecasts = {}
         self._pgres = None
+        self._getvalue = libpq.PQgetvalue
         self._copyfile = None
         self._copysize = None
+        self._copy_stream = False
 
     def __del__(self):
         if self._pgres:
@@ -223,10 +234,22 @@ class Cursor(object):
         if isinstance(query, unicode):
             query = query.encode(self._conn._py_enc)
 
-        if parameters is not None:
-            self._query = _combine_cmd_params(query, parameters, conn)
-        else:
+        stmt = params = None
+        if parameters is not None and conn._prepare_threshold is not None \
+                and not self._name and not conn._async:
+            prepared = conn._get_auto_statement(query, parameters)
+            if prepared is not None:
+                stmt, params = prepared
+
+        if stmt is not None:
+            self._query = stmt[1]
+            params = _param_arrays(params)
+        elif parameters is None:
             self._query = query
+        elif self._server_params:
+            self._query, params = _bind_server_params(query, parameters, conn)
+        else:
+            self._query = _combine_cmd_params(query, parameters, conn)
 
         conn._begin_transaction()
         self._clear_pgres()
@@ -237,12 +260,55 @@ class Cursor(object):
                 self._withhold and "WITH" or "WITHOUT", # youuuuu
                 self._query)
 
-        self._pq_execute(self._query, conn._async)
+        self._pq_execute(self._query, conn._async, params,
+                         stmt and stmt[0])
+
+    @check_closed
+    def execute_prepared(self, name, parameters=None):
+        """Execute a statement created by the connection prepare() method.
+
+        The parameters are bound to the statement placeholders as in
+        execute(), they are sent separately from the statement so they must
+        be of the builtin types.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        self._description = None
+        conn = self._conn
+
+        if self._name:
+            raise ProgrammingError(
+                "can't execute a prepared statement on a named cursor")
 
+        if isinstance(name, unicode):
+            name = name.encode(conn._py_enc)
+        try:
+            name, query, keys = conn._statements[name]
+        except KeyError:
+            raise ProgrammingError(
+                'prepared statement "%s" does not exist' % name)
+
+        params = None
+        if parameters is not None:
+            params = _prepared_params(keys, parameters, conn)
+            if params is None:
+                raise ProgrammingError(
+                    "only values of the builtin types can be passed "
+                    "to a prepared statement")
+            params = _param_arrays(params)
+        elif keys:
+            raise ProgrammingError(
+                "the prepared statement requires parameters")
+
+        self._query = query
+        conn._begin_transaction()
+        self._clear_pgres()
+        self._pq_execute(query, conn._async, params, name)
 
     @check_closed
     @check_async
-    def executemany(self, query, paramlist):
+    def executemany(self, query, paramlist, page_size=1):
         """Prepare a database operation (query or command) and then execute
         it against all parameter sequences or mappings found in the sequence
         seq_of_parameters.
@@ -261,15 +327,66 @@ class Cursor(object):
 
         Return values are not defined.
 
+        By default every set is executed by execute(). With a `page_size`
+        greater than 1 the parameters are sent to the server in batches of
+        `page_size` sets, bound client side: a simple INSERT ... VALUES
+        query is sent as a single multi-row VALUES, other queries as a
+        single query with one statement per set. In autocommit mode every
+        batch runs in a transaction of its own. The batches are not used on
+        binary or server_params cursors, or when the connection prepares
+        the statements. The `page_size` argument is a psycopg2ct extension
+        to the DB API 2.0
+
         """
+        if self._name:
+            raise ProgrammingError(
+                "can't call .executemany() on named cursors")
+
         self._rowcount = -1
         rowcount = 0
-        for params in paramlist:
-            self.execute(query, params)
-            if self.rowcount == -1:
+        if page_size <= 1 or self._binary or self._server_params \
+                or self._conn._prepare_threshold is not None:
+            for params in paramlist:
+                self.execute(query, params)
+                if self.rowcount == -1:
+                    rowcount = -1
+                else:
+                    rowcount += self.rowcount
+            self._rowcount = rowcount
+            return
+
+        self._description = None
+        conn = self._conn
+
+        if isinstance(query, unicode):
+            query = query.encode(conn._py_enc)
+
+        insert = _split_insert_values(query)
+        paramlist = iter(paramlist)
+        while True:
+            page = list(islice(paramlist, page_size))
+            if not page:
+                break
+
+            if insert is not None:
+                head, row, tail = insert
+                self._query = '%s%s%s' % (head, ','.join(
+                    [_combine_cmd_params(row, params, conn)
+                        for params in page]), tail)
+            else:
+                # A newline ends a comment at the end of the statement
+                self._query = '\n;'.join(
+                    [_combine_cmd_params(query, params, conn)
+                        for params in page])
+
+            conn._begin_transaction()
+            self._clear_pgres()
+            count = self._pq_execute_batch(self._query)
+            if count == -1 or rowcount == -1:
                 rowcount = -1
             else:
-                rowcount += self.rowcount
+                rowcount += count
+
         self._rowcount = rowcount
 
     @check_closed
@@ -331,10 +448,8 @@ class Cursor(object):
         if size <= 0:
             return []
 
-        rows = []
-        for i in xrange(size):
-            rows.append(self._build_row(self._rownumber))
-            self._rownumber += 1
+        rows = self._build_rows(self._rownumber, self._rownumber + size)
+        self._rownumber += size
         return rows
 
     @check_closed
@@ -357,12 +472,73 @@ class Cursor(object):
         if size <= 0:
             return []
 
-        result = []
-        for row in xrange(size):
-            result.append(self._build_row(self._rownumber))
-            self._rownumber += 1
+        if self._lazy:
+            if self.row_factory:
+                raise ProgrammingError(
+                    "lazy results can't be used with a row factory")
+
+            # The result set takes over the PGresult and frees it
+            result = LazyResult(
+                self, self._pgres, self._rownumber, self._rowcount)
+            self._pgres = None
+            self._rownumber = self._rowcount
+            return result
+
+        result = self._build_rows(self._rownumber, self._rowcount)
+        self._rownumber = self._rowcount
         return result
 
+    @check_closed
+    @check_no_tuples
+    def fetch_columns(self):
+        """Fetch all (remaining) rows of a query result, returning them as a
+        list of columns, each one a list of values.
+
+        The result is walked column by column, which avoids transposing the
+        rows returned by fetchall().
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        if self._name is not None:
+            self._pq_execute('FETCH FORWARD ALL FROM "%s"' % self._name)
+
+        start = self._rownumber
+        end = self._rowcount
+        if end - start <= 0:
+            return [[] for i in xrange(self._nfields)]
+
+        columns = self._build_columns(start, end)
+        self._rownumber = end
+        return columns
+
+    @check_closed
+    @check_no_tuples
+    def fetchnumpy(self):
+        """Fetch all (remaining) rows of a query result, returning them as a
+        list of numpy masked arrays, one for each column.
+
+        Integer, float, boolean, date and timestamp columns are parsed
+        directly into arrays of the matching dtype, other columns are
+        typecast into object arrays. The mask is set for the NULL values.
+
+        Raise ImportError if numpy is not available.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        if columnar.numpy is None:
+            raise ImportError("numpy is required to fetch numpy arrays")
+
+        if self._name is not None:
+            self._pq_execute('FETCH FORWARD ALL FROM "%s"' % self._name)
+
+        start = self._rownumber
+        end = max(self._rowcount, start)
+        arrays = columnar.build_arrays(self, start, end)
+        self._rownumber = end
+        return arrays
+
     def nextset(self):
         """This method will make the cursor skip to the next available set,
         discarding any remaining rows from the current set.
@@ -402,7 +578,6 @@ class Cursor(object):
         return _combine_cmd_params(query, vars, self._conn)
 
     @check_closed
-    @check_async
     def copy_from(self, file, table, sep='\t', null='\\N', size=8192,
                   columns=None):
         """Reads data from a file-like object appending them to a database
@@ -410,6 +585,9 @@ class Cursor(object):
 
         The source file must have both read() and readline() method.
 
+        On an asynchronous connection the method returns once the command
+        is sent: the data is read from the file while poll() is called.
+
         TODO: Improve error handling
 
         """
@@ -423,44 +601,126 @@ class Cursor(object):
             util.quote_string(self._conn, sep),
             util.quote_string(self._conn, null))
 
-        self._copysize = size
-        self._copyfile = file
-        try:
-            self._pq_execute(query)
-        finally:
-            self._copyfile = None
-            self._copysize = None
+        self._copy_execute(query, file, size)
 
     @check_closed
     @check_async
-    def copy_to(self, file, table, sep='\t', null='\\N', columns=None):
-        """Writes the content of a table to a file-like object (COPY table
-        TO file syntax).
+    def copy_from_iter(self, table, rows, columns=None, sep='\t',
+                       null='\\N', size=65536, binary=False):
+        """Append the rows of an iterable to a database table (COPY table
+        FROM stdin syntax).
 
-        The target file must have a write() method.
+        Every row is a sequence of values, None is sent as `null` and the
+        other values are converted to the COPY text format while they are
+        sent, in chunks of about `size` bytes.
 
-        TODO: Improve error handling
+        If `binary` is true the rows are sent in the COPY binary format,
+        encoded according to the types of the table columns, and `sep` and
+        `null` are not used.
+
+        This is a psycopg2ct extension to the DB API 2.0
 
         """
-        if columns:
-            columns_str = '(%s)' % ','.join([column for column in columns])
+        if not binary:
+            reader = copyio.CopyRowsReader(rows, self._conn, sep, null)
+            self.copy_from(reader, table, sep, null, size, columns)
+            return
+
+        oids = self._copy_column_types(table, columns)
+        reader = copyio.BinaryCopyRowsReader(rows, oids, self._conn)
+        self.copy_expert("COPY %s%s FROM stdin WITH BINARY" % (
+            table, _columns_list(columns)), reader, size)
+
+    @check_closed
+    @check_async
+    def copy_to_rows(self, table, columns=None):
+        """Return the content of a table as a list of tuples, using the
+        COPY binary format (COPY table TO stdout WITH BINARY syntax).
+
+        The values are typecast by the binary typecasters of the columns
+        types.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return list(self.copy_to_iter(table, columns, binary=True))
+
+    @check_closed
+    @check_async
+    def copy_to_iter(self, sql_or_table, columns=None, binary=False):
+        """Return an iterator on the rows of a table or of a query result,
+        read with COPY ... TO stdout.
+
+        `sql_or_table` is a table name or a SELECT query. The data is parsed
+        while it is received and the values are typecast according to the
+        columns types, so the memory used doesn't depend on the number of
+        rows. If `binary` is true the COPY binary format and the binary
+        typecasters are used.
+
+        The COPY is executed when the iteration starts. The connection
+        can't be used until the iterator is exhausted or closed: closing it
+        discards the rest of the data.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        if isinstance(sql_or_table, unicode):
+            sql_or_table = sql_or_table.encode(self._conn._py_enc)
+
+        if _copy_query_re.match(sql_or_table):
+            if columns:
+                raise ProgrammingError(
+                    "columns can't be specified when copying a query")
+            source = '(%s)' % sql_or_table
+            types = (source + ' AS copy_source', None)
         else:
-            columns_str = ''
+            source = sql_or_table + _columns_list(columns)
+            types = (sql_or_table, columns)
+
+        if binary:
+            decoder = copyio.BinaryCopyDecoder
+            query = "COPY %s TO stdout WITH BINARY" % source
+        else:
+            decoder = copyio.TextCopyDecoder
+            query = "COPY %s TO stdout" % source
+        return self._copy_out_rows(query, decoder, types)
+
+    @check_closed
+    def copy_to(self, file, table, sep='\t', null='\\N', columns=None,
+                size=1048576):
+        """Writes the content of a table to a file-like object (COPY table
+        TO file syntax).
+
+        The target file must have a write() method. The rows are collected
+        in a buffer of `size` bytes and written when it is full. If the file
+        has a write_buffer() method it is called instead of write() with a
+        memoryview of the buffer, valid only until the method returns.
+
+        On an asynchronous connection the method returns once the command
+        is sent: the data is written to the file while poll() is called.
 
+        If writing to the file fails the rest of the data is read and
+        discarded, so that the connection can be used again, and the error
+        is raised.
+
+        """
         query = "COPY %s%s TO stdout WITH DELIMITER AS %s NULL AS %s" % (
-            table, columns_str,
+            table, _columns_list(columns),
             util.quote_string(self._conn, sep),
             util.quote_string(self._conn, null))
 
-        self._copyfile = file
-        try:
-            self._pq_execute(query)
-        finally:
-            self._copyfile = None
+        self._copy_execute(query, file, size)
 
     @check_closed
-    @check_async
     def copy_expert(self, sql, file, size=8192):
+        """Execute a COPY command reading the data from `file`, or writing
+        it to `file`.
+
+        For COPY FROM the data is read in chunks of `size` bytes; for COPY
+        TO it is written in chunks of about `size` bytes, see copy_to().
+        On an asynchronous connection the data is transferred by poll().
+
+        """
         if not sql:
             return
 
@@ -468,11 +728,7 @@ class Cursor(object):
             raise TypeError("file must be a readable file-like object for"
                 " COPY FROM; a writeable file-like object for COPY TO.")
 
-        self._copyfile = file
-        try:
-            self._pq_execute(sql)
-        finally:
-            self._copyfile = None
+        self._copy_execute(sql, file, size)
 
     @check_closed
     def setinputsizes(self, sizes):
@@ -603,6 +859,59 @@ class Cursor(object):
 
         self._withhold = bool(value)
 
+    @property
+    def lazy(self):
+        """If set, fetchall() returns a `LazyResult` instead of a list.
+
+        The values of the result set are typecast only when accessed: this
+        saves time and memory when only a part of a large result is used.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._lazy
+
+    @lazy.setter
+    def lazy(self, value):
+        self._lazy = bool(value)
+
+    @property
+    def binary(self):
+        """If set, the query results are requested in binary format.
+
+        The values are decoded by the typecasters registered in
+        `binary_types`, the types without one are returned as raw strings.
+        The queries are sent with PQexecParams(), which doesn't accept more
+        than one statement per query.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._binary
+
+    @binary.setter
+    def binary(self, value):
+        self._binary = bool(value)
+
+    @property
+    def server_params(self):
+        """If set, the query parameters are sent separately from the query.
+
+        The placeholders are converted to the PostgreSQL `$n` syntax and the
+        query is sent with PQexecParams(), so the values of the builtin types
+        don't need to be quoted and escaped. The values of the other types
+        are still merged into the query as literals. PQexecParams() doesn't
+        accept more than one statement per query.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        return self._server_params
+
+    @server_params.setter
+    def server_params(self, value):
+        self._server_params = bool(value)
+
     @check_closed
     def scroll(self, value, mode='relative'):
         if not self._name:
@@ -614,6 +923,10 @@ class Cursor(object):
                 raise ProgrammingError(
                     "scroll mode must be 'relative' or 'absolute'")
 
+            if self._pgres is None and not self._no_tuples:
+                raise ProgrammingError(
+                    "can't scroll: the result was handed to a lazy result")
+
             if not 0 <= new_pos < self._rowcount:
                 raise ProgrammingError("scroll destination out of bounds")
 
@@ -640,20 +953,23 @@ class Cursor(object):
             libpq.PQclear(self._pgres)
             self._pgres = None
 
-    def _pq_execute(self, query, async=False):
+    def _pq_execute(self, query, async=False, params=None, stmt=None):
         """Execute the query"""
+        self._conn._check_pid()
         pgconn = self._conn._pgconn
 
         # Check the status of the connection
         if libpq.PQstatus(pgconn) != libpq.CONNECTION_OK:
             raise self._conn._create_exception()
 
+        execute, send, args = self._pq_command(pgconn, query, params, stmt)
+
         if not async:
             with self._conn._lock:
                 if not self._conn._have_wait_callback():
-                    self._pgres = libpq.PQexec(pgconn, query)
+                    self._pgres = execute(*args)
                 else:
-                    self._pgres = self._conn._execute_green(query)
+                    self._pgres = self._conn._send_green(send, args)
                 if not self._pgres:
                     raise self._conn._create_exception(pgres=self._pgres)
                 self._conn._process_notifies()
@@ -661,7 +977,7 @@ class Cursor(object):
 
         else:
             with self._conn._lock:
-                ret = libpq.PQsendQuery(pgconn, query)
+                ret = send(*args)
                 if not ret:
 
                     # XXX: check if this is correct, seems like a hack.
@@ -683,6 +999,104 @@ class Cursor(object):
             self._conn._async_status = async_status
             self._conn._async_cursor = weakref.ref(self)
 
+    def _pq_execute_batch(self, query):
+        """Execute a query made of several statements.
+
+        Return the sum of the statements rowcount, or -1 if it is unknown for
+        some of them.
+
+        """
+        conn = self._conn
+        conn._check_pid()
+        pgconn = conn._pgconn
+        with conn._lock:
+            if not conn._have_wait_callback():
+                if libpq.PQsendQuery(pgconn, query):
+                    results = util.pq_get_results(pgconn)
+                else:
+                    results = None
+            else:
+                results = conn._send_green(
+                    libpq.PQsendQuery, (pgconn, query), util.pq_get_results)
+            if not results:
+                raise conn._create_exception()
+            conn._process_notifies()
+
+        # Keep the result of the failed statement, or else the last one
+        self._pgres = results[-1]
+        rowcount = 0
+        for pgres in results:
+            pgstatus = libpq.PQresultStatus(pgres)
+            if pgstatus == libpq.PGRES_COMMAND_OK:
+                count = libpq.PQcmdTuples(pgres)
+                count = count and int(count) or -1
+            elif pgstatus == libpq.PGRES_TUPLES_OK:
+                count = libpq.PQntuples(pgres)
+            else:
+                self._pgres = pgres
+                break
+            if count == -1 or rowcount == -1:
+                rowcount = -1
+            else:
+                rowcount += count
+
+        for pgres in results:
+            if pgres is not self._pgres:
+                libpq.PQclear(pgres)
+
+        self._pq_fetch()
+        return rowcount
+
+    def _pq_command(self, pgconn, query, params=None, stmt=None):
+        """Return the libpq functions to execute the query, the blocking one
+        and the asynchronous one, and the arguments to call them with.
+
+        `params` are the arrays returned by `_param_arrays()`. If `stmt` is
+        specified the prepared statement with that name is executed instead
+        of the query.
+
+        """
+        if stmt is not None:
+            if params is None:
+                params = (0, None, None, None, None)
+            args = (pgconn, stmt, params[0]) + params[2:] + \
+                (int(self._binary),)
+            return libpq.PQexecPrepared, libpq.PQsendQueryPrepared, args
+
+        if params is not None or self._binary:
+            if params is None:
+                params = (0, None, None, None, None)
+            args = (pgconn, query) + params + (int(self._binary),)
+            return libpq.PQexecParams, libpq.PQsendQueryParams, args
+        return libpq.PQexec, libpq.PQsendQuery, (pgconn, query)
+
+    def _copy_execute(self, query, file, size):
+        """Execute a COPY command transferring the data from or to `file`.
+
+        In asynchronous mode the file is kept until poll() starts the COPY.
+
+        """
+        self._copysize = size
+        self._copyfile = file
+        try:
+            self._pq_execute(query, self._conn._async)
+        except:
+            self._copyfile = None
+            self._copysize = None
+            raise
+        if not self._conn._async:
+            self._copyfile = None
+            self._copysize = None
+
+    def _copy_column_types(self, table, columns):
+        """Return the type oids of the table columns copied"""
+        self._pq_execute("SELECT %s FROM %s LIMIT 0" % (
+            columns and ','.join(columns) or '*', table))
+        oids = [column.type_code for column in self._description]
+        self._clear_pgres()
+        self._description = None
+        return oids
+
     def _pq_fetch(self):
         pgstatus = libpq.PQresultStatus(self._pgres)
         self._statusmessage = libpq.PQcmdStatus(self._pgres)
@@ -721,6 +1135,7 @@ class Cursor(object):
             self._no_tuples = False
             description = []
             casts = []
+            binary = False
             for i in xrange(self._nfields):
                 ftype = libpq.PQftype(self._pgres, i)
                 fsize = libpq.PQfsize(self._pgres, i)
@@ -742,7 +1157,12 @@ class Cursor(object):
                 else:
                     prec = scale = None
 
-                casts.append(self._get_cast(ftype))
+                if libpq.PQfformat(self._pgres, i):
+                    binary = True
+                    casts.append(typecasts.binary_types.get(
+                        ftype, typecasts.BINARY_UNKNOWN))
+                else:
+                    casts.append(self._get_cast(ftype))
                 description.append(Column(
                     name=libpq.PQfname(self._pgres, i),
                     type_code=ftype,
@@ -755,84 +1175,322 @@ class Cursor(object):
 
             self._description = tuple(description)
             self._casts = casts
+            self._casters = [typecasts.cast_function(c) for c in casts]
+            if binary:
+                self._getvalue = util.pq_get_binary_value
+            else:
+                self._getvalue = libpq.PQgetvalue
 
     def _pq_fetch_copy_in(self):
-        pgconn = self._conn._pgconn
-        size = self._copysize
-        error = 0
-        while True:
-            data = self._copyfile.read(size)
-            if isinstance(self._copyfile, TextIOBase):
-                data = data.encode(self._conn._py_enc)
+        self._copy_run(self._copy_in_steps(self._copyfile, self._copysize))
 
-            if not data:
-                break
+    def _pq_fetch_copy_out(self):
+        if self._copy_stream:
+            # The data is read by the iterator returned by copy_to_iter()
+            return
 
-            res = libpq.PQputCopyData(pgconn, data, len(data))
-            if res <= 0:
-                error = 2
-                break
+        self._copy_run(
+            self._copy_out_steps(self._copyfile, self._copysize or 8192))
+
+    def _copy_run(self, steps):
+        """Transfer the data of a COPY running the generator `steps`.
+
+        The steps yield POLL_READ or POLL_WRITE when they have to wait for
+        the connection, which happens only in non-blocking mode: with a wait
+        callback the connection is made non-blocking and the callback waits,
+        in asynchronous mode the steps are run by poll().
+
+        """
+        conn = self._conn
+        if conn._async:
+            conn._copy_steps = steps
+            self._copyfile = None
+            self._copysize = None
+            return
+
+        if not conn._have_wait_callback():
+            for state in steps:
+                pass
+            return
+
+        util.pq_set_non_blocking(conn._pgconn, 1, True)
+        try:
+            for state in steps:
+                conn._wait(state)
+        finally:
+            util.pq_set_non_blocking(conn._pgconn, 0)
+
+    def _copy_nonblocking(self):
+        return self._conn._async or self._conn._have_wait_callback()
+
+    def _copy_in_steps(self, file, size):
+        conn = self._conn
+        pgconn = conn._pgconn
+        nonblocking = self._copy_nonblocking()
+        is_text = isinstance(file, TextIOBase)
 
         errmsg = None
-        if error == 2:
-            errmsg = 'error in PQputCopyData() call'
+        try:
+            while True:
+                data = file.read(size)
+                if is_text:
+                    data = data.encode(conn._py_enc)
+
+                if not data:
+                    break
+
+                res = libpq.PQputCopyData(pgconn, data, len(data))
+                while res == 0:
+                    # The output buffer is full
+                    yield consts.POLL_WRITE
+                    if libpq.PQflush(pgconn) < 0:
+                        raise conn._create_exception()
+                    res = libpq.PQputCopyData(pgconn, data, len(data))
+                if res < 0:
+                    errmsg = 'error in PQputCopyData() call'
+                    break
+        except Exception:
+            # Terminate the COPY before propagating the error of the source
+            exc_info = sys.exc_info()
+            libpq.PQputCopyEnd(pgconn, 'error reading the COPY data')
+            self._clear_pgres()
+            util.pq_clear_async(pgconn)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        while True:
+            res = libpq.PQputCopyEnd(pgconn, errmsg)
+            if res != 0:
+                break
+            yield consts.POLL_WRITE
+            if libpq.PQflush(pgconn) < 0:
+                raise conn._create_exception()
+        if res < 0:
+            raise conn._create_exception()
+
+        for state in self._copy_end_steps(nonblocking):
+            yield state
+
+    def _copy_out_steps(self, file, size):
+        # The rows are copied from the libpq memory into a fixed buffer,
+        # written when full: no Python string is built per row
+        buf = bytearray(size)
+        base = libpq.addressof((libpq.c_char * size).from_buffer(buf))
+        memmove = libpq.memmove
+        flush = self._copy_out_writer(file, buf)
+
+        pos = 0
+        error = None
+        for address, length in self._pq_copy_out_data():
+            if address is None:
+                # No data available: length is the state to wait for
+                yield length
+                continue
+            if error is not None:
+                # Read the rest of the data to end the COPY
+                continue
+
+            try:
+                if pos + length > size:
+                    if pos:
+                        flush(pos)
+                        pos = 0
+                    if length > size:
+                        flush(libpq.string_at(address, length))
+                        continue
+                memmove(base + pos, address, length)
+                pos += length
+            except Exception:
+                error = sys.exc_info()
+
+        if error is None and pos:
+            flush(pos)
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def _copy_end_steps(self, nonblocking):
+        """Read the result of a COPY after its data."""
+        conn = self._conn
+        pgconn = conn._pgconn
+        if nonblocking:
+            while True:
+                res = libpq.PQflush(pgconn)
+                if res == 0:
+                    break
+                elif res < 0:
+                    raise conn._create_exception()
+                yield consts.POLL_WRITE
+
+            while conn._is_busy():
+                yield consts.POLL_READ
 
-        libpq.PQputCopyEnd(pgconn, errmsg)
         self._clear_pgres()
-        util.pq_clear_async(pgconn)
+        self._pgres = util.pq_get_last_result(pgconn)
+        if libpq.PQresultStatus(self._pgres) != libpq.PGRES_COMMAND_OK:
+            raise conn._create_exception(pgres=self._pgres)
 
-    def _pq_fetch_copy_out(self):
-        is_text = isinstance(self._copyfile, TextIOBase)
-        pgconn = self._conn._pgconn
-        while True:
-            buf = libpq.pointer(libpq.c_char_p())
-            length = libpq.PQgetCopyData(pgconn, buf, 0)
+        rowcount = libpq.PQcmdTuples(self._pgres)
+        if not rowcount or not rowcount[0]:
+            self._rowcount = -1
+        else:
+            self._rowcount = int(rowcount)
+        self._clear_pgres()
 
-            if length > 0:
-                value = buf.contents.value
-                if is_text:
-                    value = typecasts.parse_unicode(value, length, self)
-                libpq.PQfreemem(buf.contents)
+    def _copy_out_writer(self, file, buf):
+        """Return a function writing the first bytes of `buf` to `file`, or a
+        string when called with one."""
+        write_buffer = getattr(file, 'write_buffer', None)
+        if write_buffer is not None:
+            view = memoryview(buf)
+
+            def flush(data):
+                if isinstance(data, str):
+                    write_buffer(memoryview(data))
+                else:
+                    write_buffer(view[:data])
+            return flush
+
+        is_text = isinstance(file, TextIOBase)
+        write = file.write
+
+        def flush(data):
+            if not isinstance(data, str):
+                data = str(buf[:data])
+            if is_text:
+                data = typecasts.parse_unicode(data, len(data), self)
+            write(data)
+        return flush
 
-                if value is None:
-                    return
+    def _pq_copy_out_data(self):
+        """Iterate on the (address, length) of the data of the current COPY
+        OUT, then end it.
 
-                self._copyfile.write(value)
+        The data is freed when the next one is requested, the same pointer
+        is used for all of them. In non-blocking mode (None, state) is
+        returned when the connection must be waited for, with state either
+        POLL_READ or POLL_WRITE.
+
+        """
+        conn = self._conn
+        pgconn = conn._pgconn
+        nonblocking = self._copy_nonblocking()
+        getcopydata = libpq.PQgetCopyData
+        freemem = libpq.PQfreemem
+        ptr = libpq.c_char_p()
+        address = libpq.c_void_p.from_buffer(ptr)
+        ptr_ref = libpq.byref(ptr)
+
+        while True:
+            length = getcopydata(pgconn, ptr_ref, nonblocking and 1 or 0)
+
+            if length > 0:
+                try:
+                    yield address.value, length
+                finally:
+                    freemem(address)
+            elif length == 0:
+                yield None, consts.POLL_READ
+                if libpq.PQconsumeInput(pgconn) == 0:
+                    raise conn._create_exception()
             elif length == -2:
-                raise self._conn._create_exception()
+                raise conn._create_exception()
             else:
                 break
 
-        self._clear_pgres()
-        util.pq_clear_async(pgconn)
+        for state in self._copy_end_steps(nonblocking):
+            yield None, state
+
+    def _copy_out_rows(self, query, decoder_class, types):
+        # The columns types are read and the COPY started at the first
+        # iteration: an iterator dropped before it would leave the
+        # connection in the COPY state
+        decoder = decoder_class(self._copy_column_types(*types), self)
+        self._copy_stream = True
+        try:
+            self._pq_execute(query)
+        finally:
+            self._copy_stream = False
+
+        string_at = libpq.string_at
+        wait = self._conn._wait
+        chunks = self._pq_copy_out_data()
+        try:
+            for address, length in chunks:
+                if address is None:
+                    wait(length)
+                    continue
+                for row in decoder.feed(string_at(address, length)):
+                    yield row
+        finally:
+            # Read the rest of the data if the iteration is interrupted, so
+            # that the connection can be used again
+            for address, length in chunks:
+                if address is None:
+                    wait(length)
 
     def _build_row(self, row_num):
+        return self._build_rows(row_num, row_num + 1)[0]
 
-        # Create the row
-        if self.row_factory:
-            row = self.row_factory(self)
-            is_tuple = False
-        else:
-            row = [None] * self._nfields
-            is_tuple = True
-
-        # Fill it
-        n = self._nfields
-        for i in xrange(n):
-
-            # PQgetvalue will return an empty string for null values,
-            # so check with PQgetisnull if the value is really null
-            val = libpq.PQgetvalue(self._pgres, row_num, i)
-            if not val and libpq.PQgetisnull(self._pgres, row_num, i):
-                val = None
+    def _build_rows(self, start, end):
+        """Build the rows `start` to `end` of the current result in one pass.
+
+        The casters are resolved once per column in `_pq_fetch_tuples()` and
+        everything used in the inner loop is bound to a local name, so the
+        only work left per value is fetching it from the PGresult.
+
+        """
+        pgres = self._pgres
+        nfields = self._nfields
+        casters = self._casters
+        row_factory = self.row_factory
+        getvalue = self._getvalue
+        getisnull = libpq.PQgetisnull
+        columns = zip(xrange(nfields), casters)
+
+        rows = [None] * (end - start)
+        for pos, row_num in enumerate(xrange(start, end)):
+            if row_factory:
+                row = row_factory(self)
             else:
-                length = libpq.PQgetlength(self._pgres, row_num, i)
-                val = typecasts.typecast(self._casts[i], val, length, self)
-            row[i] = val
+                row = [None] * nfields
+
+            for i, caster in columns:
+                # PQgetvalue will return an empty string for null values,
+                # so check with PQgetisnull if the value is really null
+                val = getvalue(pgres, row_num, i)
+                if not val and getisnull(pgres, row_num, i):
+                    val = None
+                elif caster is not None:
+                    val = caster(val, len(val), self)
+                row[i] = val
+
+            if row_factory:
+                rows[pos] = row
+            else:
+                rows[pos] = tuple(row)
+        return rows
 
-        if is_tuple:
-            return tuple(row)
-        return row
+    def _build_columns(self, start, end):
+        """Build the columns of the rows `start` to `end` of the current
+        result, walking the PGresult one column at a time.
+
+        """
+        pgres = self._pgres
+        getvalue = self._getvalue
+        getisnull = libpq.PQgetisnull
+        row_nums = xrange(start, end)
+
+        columns = []
+        for i, caster in enumerate(self._casters):
+            column = [None] * (end - start)
+            for pos, row_num in enumerate(row_nums):
+                val = getvalue(pgres, row_num, i)
+                if not val and getisnull(pgres, row_num, i):
+                    continue
+                if caster is not None:
+                    val = caster(val, len(val), self)
+                column[pos] = val
+            columns.append(column)
+        return columns
 
     def _get_cast(self, oid):
         try:
@@ -847,6 +1505,17 @@ class Cursor(object):
                     return typecasts.string_types[705]
 
 
+# A query to COPY, instead of a table name
+_copy_query_re = re.compile(r'\s*(\(|(SELECT|WITH|VALUES)\b)', re.IGNORECASE)
+
+
+def _columns_list(columns):
+    """Return the columns list of a COPY command"""
+    if columns:
+        return '(%s)' % ','.join(columns)
+    return ''
+
+
 def _combine_cmd_params(cmd, params, conn):
     """Combine the command string and params"""
 
@@ -855,33 +1524,127 @@ def _combine_cmd_params(cmd, params, conn):
     if '%' not in cmd:
         return cmd
 
-    idx = 0
-    param_num = 0
-    arg_values = None
+    fragments, keys = _get_parsed_query(cmd, conn)
+    if not keys:
+        return fragments[0]
+
+    if isinstance(keys[0], basestring):
+        arg_values = {}
+        for key in keys:
+            if key not in arg_values:
+                arg_values[key] = _getquoted(params[key], conn)
+        values = [arg_values[key] for key in keys]
+    else:
+        values = [_getquoted(params[key], conn) for key in keys]
+        if len(values) != len(params):
+            raise TypeError(
+                "not all arguments converted during string formatting")
+
+    parts = [None] * (len(fragments) + len(values))
+    parts[::2] = fragments
+    parts[1::2] = values
+    return ''.join(parts)
+
+
+# The start of an INSERT query up to the opening paren of the VALUES row:
+# the table name and the optional columns list
+_insert_values_re = re.compile(
+    r'\s*INSERT\s+INTO\s+[^();]+?(?:\s*\([^();]*\)\s*|\s+)VALUES\s*\(',
+    re.IGNORECASE)
+
+
+def _split_insert_values(cmd):
+    """Split a simple INSERT ... VALUES (...) query around its row.
+
+    Return the part before the row, the row and the part after it, or None
+    if the query is not an INSERT of a single VALUES row with placeholders
+    in the row only.
+
+    """
+    match = _insert_values_re.match(cmd)
+    if match is None:
+        return None
+
+    # Find the paren closing the row, skipping the quoted strings
+    start = match.end() - 1
+    depth = 0
+    quote = None
+    for idx in xrange(start, len(cmd)):
+        char = cmd[idx]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        return None
+
+    head, row, tail = cmd[:start], cmd[start:idx + 1], cmd[idx + 1:]
+    if '%' in head or '%' in tail or ';' in tail.strip().rstrip(';') \
+            or tail.lstrip().startswith(','):
+        return None
+    return head, row, tail.rstrip().rstrip(';')
+
+
+def _get_parsed_query(cmd, conn):
+    """Return the command parsed by `_parse_query()`, using the cache of the
+    connection"""
+    cache = conn._query_cache
+    parsed = cache.get(cmd)
+    if parsed is None:
+        parsed = _parse_query(cmd)
+        cache.set(cmd, parsed)
+    return parsed
+
+
+def _parse_query(cmd):
+    """Split the command string at the placeholders.
+
+    Return the list of the literal fragments of the query, with the '%%'
+    escapes already replaced, and the list of the placeholders: the position
+    of the parameter for '%s' or its name for '%(name)s'. There is always one
+    fragment more than placeholders.
+
+    """
+    fragments = []
+    keys = []
     named_args_format = None
 
-    def check_format_char(format_char, pos):
-        """Raise an exception when the format_char is unsupported"""
-        if format_char not in 's ':
+    def check_format_char(pos, start):
+        """Return the position after the format char, raise an exception
+        when it is unsupported"""
+        while cmd[pos] == ' ':
+            pos += 1
+        format_char = cmd[pos]
+        if format_char != 's':
             raise ValueError(
                 "unsupported format character '%s' (0x%x) at index %d" %
-                (format_char, ord(format_char), pos))
+                (format_char, ord(format_char), start))
+        return pos + 1
 
-    cmd_length = len(cmd)
-    while idx < cmd_length:
+    parts = []
+    start = 0
+    idx = cmd.find('%')
+    while idx >= 0:
 
         # Escape
-        if cmd[idx] == '%' and cmd[idx + 1] == '%':
-            idx += 1
+        if cmd[idx + 1] == '%':
+            parts.append(cmd[start:idx + 1])
+            start = idx + 2
 
         # Named parameters
-        elif cmd[idx] == '%' and cmd[idx + 1] == '(':
+        elif cmd[idx + 1] == '(':
 
             # Validate that we don't mix formats
             if named_args_format is False:
                 raise ValueError("argument formats can't be mixed")
-            elif named_args_format is None:
-                named_args_format = True
+            named_args_format = True
 
             # Check for incomplate placeholder
             max_lookahead = cmd.find('%', idx + 2)
@@ -890,43 +1653,129 @@ def _combine_cmd_params(cmd, params, conn):
                 raise ProgrammingError(
                     "incomplete placeholder: '%(' without ')'")
 
-            key = cmd[idx + 2:end]
-            if arg_values is None:
-                arg_values = {}
-            if key not in arg_values:
-                arg_values[key] = _getquoted(params[key], conn)
-
-            check_format_char(cmd[end + 1], idx)
+            parts.append(cmd[start:idx])
+            fragments.append(''.join(parts))
+            parts = []
+            keys.append(cmd[idx + 2:end])
+            start = check_format_char(end + 1, idx)
 
         # Indexed parameters
-        elif cmd[idx] == '%':
+        else:
 
             # Validate that we don't mix formats
             if named_args_format is True:
                 raise ValueError("argument formats can't be mixed")
-            elif named_args_format is None:
-                named_args_format = False
+            named_args_format = False
 
-            check_format_char(cmd[idx + 1], idx)
+            parts.append(cmd[start:idx])
+            fragments.append(''.join(parts))
+            parts = []
+            keys.append(len(keys))
+            start = check_format_char(idx + 1, idx)
 
-            if arg_values is None:
-                arg_values = []
+        idx = cmd.find('%', start)
 
-            value = _getquoted(params[param_num], conn)
-            arg_values.append(value)
+    parts.append(cmd[start:])
+    fragments.append(''.join(parts))
+    return tuple(fragments), tuple(keys)
 
-            param_num += 1
-            idx += 1
 
-        idx += 1
+def _bind_server_params(cmd, params, conn):
+    """Convert the command placeholders to the $n syntax.
 
-    if named_args_format is False:
-        if len(arg_values) != len(params):
-            raise TypeError(
-                "not all arguments converted during string formatting")
-        arg_values = tuple(arg_values)
+    Return the new command and the arrays of the parameters types, values,
+    lengths and formats to be passed to PQexecParams(), or None if there is
+    no parameter to pass. The parameters which can't be passed separately
+    are merged into the command.
 
-    if not arg_values:
-        return cmd % tuple()  # Required to unescape % chars
-    return cmd % arg_values
+    """
+    fragments, keys = _get_parsed_query(cmd, conn)
+
+    query = [fragments[0]]
+    values = []
+    placeholders = {}
+    for key, fragment in zip(keys, fragments[1:]):
+        placeholder = placeholders.get(key)
+        if placeholder is None:
+            param = _getparam(params[key], conn)
+            if param is None:
+                placeholder = _getquoted(params[key], conn)
+            else:
+                values.append(param)
+                placeholder = '$%d' % len(values)
+            placeholders[key] = placeholder
+        query.append(placeholder)
+        query.append(fragment)
 
+    if keys and not isinstance(keys[0], basestring) \
+            and len(keys) != len(params):
+        raise TypeError(
+            "not all arguments converted during string formatting")
+
+    return ''.join(query), _param_arrays(values)
+
+
+def _prepare_query(cmd, conn):
+    """Convert the command placeholders to the $n syntax for a prepared
+    statement.
+
+    Return the new command and the keys of the parameters, in the order of
+    the $n placeholders.
+
+    """
+    fragments, keys = _get_parsed_query(cmd, conn)
+
+    query = [fragments[0]]
+    params = []
+    placeholders = {}
+    for key, fragment in zip(keys, fragments[1:]):
+        placeholder = placeholders.get(key)
+        if placeholder is None:
+            params.append(key)
+            placeholder = placeholders[key] = '$%d' % len(params)
+        query.append(placeholder)
+        query.append(fragment)
+
+    return ''.join(query), tuple(params)
+
+
+def _prepared_params(keys, params, conn):
+    """Return the (oid, value, format) of the parameters of a prepared
+    statement, or None if some of them can't be sent separately.
+
+    """
+    values = []
+    for key in keys:
+        param = _getparam(params[key], conn)
+        if param is None:
+            return None
+        values.append(param)
+
+    if keys and not isinstance(keys[0], basestring) \
+            and len(keys) != len(params):
+        raise TypeError(
+            "not all arguments converted during string formatting")
+
+    return values
+
+
+def _param_arrays(params):
+    """Return the arrays of the types, values, lengths and formats of the
+    (oid, value, format) parameters to be passed to the libpq functions, or
+    None if there is no parameter.
+
+    """
+    if not params:
+        return None
+
+    num = len(params)
+    oids = (libpq.c_uint * num)()
+    values = (libpq.c_char_p * num)()
+    lengths = (libpq.c_int * num)()
+    formats = (libpq.c_int * num)()
+    for i, (oid, value, format) in enumerate(params):
+        oids[i] = oid
+        values[i] = value
+        lengths[i] = value is not None and len(value) or 0
+        formats[i] = format
+    return num, oids, values, lengths, formats
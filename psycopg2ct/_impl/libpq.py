@@ -40,6 +40,10 @@ PGRES_COPY_IN = 4
 PGRES_BAD_RESPONSE = 5
 PGRES_NONFATAL_ERROR = 6
 PGRES_FATAL_ERROR = 7
+PGRES_COPY_BOTH = 8
+PGRES_SINGLE_TUPLE = 9
+PGRES_PIPELINE_SYNC = 10
+PGRES_PIPELINE_ABORTED = 11
 
 ExecStatusType = c_int
 
@@ -142,6 +146,21 @@ PQexec = libpq.PQexec
 PQexec.argtypes = [PGconn_p, c_char_p]
 PQexec.restype = PGresult_p
 
+PQexecParams = libpq.PQexecParams
+PQexecParams.argtypes = [PGconn_p, c_char_p, c_int, POINTER(c_uint),
+                         POINTER(c_char_p), POINTER(c_int), POINTER(c_int),
+                         c_int]
+PQexecParams.restype = PGresult_p
+
+PQprepare = libpq.PQprepare
+PQprepare.argtypes = [PGconn_p, c_char_p, c_char_p, c_int, POINTER(c_uint)]
+PQprepare.restype = PGresult_p
+
+PQexecPrepared = libpq.PQexecPrepared
+PQexecPrepared.argtypes = [PGconn_p, c_char_p, c_int, POINTER(c_char_p),
+                           POINTER(c_int), POINTER(c_int), c_int]
+PQexecPrepared.restype = PGresult_p
+
 PQresultStatus = libpq.PQresultStatus
 PQresultStatus.argtypes = [PGresult_p]
 PQresultStatus.restype = ExecStatusType
@@ -196,6 +215,16 @@ PQgetvalue = libpq.PQgetvalue
 PQgetvalue.argtypes = [PGresult_p, c_int, c_int]
 PQgetvalue.restype = c_char_p
 
+# Binary values can contain NUL bytes, so they are read with string_at()
+# from the pointer returned by this second binding of PQgetvalue
+PQgetvalue_raw = libpq['PQgetvalue']
+PQgetvalue_raw.argtypes = [PGresult_p, c_int, c_int]
+PQgetvalue_raw.restype = c_void_p
+
+PQfformat = libpq.PQfformat
+PQfformat.argtypes = [PGresult_p, c_int]
+PQfformat.restype = c_int
+
 # Retrieving other result information
 
 PQcmdStatus = libpq.PQcmdStatus
@@ -243,6 +272,23 @@ PQsendQuery = libpq.PQsendQuery
 PQsendQuery.argtypes = [PGconn_p, c_char_p]
 PQsendQuery.restype = c_int
 
+PQsendQueryParams = libpq.PQsendQueryParams
+PQsendQueryParams.argtypes = [PGconn_p, c_char_p, c_int, POINTER(c_uint),
+                              POINTER(c_char_p), POINTER(c_int),
+                              POINTER(c_int), c_int]
+PQsendQueryParams.restype = c_int
+
+PQsendPrepare = libpq.PQsendPrepare
+PQsendPrepare.argtypes = [PGconn_p, c_char_p, c_char_p, c_int,
+                          POINTER(c_uint)]
+PQsendPrepare.restype = c_int
+
+PQsendQueryPrepared = libpq.PQsendQueryPrepared
+PQsendQueryPrepared.argtypes = [PGconn_p, c_char_p, c_int,
+                                POINTER(c_char_p), POINTER(c_int),
+                                POINTER(c_int), c_int]
+PQsendQueryPrepared.restype = c_int
+
 PQgetResult = libpq.PQgetResult
 PQgetResult.argtypes = [PGconn_p]
 PQgetResult.restype = PGresult_p
@@ -263,6 +309,21 @@ PQflush = libpq.PQflush
 PQflush.argtypes = [PGconn_p]
 PQflush.restype = c_int
 
+# Pipeline Mode
+
+if PG_VERSION >= 0x0E0000:
+    PQenterPipelineMode = libpq.PQenterPipelineMode
+    PQenterPipelineMode.argtypes = [PGconn_p]
+    PQenterPipelineMode.restype = c_int
+
+    PQexitPipelineMode = libpq.PQexitPipelineMode
+    PQexitPipelineMode.argtypes = [PGconn_p]
+    PQexitPipelineMode.restype = c_int
+
+    PQpipelineSync = libpq.PQpipelineSync
+    PQpipelineSync.argtypes = [PGconn_p]
+    PQpipelineSync.restype = c_int
+
 # Cancelling queries in progress
 
 PQgetCancel = libpq.PQgetCancel
@@ -0,0 +1,307 @@
+"""Send several queries to the server in a single round trip."""
+import select
+import weakref
+
+from psycopg2ct._impl import consts
+from psycopg2ct._impl import libpq
+from psycopg2ct._impl import util
+from psycopg2ct._impl.cursor import _combine_cmd_params
+from psycopg2ct._impl.exceptions import OperationalError, ProgrammingError
+
+
+# True if the libpq supports the pipeline mode
+have_pipeline = hasattr(libpq, 'PQenterPipelineMode')
+
+
+class Pipeline(object):
+    """A queue of queries sent to the server together.
+
+    execute() queues a query on a cursor, sync() sends all the queued
+    queries and stores every result in its own cursor, in order. Used as a
+    context manager the queries are sent on exit.
+
+    With a libpq supporting it the queries are sent in pipeline mode,
+    else they are joined in a single multi-statement query: in both cases
+    each query must be a single statement. The queries are run in a
+    single transaction: if one fails the following ones are not executed.
+
+    On asynchronous connections sync() only starts sending the queries:
+    the results are available when poll() returns POLL_OK.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._queue = [] # (cursor, query)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.sync()
+        else:
+            self._queue = []
+
+    def execute(self, cursor, query, parameters=None):
+        """Queue a query to be executed on `cursor`.
+
+        Return the cursor, whose results are available after sync().
+
+        """
+        conn = self._conn
+        if cursor.connection is not conn:
+            raise ProgrammingError(
+                "the cursor doesn't belong to the pipeline connection")
+        if cursor.name:
+            raise ProgrammingError("named cursors can't be pipelined")
+
+        if isinstance(query, unicode):
+            query = query.encode(conn._py_enc)
+        if parameters is not None:
+            query = _combine_cmd_params(query, parameters, conn)
+
+        self._queue.append((cursor, query))
+        return cursor
+
+    def sync(self):
+        """Send the queued queries and fetch their results.
+
+        Return the list of the cursors the queries were executed on. If a
+        query failed, the error is raised once all the results are
+        received.
+
+        """
+        conn = self._conn
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+        if conn.closed:
+            raise conn.InterfaceError('connection already closed')
+        conn._check_pid()
+        if conn.isexecuting():
+            raise ProgrammingError(
+                'cannot be used while an asynchronous query is underway')
+
+        queries = [(query, cursor.binary) for cursor, query in queue]
+        begin = conn.status == consts.STATUS_READY and not conn.autocommit
+        if begin:
+            queries.insert(0, ('BEGIN', False))
+
+        for cursor, query in queue:
+            cursor._description = None
+            cursor._query = query
+            cursor._clear_pgres()
+
+        cursors = [cursor for cursor, query in queue]
+        if conn._async:
+            conn._copy_steps = self._steps(queries, begin, cursors, True)
+            conn._async_cursor = weakref.ref(cursors[0])
+            return cursors
+
+        if not conn._have_wait_callback():
+            with conn._lock:
+                for state in self._steps(queries, begin, cursors, False):
+                    pass
+            return cursors
+
+        util.pq_set_non_blocking(conn._pgconn, 1, True)
+        try:
+            with conn._lock:
+                for state in self._steps(queries, begin, cursors, True):
+                    conn._wait(state)
+        finally:
+            util.pq_set_non_blocking(conn._pgconn, 0)
+        return cursors
+
+    def _steps(self, queries, begin, cursors, nonblocking):
+        """Run the queries and distribute the results to the cursors.
+
+        `begin` is True if the first query is a BEGIN added by sync().
+        Yield POLL_READ or POLL_WRITE when waiting for the connection in
+        non-blocking mode.
+
+        """
+        conn = self._conn
+        results = []
+        if have_pipeline:
+            steps = self._pipeline_steps(queries, results, nonblocking)
+        else:
+            steps = self._batch_steps(queries, results, nonblocking)
+        for state in steps:
+            yield state
+
+        conn._process_notifies()
+
+        if begin and results:
+            pgres = results.pop(0)
+            if libpq.PQresultStatus(pgres) != libpq.PGRES_COMMAND_OK:
+                for other in results:
+                    libpq.PQclear(other)
+                try:
+                    raise conn._create_exception(pgres=pgres)
+                finally:
+                    libpq.PQclear(pgres)
+            libpq.PQclear(pgres)
+            conn.status = consts.STATUS_BEGIN
+
+        error = None
+        for i, cursor in enumerate(cursors):
+            pgres = i < len(results) and results[i] or None
+            if pgres is None or libpq.PQresultStatus(pgres) \
+                    == libpq.PGRES_PIPELINE_ABORTED:
+                if pgres is not None:
+                    libpq.PQclear(pgres)
+                if error is None:
+                    error = OperationalError(
+                        "query not executed: a previous query of the "
+                        "pipeline failed")
+                continue
+
+            cursor._pgres = pgres
+            try:
+                cursor._pq_fetch()
+            except Exception, e:
+                if error is None:
+                    error = e
+
+        if error is not None:
+            raise error
+
+    def _flush(self, nonblocking):
+        pgconn = self._conn._pgconn
+        while nonblocking:
+            ret = libpq.PQflush(pgconn)
+            if ret == 0:
+                break
+            if ret < 0:
+                raise self._conn._create_exception()
+            yield consts.POLL_WRITE
+
+    def _busy(self, nonblocking):
+        """Wait until a result can be read without blocking."""
+        conn = self._conn
+        while nonblocking:
+            if not libpq.PQconsumeInput(conn._pgconn):
+                raise conn._create_exception()
+            if not libpq.PQisBusy(conn._pgconn):
+                break
+            yield consts.POLL_READ
+
+    def _batch_steps(self, queries, results, nonblocking):
+        """Send the queries as a single multi-statement query.
+
+        Every statement returns a result, until the first one failing: they
+        are added to `results`.
+
+        """
+        conn = self._conn
+        pgconn = conn._pgconn
+        # A newline ends a comment at the end of a query
+        if not libpq.PQsendQuery(pgconn,
+                '\n;'.join([query for query, binary in queries])):
+            raise conn._create_exception()
+        for state in self._flush(nonblocking):
+            yield state
+
+        try:
+            while True:
+                for state in self._busy(nonblocking):
+                    yield state
+                pgres = libpq.PQgetResult(pgconn)
+                if not pgres:
+                    break
+                results.append(pgres)
+        except:
+            for pgres in results:
+                libpq.PQclear(pgres)
+            del results[:]
+            raise
+
+    def _pipeline_steps(self, queries, results, nonblocking):
+        """Send the queries in pipeline mode, followed by a sync.
+
+        Every query returns a result, PGRES_PIPELINE_ABORTED for the ones
+        following a failure: they are added to `results`.
+
+        """
+        conn = self._conn
+        pgconn = conn._pgconn
+        if not libpq.PQenterPipelineMode(pgconn):
+            raise conn._create_exception()
+
+        synced = False
+        try:
+            for query, binary in queries:
+                if not libpq.PQsendQueryParams(pgconn, query, 0,
+                        None, None, None, None, int(binary)):
+                    raise conn._create_exception()
+            if not libpq.PQpipelineSync(pgconn):
+                raise conn._create_exception()
+            synced = True
+            for state in self._flush(nonblocking):
+                yield state
+
+            # Every query result is followed by a NULL, the sync by nothing
+            while True:
+                for state in self._busy(nonblocking):
+                    yield state
+                pgres = libpq.PQgetResult(pgconn)
+                if not pgres:
+                    continue
+                if libpq.PQresultStatus(pgres) == libpq.PGRES_PIPELINE_SYNC:
+                    libpq.PQclear(pgres)
+                    break
+                results.append(pgres)
+        except:
+            for pgres in results:
+                libpq.PQclear(pgres)
+            del results[:]
+            self._abort_pipeline(synced)
+            raise
+
+        if not libpq.PQexitPipelineMode(pgconn):
+            raise conn._create_exception()
+
+    def _abort_pipeline(self, synced):
+        """Leave the pipeline mode after an error.
+
+        The results still pending are read, blocking, and discarded. If the
+        connection can't leave the pipeline mode it is closed, as it
+        couldn't run any other query.
+
+        """
+        conn = self._conn
+        pgconn = conn._pgconn
+        if libpq.PQexitPipelineMode(pgconn):
+            return
+
+        if (synced or libpq.PQpipelineSync(pgconn)) and self._drain_output():
+            nulls = 0
+            # Every query result is followed by a NULL: two NULLs in a row
+            # mean that there is nothing more to read
+            while nulls < 2 and libpq.PQstatus(pgconn) == libpq.CONNECTION_OK:
+                pgres = libpq.PQgetResult(pgconn)
+                if not pgres:
+                    nulls += 1
+                    continue
+                nulls = 0
+                status = libpq.PQresultStatus(pgres)
+                libpq.PQclear(pgres)
+                if status == libpq.PGRES_PIPELINE_SYNC:
+                    break
+            if libpq.PQexitPipelineMode(pgconn):
+                return
+
+        conn.close()
+
+    def _drain_output(self):
+        """Send all the output queued, blocking. Return False on error."""
+        pgconn = self._conn._pgconn
+        while True:
+            ret = libpq.PQflush(pgconn)
+            if ret <= 0:
+                return ret == 0
+            select.select([], [libpq.PQsocket(pgconn)], [])
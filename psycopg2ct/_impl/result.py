@@ -0,0 +1,147 @@
+from functools import wraps
+
+from psycopg2ct._impl import libpq
+from psycopg2ct._impl.exceptions import InterfaceError
+
+
+# Marker for the cells which are not typecast yet
+_missing = object()
+
+
+def check_closed(func):
+    @wraps(func)
+    def check_closed_(self, *args, **kwargs):
+        if self.closed:
+            raise InterfaceError("result set already closed")
+        return func(self, *args, **kwargs)
+    return check_closed_
+
+
+class LazyResult(object):
+    """A read-only sequence of rows backed by the PGresult of a query.
+
+    This is returned by fetchall() on a cursor with `lazy` set. The values
+    are only typecast when they are accessed for the first time and are then
+    memoized per cell. The PGresult is freed on close() or when the object
+    is garbage collected.
+
+    """
+
+    def __init__(self, cursor, pgres, start, end):
+        self._cursor = cursor
+        self._pgres = pgres
+        self._start = start
+        self._nrows = end - start
+        self._nfields = cursor._nfields
+        self._casters = cursor._casters
+        self._getvalue = cursor._getvalue
+        self._cells = [None] * self._nfields
+        self.description = cursor.description
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Free the PGresult, the memoized values are dropped too."""
+        if self._pgres:
+            libpq.PQclear(self._pgres)
+            self._pgres = None
+        self._cells = None
+
+    @property
+    def closed(self):
+        return self._pgres is None
+
+    def __len__(self):
+        return self._nrows
+
+    @check_closed
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [LazyRow(self, i)
+                for i in xrange(*index.indices(self._nrows))]
+
+        if index < 0:
+            index += self._nrows
+        if not 0 <= index < self._nrows:
+            raise IndexError("result set index out of range")
+        return LazyRow(self, index)
+
+    def __iter__(self):
+        for i in xrange(self._nrows):
+            yield self[i]
+
+    @check_closed
+    def column(self, index):
+        """Return a list with all the values of a column.
+
+        The column can be specified by position or by name.
+
+        """
+        if not isinstance(index, (int, long)):
+            names = [col.name for col in self.description]
+            try:
+                index = names.index(index)
+            except ValueError:
+                raise KeyError(index)
+
+        return [self._value(i, index) for i in xrange(self._nrows)]
+
+    @check_closed
+    def _value(self, row, col):
+        cells = self._cells[col]
+        if cells is None:
+            cells = self._cells[col] = [_missing] * self._nrows
+
+        val = cells[row]
+        if val is _missing:
+            row_num = self._start + row
+            val = self._getvalue(self._pgres, row_num, col)
+            if not val and libpq.PQgetisnull(self._pgres, row_num, col):
+                val = None
+            else:
+                caster = self._casters[col]
+                if caster is not None:
+                    val = caster(val, len(val), self._cursor)
+            cells[row] = val
+        return val
+
+
+class LazyRow(object):
+    """A row of a `LazyResult`, the values are typecast on access."""
+
+    __slots__ = ('_result', '_row')
+
+    def __init__(self, result, row):
+        self._result = result
+        self._row = row
+
+    def __len__(self):
+        return self._result._nfields
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple([self._result._value(self._row, i)
+                for i in xrange(*index.indices(len(self)))])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return self._result._value(self._row, index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._result._value(self._row, i)
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(tuple(self))
@@ -1,6 +1,8 @@
 import datetime
 import decimal
 import math
+import struct
+import uuid
 from time import localtime
 
 from psycopg2ct._impl import libpq
@@ -57,6 +59,24 @@ def typecast(caster, value, length, cursor):
     return caster.cast(value, cursor, length)
 
 
+def cast_function(caster):
+    """Return a ``func(value, length, cursor)`` callable for the caster.
+
+    The fetch methods resolve this once per result column instead of going
+    through `typecast()` and `Type.cast()` for every value.  None is returned
+    when the value can be used as it is.
+
+    """
+    if isinstance(caster, Type):
+        if caster.py_caster is not None:
+            py_caster = caster.py_caster
+            return lambda value, length, cursor: py_caster(value, cursor)
+        if caster.caster is parse_string:
+            return None
+        return caster.caster
+    return lambda value, length, cursor: caster.cast(value, cursor, length)
+
+
 def parse_unknown(value, length, cursor):
     if value != '{}':
         return value
@@ -220,6 +240,11 @@ def _parse_time(value, cursor):
 
 
 def parse_datetime(value, length, cursor):
+    """Infinity is mapped on datetime.max/min"""
+    if value == 'infinity':
+        return datetime.datetime.max
+    elif value == '-infinity':
+        return datetime.datetime.min
     date, time = value.split(' ')
     date = _parse_date(date)
     time = _parse_time(time, cursor)
@@ -227,6 +252,11 @@ def parse_datetime(value, length, cursor):
 
 
 def parse_date(value, length, cursor):
+    """Infinity is mapped on date.max/min"""
+    if value == 'infinity':
+        return datetime.date.max
+    elif value == '-infinity':
+        return datetime.date.min
     return _parse_date(value)
 
 
@@ -387,3 +417,228 @@ TIMEARRAY = _default_type(
 UNICODE = Type('UNICODE', [19, 18, 25, 1042, 1043], parse_unicode)
 UNICODEARRAY = Type('UNICODEARRAY', [1002, 1003, 1009, 1014, 1015],
     parse_array(UNICODE))
+
+
+# Binary typecasters
+#
+# These are used for the columns of results requested in binary format (see
+# Cursor.binary), the values are the raw bytes sent by the server.
+
+_PG_EPOCH = datetime.datetime(2000, 1, 1)
+_PG_EPOCH_DATE = _PG_EPOCH.date()
+
+_DATE_INFINITY = 0x7FFFFFFF
+_TIMESTAMP_INFINITY = 0x7FFFFFFFFFFFFFFF
+
+_NUMERIC_NEG = 0x4000
+_NUMERIC_NAN = 0xC000
+_NUMERIC_PINF = 0xD000
+_NUMERIC_NINF = 0xF000
+
+_int4 = struct.Struct('!i')
+_int8 = struct.Struct('!q')
+_time_tz = struct.Struct('!qi')
+_interval = struct.Struct('!qii')
+_numeric_header = struct.Struct('!hhHH')
+_array_header = struct.Struct('!iiI')
+_array_dimension = struct.Struct('!ii')
+
+
+def _binary_unpacker(fmt):
+    """Return a typecaster unpacking a single value with `fmt`."""
+    unpack_from = struct.Struct(fmt).unpack_from
+
+    def parse(value, length, cursor):
+        return unpack_from(value)[0]
+    return parse
+
+
+parse_binary_int2 = _binary_unpacker('!h')
+parse_binary_int4 = _binary_unpacker('!i')
+parse_binary_int8 = _binary_unpacker('!q')
+parse_binary_oid = _binary_unpacker('!I')
+parse_binary_float4 = _binary_unpacker('!f')
+parse_binary_float8 = _binary_unpacker('!d')
+
+
+def parse_binary_boolean(value, length, cursor):
+    return value != '\x00'
+
+
+def parse_binary_bytea(value, length, cursor):
+    """The binary format of bytea is the data itself, no unescaping needed"""
+    return buffer(value)
+
+
+def parse_binary_date(value, length, cursor):
+    """Days since 2000-01-01, infinity is mapped on date.max/min"""
+    days = _int4.unpack_from(value)[0]
+    if days == _DATE_INFINITY:
+        return datetime.date.max
+    elif days == -_DATE_INFINITY - 1:
+        return datetime.date.min
+    return _PG_EPOCH_DATE + datetime.timedelta(days)
+
+
+def _binary_time(micros, tzinfo=None):
+    seconds, microsecond = divmod(micros, 1000000)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return datetime.time(hour, minute, second, microsecond, tzinfo)
+
+
+def parse_binary_time(value, length, cursor):
+    """Microseconds since midnight"""
+    return _binary_time(_int8.unpack_from(value)[0])
+
+
+def parse_binary_timetz(value, length, cursor):
+    """Microseconds since midnight and the offset in seconds west of UTC"""
+    micros, offset = _time_tz.unpack_from(value)
+    tzinfo = None
+    if cursor.tzinfo_factory is not None:
+        tzinfo = cursor.tzinfo_factory(-offset // 60)
+    return _binary_time(micros, tzinfo)
+
+
+def _binary_timestamp(micros):
+    if micros == _TIMESTAMP_INFINITY:
+        return datetime.datetime.max
+    elif micros == -_TIMESTAMP_INFINITY - 1:
+        return datetime.datetime.min
+    return _PG_EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def parse_binary_timestamp(value, length, cursor):
+    """Microseconds since 2000-01-01, infinity is mapped on datetime.max/min
+    """
+    return _binary_timestamp(_int8.unpack_from(value)[0])
+
+
+def parse_binary_timestamptz(value, length, cursor):
+    """Like timestamp, but in UTC instead of the session time zone"""
+    dt = _binary_timestamp(_int8.unpack_from(value)[0])
+    if cursor.tzinfo_factory is not None \
+    and dt not in (datetime.datetime.max, datetime.datetime.min):
+        dt = dt.replace(tzinfo=cursor.tzinfo_factory(0))
+    return dt
+
+
+def parse_binary_interval(value, length, cursor):
+    """Typecast an interval to a datetime.timedelta instance.
+
+    Months are counted as 30 days and years as 365 days, as the text
+    parse_interval() does.
+
+    """
+    micros, days, months = _interval.unpack_from(value)
+    sign = months < 0 and -1 or 1
+    years, months = divmod(abs(months), 12)
+    days += sign * (years * 365 + months * 30)
+    return datetime.timedelta(days, 0, micros)
+
+
+def parse_binary_numeric(value, length, cursor):
+    """Typecast a numeric to a decimal.Decimal instance.
+
+    The value is sent as a list of base 10000 digits, the weight of the first
+    digit, the sign and the number of decimal digits to display.
+
+    """
+    ndigits, weight, sign, dscale = _numeric_header.unpack_from(value)
+    if sign == _NUMERIC_NAN:
+        return decimal.Decimal('NaN')
+    elif sign == _NUMERIC_PINF:
+        return decimal.Decimal('Infinity')
+    elif sign == _NUMERIC_NINF:
+        return decimal.Decimal('-Infinity')
+
+    coefficient = 0
+    for digit in struct.unpack_from('!%dH' % ndigits, value, 8):
+        coefficient = coefficient * 10000 + digit
+
+    # Rescale the coefficient to have exactly dscale decimal digits
+    exponent = (weight - ndigits + 1) * 4
+    if exponent >= -dscale:
+        coefficient *= 10 ** (exponent + dscale)
+    else:
+        coefficient //= 10 ** (-dscale - exponent)
+
+    digits = tuple([int(c) for c in str(coefficient)])
+    return decimal.Decimal((sign == _NUMERIC_NEG and 1 or 0, digits, -dscale))
+
+
+def parse_binary_uuid(value, length, cursor):
+    return uuid.UUID(bytes=value)
+
+
+def parse_binary_array(value, length, cursor):
+    """Typecast an array to a (nested) list.
+
+    The header contains the oid of the items, which are typecast with the
+    binary typecaster registered for it.
+
+    """
+    ndim, flags, oid = _array_header.unpack_from(value)
+    if not ndim:
+        return []
+
+    pos = _array_header.size
+    dims = []
+    for i in xrange(ndim):
+        dims.append(_array_dimension.unpack_from(value, pos)[0])
+        pos += _array_dimension.size
+
+    caster = cast_function(binary_types.get(oid, BINARY_UNKNOWN))
+    unpack_length = _int4.unpack_from
+
+    count = reduce(lambda a, b: a * b, dims)
+    items = [None] * count
+    for i in xrange(count):
+        size = unpack_length(value, pos)[0]
+        pos += 4
+        if size < 0:
+            continue
+        item = value[pos:pos + size]
+        pos += size
+        if caster is not None:
+            item = caster(item, size, cursor)
+        items[i] = item
+
+    for dim in reversed(dims[1:]):
+        items = [items[i:i + dim] for i in xrange(0, len(items), dim)]
+    return items
+
+
+def _binary_type(name, oids, caster):
+    """Shortcut to register internal binary types"""
+    type_obj = Type(name, oids, caster)
+    for oid in oids:
+        binary_types[oid] = type_obj
+    return type_obj
+
+
+# Used for the types without a binary typecaster: the raw bytes are returned
+BINARY_UNKNOWN = Type('BINARY_UNKNOWN', [], parse_string)
+
+_binary_type('STRING', [19, 18, 25, 1042, 1043, 705], parse_string)
+_binary_type('BINARY', [17], parse_binary_bytea)
+_binary_type('BOOLEAN', [16], parse_binary_boolean)
+_binary_type('SMALLINT', [21], parse_binary_int2)
+_binary_type('INTEGER', [23], parse_binary_int4)
+_binary_type('LONGINTEGER', [20], parse_binary_int8)
+_binary_type('ROWID', [26], parse_binary_oid)
+_binary_type('REAL', [700], parse_binary_float4)
+_binary_type('FLOAT', [701], parse_binary_float8)
+_binary_type('DECIMAL', [1700], parse_binary_numeric)
+_binary_type('DATE', [1082], parse_binary_date)
+_binary_type('TIME', [1083], parse_binary_time)
+_binary_type('TIMETZ', [1266], parse_binary_timetz)
+_binary_type('DATETIME', [1114], parse_binary_timestamp)
+_binary_type('DATETIMETZ', [1184], parse_binary_timestamptz)
+_binary_type('INTERVAL', [1186], parse_binary_interval)
+_binary_type('UUID', [2950], parse_binary_uuid)
+_binary_type('ARRAY', [
+    1000, 1001, 1002, 1003, 1005, 1007, 1009, 1013, 1014, 1015, 1016, 1021,
+    1022, 1028, 1115, 1182, 1183, 1185, 1187, 1231, 1270, 2951],
+    parse_binary_array)
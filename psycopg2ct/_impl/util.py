@@ -1,3 +1,6 @@
+import threading
+from ctypes import string_at
+
 from psycopg2ct._impl import exceptions
 from psycopg2ct._impl import libpq
 from psycopg2ct._impl.adapters import QuotedString
@@ -25,6 +28,11 @@ def pq_get_last_result(pgconn):
         return
 
     while True:
+        # A COPY result is returned again until the end of the data
+        if libpq.PQresultStatus(pgres) in (
+                libpq.PGRES_COPY_IN, libpq.PGRES_COPY_OUT):
+            break
+
         pgres_next = libpq.PQgetResult(pgconn)
         if not pgres_next:
             break
@@ -36,6 +44,23 @@ def pq_get_last_result(pgconn):
     return pgres
 
 
+def pq_get_results(pgconn):
+    """Return the list of all the results of the last query"""
+    results = []
+    while True:
+        pgres = libpq.PQgetResult(pgconn)
+        if not pgres:
+            break
+        results.append(pgres)
+    return results
+
+
+def pq_get_binary_value(pgres, row, col):
+    """Return a value of a binary result, which can contain NUL bytes"""
+    ptr = libpq.PQgetvalue_raw(pgres, row, col)
+    return string_at(ptr, libpq.PQgetlength(pgres, row, col))
+
+
 def quote_string(conn, value):
     obj = QuotedString(value)
     obj.prepare(conn)
@@ -137,3 +162,107 @@ def get_exception_for_sqlstate(code):
     # Fallback exception
     return exceptions.DatabaseError
 
+
+
+class LRUCache(object):
+    """A mapping holding at most `maxsize` items.
+
+    When the cache is full the least recently used items are discarded. The
+    lookups done by get() are counted in `hits` and `misses`. The cache can
+    be used by several threads at once.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # Circular doubly linked list of [prev, next, key, value] links, from
+        # the least to the most recently used
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._links = {}
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        """Store an item, return the list of the (key, value) discarded"""
+        with self._lock:
+            return self._set(key, value)
+
+    def _set(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+            self._append(link)
+            return []
+
+        if self.maxsize <= 0:
+            return [(key, value)]
+
+        discarded = []
+        while len(self._links) >= self.maxsize:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+            discarded.append((oldest[2], oldest[3]))
+
+        link = [None, None, key, value]
+        self._append(link)
+        self._links[key] = link
+        return discarded
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+
+    def clear(self):
+        with self._lock:
+            root = self._root
+            root[:] = [root, root, None, None]
+            self._links.clear()
+
+    def items(self):
+        """Return the (key, value) items, the least recently used first"""
+        items = []
+        with self._lock:
+            link = self._root[1]
+            while link is not self._root:
+                items.append((link[2], link[3]))
+                link = link[1]
+        return items
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
@@ -0,0 +1,380 @@
+"""Use the asynchronous connections from an asyncio event loop.
+
+The functions and methods of this module return futures of the event loop,
+resolved when the database operation is complete: they can be awaited, or
+used as `yield From(...)` in trollius coroutines:
+
+    conn = yield From(aio.connect(dsn))
+    cur = conn.cursor()
+    yield From(cur.execute("select * from t where id = %s", (42,)))
+    rows = yield From(cur.fetchall())
+
+The connections are driven by add_reader() and add_writer() on their
+socket, so many queries can run concurrently without threads. Any loop
+implementing the asyncio interface can be used: trollius, or asyncio,
+is only needed to get the default loop when none is passed.
+"""
+from collections import deque
+
+from psycopg2ct import extensions as _ext
+from psycopg2ct._impl.connection import _connect
+from psycopg2ct._impl.exceptions import Error, OperationalError
+
+
+def _get_event_loop():
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio.get_event_loop()
+
+
+def _create_future(loop):
+    try:
+        return loop.create_future()
+    except AttributeError:
+        # loops of the asyncio versions older than 3.5.2
+        try:
+            from asyncio import Future
+        except ImportError:
+            from trollius import Future
+        return Future(loop=loop)
+
+
+def _done(value, loop):
+    future = _create_future(loop)
+    future.set_result(value)
+    return future
+
+
+def _poll(conn, loop):
+    """Return a future resolved when conn.poll() returns POLL_OK.
+
+    If the future is cancelled the query is cancelled too, and the
+    connection is polled until ready to be used again.
+    """
+    future = _create_future(loop)
+    watched = []    # the (fd, remove function) waited for
+
+    def step():
+        while watched:
+            fd, remove = watched.pop()
+            remove(fd)
+        try:
+            state = conn.poll()
+        except Exception, e:
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        if state == _ext.POLL_OK:
+            if not future.done():
+                future.set_result(None)
+        elif state == _ext.POLL_READ:
+            fd = conn.fileno()
+            loop.add_reader(fd, step)
+            watched.append((fd, loop.remove_reader))
+        elif state == _ext.POLL_WRITE:
+            fd = conn.fileno()
+            loop.add_writer(fd, step)
+            watched.append((fd, loop.remove_writer))
+        elif not future.done():
+            future.set_exception(
+                OperationalError("bad state from poll: %s" % state))
+
+    def cancelled(future):
+        if future.cancelled() and watched:
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+
+    future.add_done_callback(cancelled)
+    step()
+    return future
+
+
+def connect(dsn=None, loop=None, connection_factory=None, **kwargs):
+    """Return a future resolved with a new AsyncConnection.
+
+    The arguments are the ones of psycopg2ct.connect(), besides the event
+    `loop` to use, by default the current one.
+    """
+    import psycopg2ct
+    if loop is None:
+        loop = _get_event_loop()
+
+    dsn = psycopg2ct._get_dsn(dsn, **kwargs)
+    try:
+        conn = _connect(dsn, connection_factory=connection_factory,
+            async=True)
+    except Exception, e:
+        future = _create_future(loop)
+        future.set_exception(e)
+        return future
+
+    aconn = AsyncConnection(conn, loop)
+    future = _create_future(loop)
+
+    def connected(f):
+        if f.exception() is not None:
+            conn.close()
+            if not future.done():
+                future.set_exception(f.exception())
+        elif future.done():
+            # cancelled while connecting
+            conn.close()
+        else:
+            future.set_result(aconn)
+
+    _poll(conn, loop).add_done_callback(connected)
+    return future
+
+
+class AsyncConnection(object):
+    """An asynchronous connection used from an event loop.
+
+    The connection is in autocommit mode: transactions can be managed
+    executing BEGIN and COMMIT statements. Only one query at time can run
+    on a connection.
+    """
+
+    def __init__(self, conn, loop):
+        self._conn = conn
+        self._loop = loop
+
+    @property
+    def connection(self):
+        """The underlying asynchronous connection."""
+        return self._conn
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def closed(self):
+        return self._conn.closed
+
+    def cursor(self, cursor_factory=None):
+        """Return a new AsyncCursor."""
+        if cursor_factory is None:
+            cur = self._conn.cursor()
+        else:
+            cur = self._conn.cursor(cursor_factory=cursor_factory)
+        return AsyncCursor(self, cur)
+
+    def pipeline(self):
+        """Return an AsyncPipeline to run several queries in a single
+        round trip."""
+        return AsyncPipeline(self)
+
+    def isexecuting(self):
+        return self._conn.isexecuting()
+
+    def close(self):
+        self._conn.close()
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+
+class AsyncCursor(object):
+    """A cursor of an AsyncConnection.
+
+    execute() and callproc() return futures resolved when the query is
+    complete; the fetch methods return futures already resolved, as the
+    results are already in memory.
+    """
+
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+
+    @property
+    def connection(self):
+        return self._conn
+
+    def execute(self, query, vars=None):
+        try:
+            self._cursor.execute(query, vars)
+        except Exception, e:
+            future = _create_future(self._conn.loop)
+            future.set_exception(e)
+            return future
+        return _poll(self._conn.connection, self._conn.loop)
+
+    def callproc(self, procname, parameters=None):
+        try:
+            self._cursor.callproc(procname, parameters)
+        except Exception, e:
+            future = _create_future(self._conn.loop)
+            future.set_exception(e)
+            return future
+        return _poll(self._conn.connection, self._conn.loop)
+
+    def fetchone(self):
+        return _done(self._cursor.fetchone(), self._conn.loop)
+
+    def fetchmany(self, size=None):
+        return _done(self._cursor.fetchmany(size), self._conn.loop)
+
+    def fetchall(self):
+        return _done(self._cursor.fetchall(), self._conn.loop)
+
+    def close(self):
+        self._cursor.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class AsyncPipeline(object):
+    """A Pipeline of an AsyncConnection.
+
+    sync() returns a future resolved when the results of all the queued
+    queries are available in their cursors.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._pipeline = conn.connection.pipeline()
+
+    def __len__(self):
+        return len(self._pipeline)
+
+    def execute(self, cursor, query, vars=None):
+        """Queue a query to run on an AsyncCursor and return the cursor."""
+        self._pipeline.execute(cursor._cursor, query, vars)
+        return cursor
+
+    def sync(self):
+        try:
+            self._pipeline.sync()
+        except Exception, e:
+            future = _create_future(self._conn.loop)
+            future.set_exception(e)
+            return future
+        return _poll(self._conn.connection, self._conn.loop)
+
+
+class PoolError(Error):
+    pass
+
+
+class AsyncConnectionPool(object):
+    """A pool of AsyncConnection for the tasks of an event loop.
+
+    getconn() returns a future resolved with a connection: if 'maxconn'
+    connections are in use the future is resolved when one is put back,
+    the waiting tasks being served in arrival order. As in the other pools
+    up to 'minconn' connections are kept open when put back. The other
+    arguments are passed to connect().
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.closed = False
+        self._loop = kwargs.pop('loop', None) or _get_event_loop()
+        self._args = args
+        self._kwargs = kwargs
+
+        self._pool = []
+        self._used = set()  # id() of the connections given out
+        self._connecting = 0
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        """The number of tasks waiting for a connection."""
+        return len([w for w in self._waiters if not w.done()])
+
+    def getconn(self):
+        """Return a future resolved with a free connection."""
+        if self.closed: raise PoolError("connection pool is closed")
+        future = _create_future(self._loop)
+        self._waiters.append(future)
+        self._serve_waiters()
+        return future
+
+    def putconn(self, conn, close=False):
+        """Put away a connection.
+
+        The connections put back after closeall() are closed.
+        """
+        if self.closed:
+            if not conn.closed:
+                conn.close()
+            return
+        if id(conn) not in self._used:
+            raise PoolError("trying to put unkeyed connection")
+        self._used.discard(id(conn))
+
+        if not close and self._reusable(conn) and (self._waiters
+                or len(self._pool) < self.minconn):
+            self._pool.append(conn)
+        elif not conn.closed:
+            conn.close()
+        self._serve_waiters()
+
+    def _reusable(self, conn):
+        return not conn.closed and not conn.isexecuting() and \
+            conn.get_transaction_status() == _ext.TRANSACTION_STATUS_IDLE
+
+    def _serve_waiters(self):
+        """Give the free connections to the waiting tasks, and start new
+        connections if the pool can grow."""
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():   # cancelled
+                self._waiters.popleft()
+                continue
+            if self._pool:
+                self._waiters.popleft()
+                conn = self._pool.pop()
+                self._used.add(id(conn))
+                waiter.set_result(conn)
+                continue
+
+            # Don't start more connections than tasks waiting
+            pending = len([w for w in self._waiters if not w.done()])
+            if self._connecting >= pending or len(self._used) + \
+                    self._connecting + len(self._pool) >= self.maxconn:
+                break
+            self._connecting += 1
+            connect(*self._args, loop=self._loop, **self._kwargs) \
+                .add_done_callback(self._connected)
+
+    def _connected(self, future):
+        self._connecting -= 1
+        if future.cancelled():
+            pass
+        elif future.exception() is not None:
+            # Report the error to a waiting task
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(future.exception())
+                    break
+        elif self.closed:
+            future.result().close()
+        else:
+            self._pool.append(future.result())
+        if not self.closed:
+            self._serve_waiters()
+
+    def closeall(self):
+        """Close all the idle connections and fail the waiting tasks."""
+        if self.closed: raise PoolError("connection pool is closed")
+        self.closed = True
+        for conn in self._pool:
+            conn.close()
+        self._pool = []
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(PoolError("connection pool is closed"))
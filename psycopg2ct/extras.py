@@ -27,9 +27,15 @@ and classes untill a better place in the distribution is found.
 
 import os
 import sys
+import errno
+import fcntl
 import time
 import warnings
 import re as regex
+import threading as _threading
+import uuid as _uuid
+from itertools import islice as _islice
+from Queue import Queue as _Queue, Empty as _Empty, Full as _Full
 
 try:
     import logging
@@ -962,4 +968,500 @@ def register_composite(name, conn_or_curs, globally=False):
     return caster
 
 
+def execute_values(cur, sql, argslist, template=None, page_size=1000,
+                   fetch=False):
+    """Execute a statement using a VALUES list with many parameters sets.
+
+    `sql` must contain a single '%s' placeholder, which is replaced by a
+    VALUES list of `page_size` rows at most: the query is executed once per
+    page instead of once per row like in executemany().
+
+    Every row is merged in the query using `template`, e.g. '(%s, 42)' or
+    '(%(id)s, %(name)s)'; if it is None the values of each sequence are
+    adapted and wrapped in parens. If `fetch` is true the rows returned by
+    the queries, e.g. by a RETURNING clause, are collected and returned.
+    """
+    conn = cur.connection
+    if isinstance(sql, unicode):
+        sql = sql.encode(_ext.encodings[conn.encoding])
+    if isinstance(template, unicode):
+        template = template.encode(_ext.encodings[conn.encoding])
+
+    pre, post = _split_sql(sql)
+
+    result = [] if fetch else None
+    argslist = iter(argslist)
+    while True:
+        page = list(_islice(argslist, page_size))
+        if not page:
+            break
+
+        if template is None:
+            rows = ['(%s)' % ','.join([_quote(value, conn)
+                for value in args]) for args in page]
+        else:
+            rows = [cur.mogrify(template, args) for args in page]
+
+        cur.execute(''.join([pre, ','.join(rows), post]))
+        if fetch:
+            result.extend(cur.fetchall())
+
+    return result
+
+
+def _split_sql(sql):
+    """Split `sql` at its single '%s' placeholder, unescaping '%%'."""
+    pre = current = []
+    post = []
+    for token in regex.split(r'(%.)', sql):
+        if len(token) != 2 or token[0] != '%':
+            current.append(token)
+        elif token[1] == 's' and current is pre:
+            current = post
+        elif token[1] == '%':
+            current.append('%')
+        else:
+            raise ValueError(
+                "the query must contain a single '%s' placeholder")
+    if current is pre:
+        raise ValueError("the query must contain a single '%s' placeholder")
+    return ''.join(pre), ''.join(post)
+
+
+def _quote(value, conn):
+    """Return the SQL literal of `value`, adapted for `conn`."""
+    if value is None:
+        return 'NULL'
+    adapter = _A(value)
+    if hasattr(adapter, 'prepare'):
+        adapter.prepare(conn)
+    return adapter.getquoted()
+
+
+class ParallelCopyError(psycopg2.DatabaseError):
+    """Raised by parallel_copy_from() when some of the workers failed.
+
+    `errors` is a list of (worker, exception) pairs, where worker is None
+    for an error reading the source.
+    """
+
+    def __init__(self, errors):
+        psycopg2.DatabaseError.__init__(self, '; '.join([
+            '%s: %s' % (worker is None and 'source' or 'worker %d' % worker,
+                error) for worker, error in errors]))
+        self.errors = errors
+
+
+class _CopyAborted(Exception):
+    """Stop the COPY of a worker after the failure of another one."""
+
+
+class _QueueReader(object):
+    """A file-like object reading the chunks put in a queue until None."""
+
+    def __init__(self, queue, failed):
+        self._queue = queue
+        self._failed = failed
+
+    def read(self, size=-1):
+        while True:
+            if self._failed.isSet():
+                raise _CopyAborted()
+            try:
+                chunk = self._queue.get(timeout=0.1)
+            except _Empty:
+                continue
+            return chunk or ''
+
+
+def parallel_copy_from(dsn, table, source, workers=4, columns=None,
+                       sep='\t', null='\\N', size=65536, two_phase=False):
+    """Load the content of a file into a table with a COPY on every one of
+    `workers` connections to `dsn`, running in parallel threads.
+
+    `source` is read in chunks of about `size` bytes, split at the end of
+    the lines: every chunk is sent by the first worker ready, so the order
+    of the rows is not kept. Return the number of rows sent.
+
+    If a worker fails the others stop and ParallelCopyError is raised with
+    all the errors. The workers commit independently unless `two_phase` is
+    true: then every worker prepares its transaction (see tpc_prepare())
+    and they are all committed only if all of them succeeded.
+    """
+    conns = []
+    try:
+        for i in xrange(workers):
+            conns.append(psycopg2.connect(dsn))
+        return _parallel_copy(conns, table, source, columns, sep, null, size,
+            two_phase)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def _parallel_copy(conns, table, source, columns, sep, null, size,
+                   two_phase):
+    encoding = _ext.encodings[conns[0].encoding]
+    queue = _Queue(len(conns) * 2)
+    failed = _threading.Event()
+    errors = []
+    gtrid = 'parallel_copy_from-%s' % _uuid.uuid4().hex
+
+    def work(i, conn):
+        try:
+            if two_phase:
+                conn.tpc_begin(conn.xid(0, gtrid, str(i)))
+            conn.cursor().copy_from(_QueueReader(queue, failed), table,
+                sep, null, size, columns)
+            if two_phase:
+                conn.tpc_prepare()
+            else:
+                conn.commit()
+        except _CopyAborted:
+            conn.rollback()
+        except Exception, e:
+            errors.append((i, e))
+            failed.set()
+            conn.rollback()
+
+    threads = [_threading.Thread(target=work, args=(i, conn))
+        for i, conn in enumerate(conns)]
+    for thread in threads:
+        thread.start()
+
+    def put(chunk):
+        while not failed.isSet():
+            try:
+                queue.put(chunk, timeout=0.1)
+                return
+            except _Full:
+                pass
+
+    rows = 0
+    try:
+        tail = ''
+        while not failed.isSet():
+            data = source.read(size)
+            if isinstance(data, unicode):
+                data = data.encode(encoding)
+            if not data:
+                if tail:
+                    # The last line has no newline
+                    rows += 1
+                    put(tail)
+                break
+
+            # Send the complete lines only
+            end = data.rfind('\n') + 1
+            if not end:
+                tail += data
+                continue
+            chunk = tail + data[:end]
+            tail = data[end:]
+            rows += chunk.count('\n')
+            put(chunk)
+
+        for thread in threads:
+            put(None)
+    except Exception, e:
+        errors.append((None, e))
+        failed.set()
+
+    for thread in threads:
+        thread.join()
+
+    if two_phase:
+        # The failed workers have rolled back, the others are prepared
+        for i, conn in enumerate(conns):
+            if conn.status != _ext.STATUS_PREPARED:
+                continue
+            try:
+                if errors:
+                    conn.tpc_rollback()
+                else:
+                    conn.tpc_commit()
+            except Exception, e:
+                errors.append((i, e))
+
+    if errors:
+        raise ParallelCopyError(errors)
+    return rows
+
+
+class _Selector(object):
+    """Wait for readable file descriptors, using epoll where available."""
+
+    def __init__(self):
+        self._fds = set()
+        self._epoll = hasattr(select, 'epoll') and select.epoll() or None
+
+    def register(self, fd):
+        self._fds.add(fd)
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+        if self._epoll is not None:
+            try:
+                self._epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                # closed fds are removed from the epoll set by the kernel
+                pass
+
+    def select(self, timeout=None):
+        try:
+            if self._epoll is not None:
+                return [fd for fd, event in self._epoll.poll(
+                    timeout is None and -1 or timeout)]
+            return select.select(list(self._fds), [], [], timeout)[0]
+        except (IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+
+
+class NotificationHub(object):
+    """Receive the notifications of many connections in a single thread.
+
+    The connections added are only read when their socket is readable, all
+    the sockets being watched by a single epoll (or select()) call. The
+    notifications received are dispatched by channel: every subscriber of
+    a channel receives, at every iteration, the list of the Notify received
+    on that channel, in order. A subscriber is either a callable, called in
+    the hub thread, or a Queue, where the lists are put.
+
+    When a queue is full `overflow` decides what to do: with 'block' the
+    hub stops reading the connections until the queue has room again, so
+    that the notifications wait in the server; with 'drop' the list is
+    discarded and counted in `dropped`.
+
+    `on_error(source, exception)` is called when a connection fails, the
+    connection being removed from the hub, or when a subscriber callable
+    raises: `source` is the connection or the callable. Without it, the
+    connection errors are raised by run_once() and the subscriber errors
+    are logged.
+
+    The connections are put in autocommit mode and should be used only by
+    the hub while added.
+    """
+
+    def __init__(self, overflow='block', on_error=None):
+        if overflow not in ('block', 'drop'):
+            raise ValueError("overflow must be 'block' or 'drop'")
+        self.overflow = overflow
+        self.on_error = on_error
+        self.dropped = 0
+
+        self._lock = _threading.Lock()
+        self._conns = {}        # fd -> connection
+        self._received = set()  # fd of the connections to check unpolled
+        self._subscribers = {}  # channel -> list of subscribers
+        self._backlog = []      # (queue, notifies) not delivered yet
+        self._stopped = False
+
+        self._selector = _Selector()
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._selector.register(self._wakeup[0])
+
+    def add(self, conn, channels=()):
+        """Start receiving the notifications of `conn`, after executing a
+        LISTEN on `channels`."""
+        conn.autocommit = True
+        cur = conn.cursor()
+        for channel in channels:
+            cur.execute('LISTEN "%s"' % channel.replace('"', '""'))
+        cur.close()
+
+        fd = conn.fileno()
+        with self._lock:
+            self._conns[fd] = conn
+            # notifications may have been received by the LISTEN already
+            self._received.add(fd)
+            self._selector.register(fd)
+        self._wake()
+
+    def remove(self, conn):
+        """Stop receiving the notifications of `conn`."""
+        with self._lock:
+            for fd, other in self._conns.items():
+                if other is conn:
+                    del self._conns[fd]
+                    self._received.discard(fd)
+                    self._selector.unregister(fd)
+                    break
+
+    @property
+    def connections(self):
+        return self._conns.values()
+
+    def subscribe(self, channel, subscriber=None, maxsize=0):
+        """Dispatch the notifications on `channel` to `subscriber`.
+
+        If no subscriber is passed a new Queue of `maxsize` items is
+        created. Return the subscriber.
+        """
+        if subscriber is None:
+            subscriber = _Queue(maxsize)
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(channel, None)
+            self._backlog = [(queue, notifies)
+                for queue, notifies in self._backlog
+                if queue is not subscriber]
+
+    def run_once(self, timeout=None):
+        """Wait up to `timeout` seconds for notifications and dispatch them.
+
+        Return the number of notifications received. While a queue is full
+        in 'block' mode the connections are not read: only the delivery of
+        the pending notifications is attempted.
+        """
+        if self._backlog:
+            self._deliver(timeout)
+            return 0
+
+        ready = self._selector.select(timeout)
+        with self._lock:
+            if self._wakeup[0] in ready:
+                self._drain_wakeup()
+            check = self._received.union(ready)
+            self._received.clear()
+            conns = [(fd, self._conns[fd]) for fd in check
+                if fd in self._conns]
+
+        batches = {}
+        channels = []
+        for fd, conn in conns:
+            if fd in ready:
+                try:
+                    conn.poll()
+                except Exception, e:
+                    self.remove(conn)
+                    if self.on_error is None:
+                        raise
+                    self.on_error(conn, e)
+                    continue
+
+            notifies = conn.notifies
+            for notify in notifies:
+                if notify.channel not in batches:
+                    batches[notify.channel] = []
+                    channels.append(notify.channel)
+                batches[notify.channel].append(notify)
+            count = len(notifies)
+            del notifies[:count]
+
+        received = 0
+        for channel in channels:
+            received += len(batches[channel])
+            self._dispatch(channel, batches[channel])
+        return received
+
+    def run(self):
+        """Dispatch the notifications until stop() is called."""
+        try:
+            while not self._stopped:
+                self.run_once()
+        finally:
+            self._stopped = False
+
+    def stop(self):
+        """Make run() return, also if called from another thread."""
+        self._stopped = True
+        self._wake()
+
+    def close(self):
+        """Release the resources of the hub. The connections are not
+        closed."""
+        with self._lock:
+            self._conns.clear()
+            self._selector.close()
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup[1], 'x')
+        except OSError, e:
+            # pipe full: the hub will wake up anyway
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _dispatch(self, channel, notifies):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            if callable(subscriber):
+                # The notifications are already consumed: a failing
+                # subscriber must not lose the ones of the others
+                try:
+                    subscriber(notifies)
+                except Exception, e:
+                    if self.on_error is not None:
+                        self.on_error(subscriber, e)
+                    elif logging:
+                        logging.getLogger('psycopg2').exception(
+                            "notification subscriber failed")
+                continue
+            try:
+                subscriber.put_nowait(notifies)
+            except _Full:
+                with self._lock:
+                    if subscriber not in self._subscribers.get(channel, ()):
+                        pass    # unsubscribed in the meantime
+                    elif self.overflow == 'drop':
+                        self.dropped += len(notifies)
+                    else:
+                        self._backlog.append((subscriber, notifies))
+
+    def _deliver(self, timeout):
+        """Put the notifications in the backlog in their queues, waiting up
+        to `timeout` seconds for them to have room."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._stopped:
+            with self._lock:
+                if not self._backlog:
+                    break
+                entry = self._backlog[0]
+            queue, notifies = entry
+            if timeout is None:
+                wait = 0.1
+            else:
+                wait = max(0, min(0.1, deadline - time.time()))
+            try:
+                queue.put(notifies, timeout=wait)
+            except _Full:
+                if timeout is not None and time.time() >= deadline:
+                    break
+                continue
+            with self._lock:
+                if self._backlog and self._backlog[0] is entry:
+                    del self._backlog[0]
+
+
 __all__ = filter(lambda k: not k.startswith('_'), locals().keys())
@@ -24,6 +24,14 @@ This module implements thread-safe (and not) connection pools.
 # FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
 # License for more details.
 
+import os
+import re
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import deque
+
 import psycopg2
 import psycopg2.extensions as _ext
 
@@ -56,6 +64,61 @@ class PoolError(psycopg2.Error):
     pass
 
 
+# Serialize the pools cleanup in a forked child: only taken when a fork
+# is detected, as the pools locks may have been held by the parent
+_fork_lock = threading.Lock()
+
+
+def _check_fork(pool):
+    """Call pool._forked() once in a process forked since the last call.
+
+    Return True if the process was forked.
+    """
+    if pool._pid == os.getpid():
+        return False
+    _fork_lock.acquire()
+    try:
+        if pool._pid == os.getpid():
+            return False
+        pool._forked()
+        # Set last, so that the other threads wait for the cleanup
+        pool._pid = os.getpid()
+        return True
+    finally:
+        _fork_lock.release()
+
+
+class _Histogram(object):
+    """Count the durations in seconds falling in a set of buckets."""
+
+    bounds = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect_left(self.bounds, value)] += 1
+
+    def snapshot(self):
+        """Return the histogram as a dict.
+
+        'buckets' is a list of (upper bound, count) pairs, the last bound
+        being None for the durations longer than all the others.
+        """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': zip(self.bounds + (None,), self.buckets)}
+
+
 class AbstractConnectionPool(object):
     """Generic key-based pooling code."""
 
@@ -65,10 +128,27 @@ class AbstractConnectionPool(object):
         New 'minconn' connections are created immediately calling 'connfunc'
         with given parameters. The connection pool will support a maximum of
         about 'maxconn' connections.        
+
+        The 'minconn' connections are established concurrently. If the
+        keyword argument 'grow_by' is set, when the pool has to create a
+        connection it creates up to 'grow_by' of them at the same time,
+        keeping the ones not requested for the next callers.
+
+        The keyword arguments 'max_lifetime' and 'max_idle' are not passed
+        to 'connfunc': if set, the connections older than 'max_lifetime'
+        seconds, or unused for more than 'max_idle' seconds, are closed
+        instead of being handed out again. 'health_check_interval' is used
+        by the pools which check their idle connections in the background.
         """
         self.minconn = minconn
         self.maxconn = maxconn
         self.closed = False
+        self._pid = os.getpid()
+
+        self.max_lifetime = kwargs.pop('max_lifetime', None)
+        self.max_idle = kwargs.pop('max_idle', None)
+        self.health_check_interval = kwargs.pop('health_check_interval', None)
+        self.grow_by = kwargs.pop('grow_by', 1)
         
         self._args = args
         self._kwargs = kwargs
@@ -77,20 +157,217 @@ class AbstractConnectionPool(object):
         self._used = {}
         self._rused = {} # id(conn) -> key map
         self._keys = 0
+        self._created = {} # id(conn) -> connection time
+        self._idle = {} # id(conn) -> time put in the pool or last checked
+        self._inherited = weakref.WeakSet() # in use when the process forked
 
-        for i in range(self.minconn):
-            self._connect()
+        self._observers = []
+        self._init_stats()
 
-    def _connect(self, key=None):
-        """Create a new connection and assign it to 'key' if not None."""
-        conn = psycopg2.connect(*self._args, **self._kwargs)
-        if key is not None:
-            self._used[key] = conn
-            self._rused[id(conn)] = key
-        else:
-            self._pool.append(conn)
+        if self.minconn > 0:
+            for conn in self._new_connections(self.minconn):
+                self._add_idle(conn)
+
+    def _init_stats(self):
+        self._checkouts = {} # id(conn) -> (checkout time, key for the stats)
+        self._checkout_time = _Histogram()
+        self._hold_time = {} # key -> _Histogram, None for unkeyed getconn()
+        self._hold_time_other = _Histogram() # keys past _max_stats_keys
+        self._connections_created = 0
+        self._connections_closed = {} # reason -> count
+        self._exhaustions = 0
+
+    def _check_fork(self):
+        """Drop the connections inherited from the parent after a fork.
+
+        The connections are closed without terminating the parent's
+        sessions; new ones are created when requested. Return True if the
+        process was forked.
+        """
+        return _check_fork(self)
+
+    def _forked(self):
+        self._inherited = weakref.WeakSet(self._used.itervalues())
+        for conn in self._pool + list(self._used.values()):
+            if not conn.closed:
+                conn.close()
+        self._pool = []
+        self._used = {}
+        self._rused = {}
+        self._created.clear()
+        self._idle.clear()
+        self._init_stats()
+
+    def _warm_up(self):
+        """Create the connections missing to have 'minconn' of them."""
+        self._check_fork()
+        missing = self.minconn - len(self._pool) - len(self._used)
+        if missing > 0:
+            for conn in self._new_connections(missing):
+                self._add_idle(conn)
+
+    # keep the hold times of the connections by key, for up to
+    # _max_stats_keys distinct keys
+    _stats_by_key = True
+    _max_stats_keys = 100
+
+    def add_observer(self, observer):
+        """Call 'observer(pool, event, info)' on the pool events.
+
+        'info' is a dict whose content depends on the event:
+
+        - 'connect': a new connection 'conn' was created;
+        - 'close': the connection 'conn' was closed for 'reason' (one of
+          'lifetime', 'idle', 'broken', 'surplus', 'putconn', 'closeall');
+        - 'checkout': the connection 'conn' was given to 'key' after 'wait'
+          seconds;
+        - 'checkin': the connection 'conn' was put back by 'key' after being
+          used for 'hold' seconds;
+        - 'exhausted': 'key' asked for a connection when 'maxconn' were in
+          use.
+
+        'key' is None if the connection was requested without a key. The
+        observers are called with the pool lock held: they should be quick
+        and they must not use the pool.
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Stop calling an observer added by add_observer()."""
+        self._observers.remove(observer)
+
+    def _notify(self, event, **info):
+        for observer in self._observers:
+            try:
+                observer(self, event, info)
+            except Exception, e:
+                dbg("pool observer failed:", e)
+
+    def _stats(self):
+        """Return a snapshot of the pool metrics as a dict.
+
+        The durations are in seconds: 'checkout_time' is the histogram of
+        the time spent to obtain a connection, including connecting and
+        waiting; 'hold_time' maps the keys to the histograms of the time
+        the connections were kept, with the connections requested without
+        a key under None. Only the first 100 keys seen get a histogram: the
+        times of the other keys are counted together in 'hold_time_other'.
+        """
+        self._check_fork()
+        return {
+            'minconn': self.minconn,
+            'maxconn': self.maxconn,
+            'idle': len(self._pool),
+            'used': len(self._used),
+            'connections_created': self._connections_created,
+            'connections_closed': dict(self._connections_closed),
+            'exhausted': self._exhaustions,
+            'checkout_time': self._checkout_time.snapshot(),
+            'hold_time': dict((k, h.snapshot())
+                for k, h in self._hold_time.iteritems()),
+            'hold_time_other': self._hold_time_other.snapshot()}
+
+    def _connect(self, key, start):
+        """Create a new connection and assign it to 'key'.
+
+        Up to 'grow_by' connections are created: the others are put in the
+        pool.
+        """
+        count = max(1, min(self.grow_by,
+            self.maxconn - len(self._used) - len(self._pool)))
+        conns = self._new_connections(count)
+        conn = conns.pop(0)
+        self._assign(conn, key, start)
+        for other in conns:
+            self._add_idle(other)
         return conn
 
+    def _new_connections(self, count):
+        """Create 'count' new connections concurrently, not assigned to the
+        pool yet."""
+        if count == 1:
+            conns = [psycopg2.connect(*self._args, **self._kwargs)]
+        else:
+            conns = psycopg2._connect_many(count, *self._args, **self._kwargs)
+        now = time.time()
+        self._connections_created += len(conns)
+        for conn in conns:
+            self._created[id(conn)] = now
+            self._notify('connect', conn=conn)
+        return conns
+
+    def _assign(self, conn, key, start):
+        """Give a connection to 'key', a new one if None, requested at
+        'start'."""
+        if key is None:
+            stat_key = None
+            key = self._getkey()
+        elif self._stats_by_key:
+            stat_key = key
+        else:
+            stat_key = None
+
+        self._used[key] = conn
+        self._rused[id(conn)] = key
+
+        now = time.time()
+        self._checkouts[id(conn)] = (now, stat_key)
+        self._checkout_time.add(now - start)
+        self._notify('checkout', conn=conn, key=stat_key, wait=now - start)
+
+    def _release(self, conn, key):
+        """Take back a connection from 'key'."""
+        del self._used[key]
+        del self._rused[id(conn)]
+
+        checkout = self._checkouts.pop(id(conn), None)
+        if checkout is not None:
+            start, stat_key = checkout
+            hold = time.time() - start
+            histogram = self._hold_time.get(stat_key)
+            if histogram is None:
+                if len(self._hold_time) < self._max_stats_keys:
+                    histogram = self._hold_time[stat_key] = _Histogram()
+                else:
+                    histogram = self._hold_time_other
+            histogram.add(hold)
+            self._notify('checkin', conn=conn, key=stat_key, hold=hold)
+
+    def _exhausted(self, key):
+        """Record a request made when all the connections are in use."""
+        self._exhaustions += 1
+        if key is not None and not self._stats_by_key:
+            key = None
+        self._notify('exhausted', key=key)
+
+    def _add_idle(self, conn):
+        """Put a connection in the pool of the idle ones."""
+        self._pool.append(conn)
+        self._idle[id(conn)] = time.time()
+
+    def _expired(self, conn, now=None):
+        """Return 'lifetime' if the connection is too old, 'idle' if it was
+        unused for too long, else None."""
+        if now is None: now = time.time()
+        if self.max_lifetime is not None and \
+                now - self._created.get(id(conn), now) >= self.max_lifetime:
+            return 'lifetime'
+        if self.max_idle is not None and \
+                now - self._idle.get(id(conn), now) >= self.max_idle:
+            return 'idle'
+        return None
+
+    def _discard(self, conn, reason):
+        """Close a connection and forget about it."""
+        self._created.pop(id(conn), None)
+        self._idle.pop(id(conn), None)
+        self._checkouts.pop(id(conn), None)
+        self._connections_closed[reason] = \
+            self._connections_closed.get(reason, 0) + 1
+        self._notify('close', conn=conn, reason=reason)
+        if not conn.closed:
+            conn.close()
+
     def _getkey(self):
         """Return a new unique key."""
         self._keys += 1
@@ -99,52 +376,88 @@ class AbstractConnectionPool(object):
     def _getconn(self, key=None):
         """Get a free connection and assign it to 'key' if not None."""
         if self.closed: raise PoolError("connection pool is closed")
-        if key is None: key = self._getkey()
+        self._check_fork()
 	
-        if key in self._used:
+        if key is not None and key in self._used:
             return self._used[key]
 
-        if self._pool:
-            self._used[key] = conn = self._pool.pop()
-            self._rused[id(conn)] = key
+        return self._take(key, time.time())
+
+    def _take(self, key, start):
+        """Assign a free or a new connection to 'key', requested at 'start'.
+        """
+        while self._pool:
+            conn = self._pool.pop()
+            reason = self._expired(conn)
+            if reason:
+                self._discard(conn, reason)
+                continue
+            del self._idle[id(conn)]
+            self._assign(conn, key, start)
             return conn
-        else:
-            if len(self._used) == self.maxconn:
-                raise PoolError("connection pool exausted")
-            return self._connect(key)
+
+        if len(self._used) == self.maxconn:
+            self._exhausted(key)
+            raise PoolError("connection pool exausted")
+        return self._connect(key, start)
 		 
     def _putconn(self, conn, key=None, close=False):
         """Put away a connection."""
         if self.closed: raise PoolError("connection pool is closed")
+        if self._putforked(conn): return
         if key is None: key = self._rused.get(id(conn))
 
         if not key:
             raise PoolError("trying to put unkeyed connection")
 
-        if len(self._pool) < self.minconn and not close:
-            # Return the connection into a consistent state before putting
-            # it back into the pool
-            if not conn.closed:
-                status = conn.get_transaction_status()
-                if status == _ext.TRANSACTION_STATUS_UNKNOWN:
-                    # server connection lost
-                    conn.close()
-                elif status != _ext.TRANSACTION_STATUS_IDLE:
-                    # connection in error or in transaction
-                    conn.rollback()
-                    self._pool.append(conn)
-                else:
-                    # regular idle connection
-                    self._pool.append(conn)
-            # If the connection is closed, we just discard it.
-        else:
-            conn.close()
-
         # here we check for the presence of key because it can happen that a
         # thread tries to put back a connection after a call to close
         if not self.closed or key in self._used:
-            del self._used[key]
-            del self._rused[id(conn)]
+            self._release(conn, key)
+
+        reason = self._expired(conn)
+        if close:
+            self._discard(conn, 'putconn')
+        elif reason:
+            self._discard(conn, reason)
+        elif len(self._pool) >= self.minconn:
+            self._discard(conn, 'surplus')
+        elif self._reset(conn):
+            self._add_idle(conn)
+        else:
+            # If the connection is closed, we just discard it.
+            self._discard(conn, 'broken')
+
+    def _putforked(self, conn):
+        """Close a connection taken before the process forked.
+
+        Return True if the connection was such.
+        """
+        self._check_fork()
+        if conn not in self._inherited:
+            return False
+        self._inherited.discard(conn)
+        if not conn.closed:
+            conn.close()
+        return True
+
+    def _reset(self, conn):
+        """Return the connection into a consistent state before using it
+        again.
+
+        Return False if the connection can't be used anymore.
+        """
+        if conn.closed:
+            return False
+
+        status = conn.get_transaction_status()
+        if status == _ext.TRANSACTION_STATUS_UNKNOWN:
+            # server connection lost
+            return False
+        elif status != _ext.TRANSACTION_STATUS_IDLE:
+            # connection in error or in transaction
+            conn.rollback()
+        return True
 
     def _closeall(self):
         """Close all connections.
@@ -154,11 +467,14 @@ class AbstractConnectionPool(object):
         your code can deal with it.
         """
         if self.closed: raise PoolError("connection pool is closed")
+        self._check_fork()
         for conn in self._pool + list(self._used.values()):
             try:
-                conn.close()
+                self._discard(conn, 'closeall')
             except:
                 pass
+        self._created.clear()
+        self._idle.clear()
         self.closed = True
         
 
@@ -168,42 +484,300 @@ class SimpleConnectionPool(AbstractConnectionPool):
     getconn = AbstractConnectionPool._getconn
     putconn = AbstractConnectionPool._putconn
     closeall   = AbstractConnectionPool._closeall
+    stats = AbstractConnectionPool._stats
+
+
+class _Waiter(object):
+    """A thread waiting for a connection in ThreadedConnectionPool.getconn()"""
+
+    def __init__(self, key, lock, start):
+        self.key = key
+        self.start = start
+        self.cond = threading.Condition(lock)
+        self.conn = None
+        self.error = None
+
+
+def _reaper(pool_ref, stop, interval):
+    """Run the maintenance of a pool every 'interval' seconds until 'stop'
+    is set or the pool is gone."""
+    while True:
+        stop.wait(interval)
+        pool = pool_ref()
+        if pool is None or stop.isSet():
+            return
+        try:
+            pool._maintain()
+        except Exception, e:
+            dbg("pool maintenance failed:", e)
+        del pool
 
 
 class ThreadedConnectionPool(AbstractConnectionPool):
-    """A connection pool that works with the threading module."""
+    """A connection pool that works with the threading module.
+
+    If 'max_lifetime', 'max_idle' or 'health_check_interval' are set, a
+    background thread closes the expired connections, checks the idle
+    ones every 'health_check_interval' seconds and opens new connections
+    to keep at least 'minconn' of them.
+    """
 
     def __init__(self, minconn, maxconn, *args, **kwargs):
         """Initialize the threading lock."""
-        import threading
         AbstractConnectionPool.__init__(
             self, minconn, maxconn, *args, **kwargs)
         self._lock = threading.Lock()
+        self._waiters = deque()
 
-    def getconn(self, key=None):
-        """Get a free connection and assign it to 'key' if not None."""
+        # number of getconn() calls which had to wait, total time waited
+        # and number of waits which timed out
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+        self._stop = threading.Event()
+        self._start_reaper()
+
+    def _start_reaper(self):
+        """Start the maintenance thread if any option requires it."""
+        intervals = [t for t in (self.max_lifetime, self.max_idle,
+            self.health_check_interval) if t is not None]
+        if intervals:
+            reaper = threading.Thread(target=_reaper,
+                args=(weakref.ref(self), self._stop,
+                    min(60.0, min(intervals) / 2.0)))
+            reaper.setDaemon(True)
+            reaper.start()
+
+    def _forked(self):
+        AbstractConnectionPool._forked(self)
+
+        # The lock may have been held by a thread of the parent, and no
+        # thread waiting or running the maintenance survived the fork
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self._stop = threading.Event()
+        self._start_reaper()
+
+    def _warm_up(self):
+        self._check_fork()
+        self._maintain()
+
+    @property
+    def waiting(self):
+        """The number of threads waiting for a connection."""
+        return len(self._waiters)
+
+    def getconn(self, key=None, timeout=0):
+        """Get a free connection and assign it to 'key' if not None.
+
+        If all the 'maxconn' connections are in use wait for one to be put
+        back for at most 'timeout' seconds, or forever if it is None. The
+        waiting threads get the connections in arrival order. PoolError is
+        raised if no connection is available in time.
+        """
+        start = time.time()
+        self._check_fork()
         self._lock.acquire()
         try:
-            return self._getconn(key)
+            if self.closed: raise PoolError("connection pool is closed")
+            if key is not None and key in self._used:
+                return self._used[key]
+
+            # Don't overtake the threads already waiting
+            if not self._waiters and (
+                    self._pool or len(self._used) < self.maxconn):
+                return self._take(key, start)
+
+            if not self._pool and len(self._used) >= self.maxconn:
+                self._exhausted(key)
+            if timeout is not None and timeout <= 0:
+                raise PoolError("connection pool exausted")
+            return self._wait(key, timeout, start)
         finally:
             self._lock.release()
 
+    def _wait(self, key, timeout, start):
+        """Wait for a connection with the lock held."""
+        waiter = _Waiter(key, self._lock, start)
+        self._waiters.append(waiter)
+
+        start = time.time()
+        try:
+            while waiter.conn is None and waiter.error is None \
+                    and not self.closed:
+                if timeout is None:
+                    waiter.cond.wait()
+                else:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    waiter.cond.wait(remaining)
+        finally:
+            self.waits += 1
+            self.wait_time += time.time() - start
+
+        if waiter.conn is not None:
+            return waiter.conn
+        if waiter.error is not None:
+            raise waiter.error
+
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+        if self.closed:
+            raise PoolError("connection pool is closed")
+        self.timeouts += 1
+        raise PoolError("connection pool exausted")
+
     def putconn(self, conn=None, key=None, close=False):
         """Put away an unused connection."""
+        self._check_fork()
         self._lock.acquire()
         try:
+            if self._putforked(conn): return
+            if self._waiters and not close and not self.closed:
+                if key is None: key = self._rused.get(id(conn))
+                if not key:
+                    raise PoolError("trying to put unkeyed connection")
+
+                # Hand the connection over to the first waiting thread
+                self._release(conn, key)
+                reason = self._expired(conn)
+                if not reason and self._reset(conn):
+                    waiter = self._waiters.popleft()
+                    self._assign(conn, waiter.key, waiter.start)
+                    waiter.conn = conn
+                    waiter.cond.notify()
+                else:
+                    # The connection is broken: make a new one
+                    self._discard(conn, reason or 'broken')
+                    self._serve_waiters()
+                return
+
             self._putconn(conn, key, close)
+            self._serve_waiters()
+        finally:
+            self._lock.release()
+
+    def _serve_waiters(self):
+        """Give a connection to the waiting threads while there are free
+        connections or the pool can grow."""
+        while self._waiters and not self.closed and (
+                self._pool or len(self._used) < self.maxconn):
+            waiter = self._waiters.popleft()
+            try:
+                waiter.conn = self._take(waiter.key, waiter.start)
+            except Exception, e:
+                waiter.error = e
+            waiter.cond.notify()
+
+    def stats(self):
+        """Return a snapshot of the pool metrics as a dict.
+
+        Besides the metrics of all the pools, 'waiting' is the number of
+        threads waiting for a connection, 'waits' the number of getconn()
+        calls which had to wait, 'wait_time' the total time they waited and
+        'timeouts' the number of waits which timed out.
+        """
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            stats = self._stats()
+            stats['waiting'] = len(self._waiters)
+            stats['waits'] = self.waits
+            stats['wait_time'] = self.wait_time
+            stats['timeouts'] = self.timeouts
+            return stats
         finally:
             self._lock.release()
 
     def closeall(self):
         """Close all connections (even the one currently in use.)"""
+        self._check_fork()
         self._lock.acquire()
         try:
             self._closeall()
+            self._stop.set()
+            while self._waiters:
+                self._waiters.popleft().cond.notify()
+        finally:
+            self._lock.release()
+
+    def _maintain(self):
+        """Close the expired connections, check the idle ones and create
+        new ones up to 'minconn'.
+
+        The lock is not held while connecting or checking the connections.
+        """
+        now = time.time()
+        checks = []
+        self._lock.acquire()
+        try:
+            if self.closed: return
+            for conn in self._pool[:]:
+                reason = self._expired(conn, now)
+                if reason:
+                    self._pool.remove(conn)
+                    self._discard(conn, reason)
+                elif self.health_check_interval is not None and \
+                        now - self._idle[id(conn)] >= \
+                        self.health_check_interval:
+                    # Keep the connection as used during the check
+                    self._pool.remove(conn)
+                    del self._idle[id(conn)]
+                    key = self._getkey()
+                    self._used[key] = conn
+                    self._rused[id(conn)] = key
+                    checks.append((key, conn))
+            missing = self.minconn - len(self._pool) - len(self._used)
+        finally:
+            self._lock.release()
+
+        for key, conn in checks:
+            alive = self._check(conn)
+            self._lock.acquire()
+            try:
+                if self.closed: return
+                self._release(conn, key)
+                if alive:
+                    self._add_idle(conn)
+                else:
+                    self._discard(conn, 'broken')
+                    missing += 1
+                self._serve_waiters()
+            finally:
+                self._lock.release()
+
+        if missing <= 0:
+            return
+        conns = self._new_connections(missing)
+        self._lock.acquire()
+        try:
+            for conn in conns:
+                if self.closed or \
+                        len(self._pool) + len(self._used) >= self.minconn:
+                    self._discard(conn, 'surplus')
+                else:
+                    self._add_idle(conn)
+            self._serve_waiters()
         finally:
             self._lock.release()
 
+    def _check(self, conn):
+        """Return True if an idle connection is still usable.
+
+        Only the input already received is read, without a round trip to
+        the server: this detects the connections closed by the server.
+        """
+        try:
+            return conn.poll() == _ext.POLL_OK and \
+                conn.get_transaction_status() == _ext.TRANSACTION_STATUS_IDLE
+        except Exception:
+            return False
+
 
 class PersistentConnectionPool(AbstractConnectionPool):
     """A pool that assigns persistent connections to different threads. 
@@ -215,6 +789,9 @@ class PersistentConnectionPool(AbstractConnectionPool):
     single connection from the pool.
     """
 
+    # the keys are thread ids: keep the hold times together
+    _stats_by_key = False
+
     def __init__(self, minconn, maxconn, *args, **kwargs):
         """Initialize the threading lock."""
         import threading
@@ -227,9 +804,22 @@ class PersistentConnectionPool(AbstractConnectionPool):
         import thread
         self.__thread = thread
 
+    def _forked(self):
+        AbstractConnectionPool._forked(self)
+        self._lock = threading.Lock()
+
+    def _warm_up(self):
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            AbstractConnectionPool._warm_up(self)
+        finally:
+            self._lock.release()
+
     def getconn(self):
         """Generate thread id and return a connection."""
         key = self.__thread.get_ident()
+        self._check_fork()
         self._lock.acquire()
         try:
             return self._getconn(key)
@@ -239,6 +829,7 @@ class PersistentConnectionPool(AbstractConnectionPool):
     def putconn(self, conn=None, close=False):
         """Put away an unused connection."""
         key = self.__thread.get_ident()
+        self._check_fork()
         self._lock.acquire()
         try:
             if not conn: conn = self._used[key]
@@ -246,10 +837,618 @@ class PersistentConnectionPool(AbstractConnectionPool):
         finally:
             self._lock.release()
 
+    def stats(self):
+        """Return a snapshot of the pool metrics as a dict."""
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            return self._stats()
+        finally:
+            self._lock.release()
+
     def closeall(self):
         """Close all connections (even the one currently in use.)"""
+        self._check_fork()
         self._lock.acquire()
         try:
             self._closeall()
         finally:
             self._lock.release()
+
+
+class _ReadOnlyConnectionPool(ThreadedConnectionPool):
+    """A threaded pool whose connections are set read-only on creation."""
+
+    def _new_connections(self, count):
+        conns = ThreadedConnectionPool._new_connections(self, count)
+        try:
+            for conn in conns:
+                conn.set_session(readonly=True)
+        except:
+            for conn in conns:
+                self._discard(conn, 'broken')
+            raise
+        return conns
+
+
+class RoutingConnectionPool(object):
+    """A pool sending the read-only work to the replicas of a server.
+
+    'primary' and the 'replicas' are connection strings: a
+    ThreadedConnectionPool of 'minconn' to 'maxconn' connections is
+    created for each of them. The connections to the replicas are made
+    read-only with set_session(readonly=True). The other keyword arguments
+    are passed to the pools.
+
+    getconn(readonly=True) chooses a replica according to 'strategy':
+
+    - 'least_outstanding': the replica with the fewest connections in use
+      relative to its weight;
+    - 'round_robin': the replicas in turn, in proportion to their weight.
+
+    'weights' is a list of positive numbers, one per replica, all 1 by
+    default. A replica failing to connect, also when the pool is created,
+    or whose connection is put back with an OperationalError, is not used
+    for 'retry_interval' seconds. When no replica is available the primary
+    is used.
+    """
+
+    def __init__(self, minconn, maxconn, primary, replicas=(),
+                 strategy='least_outstanding', weights=None,
+                 retry_interval=30, **kwargs):
+        if strategy not in ('least_outstanding', 'round_robin'):
+            raise ValueError("bad routing strategy: %r" % strategy)
+        if weights is None:
+            weights = [1] * len(replicas)
+        if len(weights) != len(replicas) or [w for w in weights if w <= 0]:
+            raise ValueError("one positive weight per replica required")
+
+        self.strategy = strategy
+        self.weights = list(weights)
+        self.retry_interval = retry_interval
+        self.closed = False
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+        self.primary = ThreadedConnectionPool(
+            minconn, maxconn, primary, **kwargs)
+        self.replicas = []
+        self._down = {} # replica index -> time it can be tried again
+        try:
+            for dsn in replicas:
+                try:
+                    pool = _ReadOnlyConnectionPool(
+                        minconn, maxconn, dsn, **kwargs)
+                except psycopg2.OperationalError, e:
+                    # Start the unreachable replica empty, to be tried again
+                    # after 'retry_interval'
+                    pool = _ReadOnlyConnectionPool(0, maxconn, dsn, **kwargs)
+                    pool.minconn = minconn
+                    self._down[len(self.replicas)] = \
+                        time.time() + retry_interval
+                    dbg("replica", len(self.replicas), "marked unhealthy:", e)
+                self.replicas.append(pool)
+        except:
+            for pool in [self.primary] + self.replicas:
+                pool.closeall()
+            raise
+
+        self._outstanding = [0] * len(self.replicas)
+        self._current = [0] * len(self.replicas) # for the round robin
+        self._routes = {} # id(conn) -> (conn, pool, key)
+        self._keys = {} # key -> pool
+        self._inherited = weakref.WeakSet() # in use when the process forked
+
+    def _check_fork(self):
+        """Forget the connections in use by the parent after a fork.
+
+        The pools of the primary and the replicas check for themselves.
+        """
+        return _check_fork(self)
+
+    def _forked(self):
+        self._lock = threading.Lock()
+        self._inherited = weakref.WeakSet(
+            [conn for conn, pool, key in self._routes.itervalues()])
+        self._routes = {}
+        self._keys = {}
+        self._outstanding = [0] * len(self.replicas)
+        self._current = [0] * len(self.replicas)
+        self._down = {}
+
+    def _warm_up(self):
+        self._check_fork()
+        after_fork(self.primary, *self.replicas)
+
+    def getconn(self, key=None, readonly=False, timeout=0):
+        """Get a connection from the primary or, if 'readonly', from a
+        replica.
+
+        'key' and 'timeout' are used as in ThreadedConnectionPool.getconn().
+        A key keeps the connection it was given until it is put back.
+        """
+        if self.closed: raise PoolError("connection pool is closed")
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            if key is not None and key in self._keys:
+                return self._keys[key].getconn(key)
+            if readonly:
+                candidates = self._candidates()
+            else:
+                candidates = []
+        finally:
+            self._lock.release()
+
+        # Try the replicas without waiting, then wait for the last choice
+        candidates.append(self.primary)
+        for pool in candidates:
+            last = pool is self.primary
+            try:
+                if last:
+                    conn = pool.getconn(key, timeout=timeout)
+                else:
+                    conn = pool.getconn(key)
+            except PoolError:
+                if last: raise
+                continue
+            except psycopg2.OperationalError:
+                if last: raise
+                self._mark_down(pool)
+                continue
+
+            self._lock.acquire()
+            try:
+                self._routes[id(conn)] = (conn, pool, key)
+                if pool is not self.primary:
+                    self._outstanding[self.replicas.index(pool)] += 1
+                if key is not None:
+                    self._keys[key] = pool
+            finally:
+                self._lock.release()
+            return conn
+
+    def putconn(self, conn, key=None, close=False, error=None):
+        """Put away a connection.
+
+        If 'error' is an OperationalError raised using a replica connection,
+        the connection is closed and the replica is not used for a while.
+        """
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            if conn in self._inherited:
+                # taken before a fork: the pools have already forgotten it
+                self._inherited.discard(conn)
+                if not conn.closed:
+                    conn.close()
+                return
+            if id(conn) not in self._routes:
+                raise PoolError("trying to put unkeyed connection")
+            route_conn, pool, route_key = self._routes.pop(id(conn))
+            if key is None: key = route_key
+            self._keys.pop(key, None)
+            if pool is not self.primary:
+                self._outstanding[self.replicas.index(pool)] -= 1
+        finally:
+            self._lock.release()
+
+        if isinstance(error, psycopg2.OperationalError) \
+                and pool is not self.primary:
+            self._mark_down(pool)
+            close = True
+        pool.putconn(conn, key, close)
+
+    def _candidates(self):
+        """Return the healthy replicas in order of preference."""
+        now = time.time()
+        for i, t in self._down.items():
+            if t <= now:
+                del self._down[i]
+        healthy = [i for i in range(len(self.replicas)) if i not in self._down]
+        if not healthy:
+            return []
+
+        if self.strategy == 'round_robin':
+            # smooth weighted round robin: the replica with the highest
+            # credit is chosen and pays for it with the total weight
+            total = 0
+            for i in healthy:
+                self._current[i] += self.weights[i]
+                total += self.weights[i]
+            healthy.sort(key=lambda i: -self._current[i])
+            self._current[healthy[0]] -= total
+        else:
+            healthy.sort(
+                key=lambda i: float(self._outstanding[i]) / self.weights[i])
+
+        return [self.replicas[i] for i in healthy]
+
+    def _mark_down(self, pool):
+        """Don't use a replica for 'retry_interval' seconds."""
+        self._lock.acquire()
+        try:
+            i = self.replicas.index(pool)
+            self._down[i] = time.time() + self.retry_interval
+            dbg("replica", i, "marked unhealthy")
+        finally:
+            self._lock.release()
+
+    def add_observer(self, observer):
+        """Add an observer to the primary and replicas pools."""
+        for pool in [self.primary] + self.replicas:
+            pool.add_observer(observer)
+
+    def stats(self):
+        """Return the stats of the pools: 'primary' and 'replicas' contain
+        the stats of the respective pools, 'unhealthy' the indexes of the
+        replicas currently not used."""
+        self._check_fork()
+        self._lock.acquire()
+        try:
+            now = time.time()
+            unhealthy = sorted(i for i, t in self._down.iteritems() if t > now)
+        finally:
+            self._lock.release()
+        return {
+            'primary': self.primary.stats(),
+            'replicas': [pool.stats() for pool in self.replicas],
+            'unhealthy': unhealthy}
+
+    def closeall(self):
+        """Close all the connections of all the pools."""
+        if self.closed: raise PoolError("connection pool is closed")
+        self.closed = True
+        for pool in [self.primary] + self.replicas:
+            pool.closeall()
+
+
+# Statements changing the session, pinning a connection to its handle
+_session_re = re.compile(
+    r'\s*(LISTEN|PREPARE|CREATE\s+(TEMP|TEMPORARY)\b|'
+    r'SET\s+(?!LOCAL\b|TRANSACTION\b|CONSTRAINTS\b))', re.I)
+
+
+class TransactionConnectionPool(ThreadedConnectionPool):
+    """A pool lending the connections only for the length of a transaction.
+
+    getconn() returns a TransactionConnection handle, which takes a
+    connection from the pool at its first statement and gives it back at
+    commit() or rollback(), or after every statement in autocommit mode.
+    Many more handles than 'maxconn' can so be in use at the same time.
+
+    A handle keeps its connection until putconn() when the session state
+    is changed: by set_session(), by a named cursor, by statements such
+    as LISTEN, SET, PREPARE or CREATE TEMP TABLE, or by calling pin().
+    'timeout' is used, as in ThreadedConnectionPool, when a handle needs
+    a connection. As in the other pools, only
+    'minconn' connections are kept open when given back.
+    """
+
+    def getconn(self, key=None, timeout=0):
+        """Return a new connection handle.
+
+        'key' is not used: it is accepted for compatibility with the other
+        pools.
+        """
+        if self.closed: raise PoolError("connection pool is closed")
+        return TransactionConnection(self, timeout)
+
+    def putconn(self, conn=None, key=None, close=False):
+        """Close a connection handle, releasing its connection if any."""
+        if not isinstance(conn, TransactionConnection) \
+                or conn._pool is not self:
+            raise PoolError("trying to put a connection not from this pool")
+        conn._release(close)
+        conn._closed = True
+
+    def _acquire(self, timeout):
+        return ThreadedConnectionPool.getconn(self, timeout=timeout)
+
+    def _putback(self, conn, close=False):
+        ThreadedConnectionPool.putconn(self, conn, close=close)
+
+
+class TransactionConnection(object):
+    """A handle to a connection of a TransactionConnectionPool.
+
+    The handle can be used as a connection: the methods not defined here
+    are run on a connection taken from the pool, which is then pinned to
+    the handle.
+    """
+
+    def __init__(self, pool, timeout=0):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+        self._pinned = False
+        self._closed = False
+        self._autocommit = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def pinned(self):
+        """True if the handle keeps its connection until it is put back."""
+        return self._pinned
+
+    @property
+    def connection(self):
+        """The connection currently bound to the handle, or None."""
+        return self._conn
+
+    def _bind(self):
+        """Return the connection bound to the handle, taking one from the
+        pool if needed."""
+        if self._closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self._conn is None:
+            conn = self._pool._acquire(self._timeout)
+            if self._autocommit:
+                conn.autocommit = True
+            self._conn = conn
+        return self._conn
+
+    def _release(self, close=False):
+        """Give the connection back to the pool, if any."""
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        self._pinned = False
+        if not conn.closed:
+            conn.autocommit = False
+        self._pool._putback(conn, close)
+
+    def _statement_done(self):
+        """Release the connection after a statement in autocommit mode."""
+        if self._autocommit and not self._pinned and self._conn is not None \
+                and self._conn.get_transaction_status() \
+                    == _ext.TRANSACTION_STATUS_IDLE:
+            self._release()
+
+    def pin(self):
+        """Keep the current connection until the handle is put back.
+
+        This is a psycopg2ct extension to the DB API 2.0
+
+        """
+        self._bind()
+        self._pinned = True
+
+    def cursor(self, name=None, cursor_factory=None, withhold=False,
+               lazy=False):
+        if self._closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        kwargs = {'withhold': withhold, 'lazy': lazy}
+        if cursor_factory is not None:
+            kwargs['cursor_factory'] = cursor_factory
+        cur = _TransactionCursor(self, name, kwargs)
+        if name is not None:
+            # The server cursor lives on the connection
+            self.pin()
+        return cur
+
+    def commit(self):
+        if self._closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self._conn is not None:
+            try:
+                self._conn.commit()
+            finally:
+                if not self._pinned:
+                    self._release()
+
+    def rollback(self):
+        if self._closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self._conn is not None:
+            try:
+                self._conn.rollback()
+            finally:
+                if not self._pinned:
+                    self._release()
+
+    def close(self):
+        if self._closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        self._pool.putconn(self)
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._autocommit = bool(value)
+        if self._conn is not None:
+            self._conn.autocommit = self._autocommit
+            self._statement_done()
+
+    def set_session(self, isolation_level=None, readonly=None,
+                    deferrable=None, autocommit=None):
+        if autocommit is not None:
+            self.autocommit = autocommit
+        if (isolation_level, readonly, deferrable) != (None, None, None):
+            self.pin()
+            self._conn.set_session(isolation_level, readonly, deferrable)
+
+    def __getattr__(self, attr):
+        self.pin()
+        return getattr(self._conn, attr)
+
+
+class _TransactionCursor(object):
+    """A cursor of a TransactionConnection.
+
+    The cursor is recreated on the connection bound to the handle when a
+    statement is executed; the other attributes are the ones of the last
+    cursor. A named cursor pins the connection, and can't be used once
+    the handle has given it back.
+    """
+
+    _attrs = ('_handle', '_name', '_kwargs', '_settings', '_cursor')
+
+    # The attributes of a cursor before its first statement
+    _defaults = {'description': None, 'query': None, 'statusmessage': None,
+        'lastrowid': None, 'rowcount': -1, 'rownumber': 0, 'closed': False,
+        'arraysize': 1, 'itersize': 2000, 'binary': False,
+        'server_params': False}
+
+    # The methods reading the results of the last statement
+    _fetches = frozenset(('fetchone', 'fetchmany', 'fetchall', 'scroll'))
+
+    def __init__(self, handle, name, kwargs):
+        self._handle = handle
+        self._name = name
+        self._kwargs = kwargs
+        self._settings = {} # attributes set by the user
+        self._cursor = None
+
+    def _bind(self):
+        conn = self._handle._bind()
+        if self._cursor is None or self._cursor.connection is not conn:
+            self._cursor = conn.cursor(self._name, **self._kwargs)
+            for attr, value in self._settings.iteritems():
+                setattr(self._cursor, attr, value)
+        return self._cursor
+
+    def _current(self):
+        """Return the last cursor, or None.
+
+        The results of an unnamed cursor are kept on the client, but the
+        server cursor of a named one can't be used once the connection is
+        given back: it may belong to another handle by now.
+        """
+        cursor = self._cursor
+        if cursor is not None and self._name is not None \
+                and cursor.connection is not self._handle._conn:
+            raise psycopg2.InterfaceError(
+                "the connection of the cursor was returned to the pool")
+        return cursor
+
+    def _run(self, method, args, kwargs):
+        cursor = self._bind()
+        try:
+            return getattr(cursor, method)(*args, **kwargs)
+        finally:
+            self._handle._statement_done()
+
+    def execute(self, query, *args, **kwargs):
+        if _session_re.match(query):
+            self._handle.pin()
+        return self._run('execute', (query,) + args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._run('executemany', args, kwargs)
+
+    def execute_prepared(self, *args, **kwargs):
+        return self._run('execute_prepared', args, kwargs)
+
+    def callproc(self, *args, **kwargs):
+        return self._run('callproc', args, kwargs)
+
+    def mogrify(self, *args, **kwargs):
+        return self._run('mogrify', args, kwargs)
+
+    def copy_from(self, *args, **kwargs):
+        return self._run('copy_from', args, kwargs)
+
+    def copy_from_iter(self, *args, **kwargs):
+        return self._run('copy_from_iter', args, kwargs)
+
+    def copy_to(self, *args, **kwargs):
+        return self._run('copy_to', args, kwargs)
+
+    def copy_to_rows(self, *args, **kwargs):
+        return self._run('copy_to_rows', args, kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        return self._run('copy_expert', args, kwargs)
+
+    def copy_to_iter(self, *args, **kwargs):
+        cursor = self._bind()
+        try:
+            for row in cursor.copy_to_iter(*args, **kwargs):
+                yield row
+        finally:
+            self._handle._statement_done()
+
+    def close(self):
+        cursor = self._current()
+        if cursor is not None:
+            cursor.close()
+
+    def __iter__(self):
+        cursor = self._current()
+        if cursor is None:
+            raise psycopg2.ProgrammingError("no results to fetch")
+        return iter(cursor)
+
+    def __getattr__(self, attr):
+        if attr == 'connection':
+            # The cursor may have run on any connection of the pool
+            return self._handle
+        cursor = self._current()
+        if cursor is not None:
+            return getattr(cursor, attr)
+
+        # Don't take a connection only to read an attribute
+        if attr in self._fetches:
+            raise psycopg2.ProgrammingError("no results to fetch")
+        if attr in self._settings:
+            return self._settings[attr]
+        if attr in self._kwargs:
+            return self._kwargs[attr]
+        if attr == 'name':
+            return self._name
+        if attr in self._defaults:
+            return self._defaults[attr]
+
+        factory = self._kwargs.get('cursor_factory', _ext.cursor)
+        if callable(getattr(factory, attr, None)):
+            # A method: the connection is taken when it is called
+            def method(*args, **kwargs):
+                return self._run(attr, args, kwargs)
+            return method
+        # The attributes of custom cursor classes
+        return getattr(self._bind(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in self._attrs:
+            object.__setattr__(self, attr, value)
+            return
+        if attr == 'withhold' and value:
+            self._handle.pin()
+        self._settings[attr] = value
+        if self._cursor is not None:
+            setattr(self._cursor, attr, value)
+
+
+def after_fork(*pools):
+    """Prepare pools created before a fork to be used in a child process.
+
+    The connections inherited from the parent are dropped, without closing
+    the parent's sessions, and 'minconn' new connections are created for
+    each pool, all the pools in parallel. This is meant to be called in
+    the child right after the fork, e.g. in a gunicorn 'post_fork' hook or
+    an uWSGI 'postfork' function. Without calling it the pools drop the
+    inherited connections when they are first used.
+    """
+    errors = []
+    def warm_up(pool):
+        try:
+            pool._warm_up()
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=warm_up, args=(pool,))
+        for pool in pools]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,186 @@
+from unittest import TestCase
+
+from psycopg2ct import aio
+from psycopg2ct import extensions
+from psycopg2ct._impl import exceptions
+
+
+class FakeFuture(object):
+    def __init__(self):
+        self._callbacks = []
+        self._state = 'pending'
+        self._result = self._exception = None
+
+    def done(self):
+        return self._state != 'pending'
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def cancel(self):
+        if self.done():
+            return False
+        self._finish('cancelled')
+        return True
+
+    def set_result(self, result):
+        self._result = result
+        self._finish('done')
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish('done')
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self, state):
+        assert not self.done()
+        self._state = state
+        for callback in self._callbacks:
+            callback(self)
+
+
+class FakeLoop(object):
+    """Call the readers and writers when run() is called."""
+
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+
+    def create_future(self):
+        return FakeFuture()
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        del self.readers[fd]
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        del self.writers[fd]
+
+    def run(self):
+        while self.readers or self.writers:
+            for callback in self.readers.values() + self.writers.values():
+                callback()
+
+
+class FakeConnection(object):
+    def __init__(self, states, fd=3):
+        self.states = list(states)
+        self.fd = fd
+        self.cancelled = self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def poll(self):
+        state = self.states.pop(0)
+        if isinstance(state, Exception):
+            raise state
+        return state
+
+    def cancel(self):
+        self.cancelled = True
+
+    def isexecuting(self):
+        return bool(self.states)
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class TestPoll(TestCase):
+    def test_poll(self):
+        loop = FakeLoop()
+        conn = FakeConnection([extensions.POLL_WRITE, extensions.POLL_READ,
+            extensions.POLL_READ, extensions.POLL_OK])
+        future = aio._poll(conn, loop)
+        self.assertEqual(loop.writers.keys(), [3])
+        self.assertFalse(future.done())
+        loop.run()
+        self.assertEqual(future.result(), None)
+        self.assertEqual(conn.states, [])
+
+    def test_error(self):
+        loop = FakeLoop()
+        error = exceptions.OperationalError("server closed the connection")
+        conn = FakeConnection([extensions.POLL_READ, error])
+        future = aio._poll(conn, loop)
+        loop.run()
+        self.assertTrue(future.exception() is error)
+
+    def test_cancel(self):
+        loop = FakeLoop()
+        conn = FakeConnection([extensions.POLL_READ, extensions.POLL_READ,
+            exceptions.QueryCanceledError()])
+        future = aio._poll(conn, loop)
+        future.cancel()
+        self.assertTrue(conn.cancelled)
+        loop.run()
+        self.assertEqual(conn.states, [])
+
+
+class TestAsyncConnectionPool(TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.conns = []
+        self._connect = aio.connect
+
+        def connect(*args, **kwargs):
+            future = FakeFuture()
+            conn = aio.AsyncConnection(FakeConnection([]), kwargs['loop'])
+            self.conns.append(conn)
+            future.set_result(conn)
+            return future
+
+        aio.connect = connect
+
+    def tearDown(self):
+        aio.connect = self._connect
+
+    def test_wait(self):
+        p = aio.AsyncConnectionPool(1, 2, 'dsn', loop=self.loop)
+        f1, f2, f3 = p.getconn(), p.getconn(), p.getconn()
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(f1.result() is self.conns[0])
+        self.assertTrue(f2.result() is self.conns[1])
+        self.assertFalse(f3.done())
+        self.assertEqual(p.waiting, 1)
+
+        p.putconn(f2.result())
+        self.assertTrue(f3.result() is self.conns[1])
+
+        # only minconn connections are kept
+        p.putconn(f1.result())
+        p.putconn(f3.result())
+        self.assertFalse(self.conns[0].closed)
+        self.assertTrue(self.conns[1].closed)
+        self.assertEqual(len(self.conns), 2)
+
+    def test_closeall(self):
+        p = aio.AsyncConnectionPool(0, 1, 'dsn', loop=self.loop)
+        conn = p.getconn().result()
+        waiter = p.getconn()
+        p.closeall()
+        self.assertTrue(isinstance(waiter.exception(), aio.PoolError))
+        p.putconn(conn)
+        self.assertTrue(conn.closed)
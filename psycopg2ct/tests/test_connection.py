@@ -0,0 +1,143 @@
+import os
+import socket
+from unittest import TestCase
+
+from psycopg2ct._impl import connection
+from psycopg2ct._impl import consts
+from psycopg2ct._impl import exceptions
+from psycopg2ct._impl.connection import Connection
+
+
+def make_connection():
+    conn = Connection.__new__(Connection)
+    conn._cancel = conn._pgconn = None
+    conn._pid = os.getpid()
+    conn._poll_state = None
+    conn._copy_steps = None
+    conn._async_cursor = None
+    conn.status = consts.STATUS_READY
+    return conn
+
+
+class TestPoll(TestCase):
+    def setUp(self):
+        self._green_callback = connection._green_callback
+
+    def tearDown(self):
+        connection._green_callback = self._green_callback
+
+    def test_wait(self):
+        states = []
+
+        def wait(conn):
+            while True:
+                state = conn.poll()
+                states.append(state)
+                if state == consts.POLL_OK:
+                    break
+
+        connection._green_callback = wait
+        conn = make_connection()
+        conn._wait(consts.POLL_WRITE)
+        self.assertEqual(states, [consts.POLL_WRITE, consts.POLL_OK])
+        self.assertEqual(conn._poll_state, None)
+
+    def test_copy_steps(self):
+        def steps():
+            yield consts.POLL_WRITE
+            yield consts.POLL_READ
+
+        conn = make_connection()
+        conn._copy_steps = steps()
+        conn._async_cursor = object()
+        self.assertEqual([conn.poll() for i in range(3)],
+            [consts.POLL_WRITE, consts.POLL_READ, consts.POLL_OK])
+        self.assertEqual(conn._copy_steps, None)
+        self.assertEqual(conn._async_cursor, None)
+
+    def test_copy_error(self):
+        def steps():
+            yield consts.POLL_READ
+            raise ValueError()
+
+        conn = make_connection()
+        conn._copy_steps = steps()
+        conn._async_cursor = object()
+        self.assertEqual(conn.poll(), consts.POLL_READ)
+        self.assertRaises(ValueError, conn.poll)
+        self.assertEqual(conn._copy_steps, None)
+        self.assertEqual(conn._async_cursor, None)
+
+
+class TestFork(TestCase):
+    def test_inherited(self):
+        conn = make_connection()
+        conn._closed = False
+        conn._pid = os.getpid() + 1   # as if created by the parent
+        self.assertRaises(exceptions.InterfaceError, conn.poll)
+        self.assertRaises(exceptions.InterfaceError, conn.get_backend_pid)
+        conn.close()
+        self.assertTrue(conn.closed)
+
+
+class FakeAsyncConnection(object):
+    """Return the states in sequence from poll()"""
+
+    def __init__(self, states, ready=True):
+        self.states = list(states)
+        self.sync = self.closed = False
+        self._sock, self._peer = socket.socketpair()
+        if ready:
+            self._peer.send('x')
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def poll(self):
+        state = self.states.pop(0)
+        if isinstance(state, Exception):
+            raise state
+        return state
+
+    def _set_sync(self):
+        self.sync = True
+
+    def _close(self):
+        self.closed = True
+
+
+class TestConnectMany(TestCase):
+    def connect_many(self, states, ready=True, timeout=None):
+        conns = [FakeAsyncConnection(s, ready) for s in states]
+        factory = iter(conns).next
+        try:
+            return connection._connect_many('', len(conns),
+                connection_factory=lambda dsn, async: factory(),
+                timeout=timeout)
+        finally:
+            self.conns = conns
+
+    def test_connect(self):
+        conns = self.connect_many([
+            [consts.POLL_WRITE, consts.POLL_READ, consts.POLL_OK],
+            [consts.POLL_OK],
+            [consts.POLL_READ, consts.POLL_OK]])
+        self.assertEqual(conns, self.conns)
+        for conn in conns:
+            self.assertEqual(conn.states, [])
+            self.assertTrue(conn.sync)
+            self.assertFalse(conn.closed)
+
+    def test_error(self):
+        error = exceptions.OperationalError("connection refused")
+        self.assertRaises(exceptions.OperationalError, self.connect_many, [
+            [consts.POLL_WRITE, consts.POLL_READ, consts.POLL_OK],
+            [consts.POLL_READ, error]])
+        for conn in self.conns:
+            self.assertTrue(conn.closed)
+            self.assertFalse(conn.sync)
+
+    def test_timeout(self):
+        self.assertRaises(exceptions.OperationalError, self.connect_many,
+            [[consts.POLL_READ, consts.POLL_OK]], ready=False, timeout=0.01)
+        self.assertTrue(self.conns[0].closed)
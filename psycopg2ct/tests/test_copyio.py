@@ -0,0 +1,233 @@
+from ctypes import addressof, create_string_buffer
+import datetime
+import decimal
+import uuid
+from unittest import TestCase
+
+from psycopg2ct import tz
+from psycopg2ct._impl import consts
+from psycopg2ct._impl import typecasts
+from psycopg2ct._impl.cursor import Cursor
+from psycopg2ct._impl.copyio import BinaryCopyDecoder, BinaryCopyRowsReader
+from psycopg2ct._impl.copyio import CopyRowsReader, TextCopyDecoder
+from psycopg2ct._impl.copyio import format_binary_numeric
+from psycopg2ct._impl.exceptions import DataError, NotSupportedError
+
+
+class FakeConnection(object):
+    _py_enc = 'utf-8'
+
+
+class FakeCursor(object):
+    tzinfo_factory = tz.FixedOffsetTimezone
+    _py_enc = 'utf-8'
+
+    def _get_cast(self, oid):
+        return typecasts.string_types[oid]
+
+
+class TestCopyRowsReader(TestCase):
+    def read(self, rows, **kwargs):
+        return CopyRowsReader(rows, FakeConnection(), **kwargs).read()
+
+    def test_types(self):
+        self.assertEqual(self.read([
+            (1, 2 ** 70, 1.5, decimal.Decimal('1.10'), True, None),
+            (datetime.date(2012, 1, 2), datetime.datetime(2012, 1, 2, 3, 4),
+                buffer('\x00\xff'), u'\u20ac', [1, 2]),
+        ]), '1\t1180591620717411303424\t1.5\t1.10\tt\t\\N\n'
+            '2012-01-02\t2012-01-02T03:04:00\t\\\\x00ff\t\xe2\x82\xac\t'
+            '[1, 2]\n')
+
+    def test_escape(self):
+        self.assertEqual(self.read([('a\tb\nc\\d\re',)]),
+            'a\\tb\\nc\\\\d\\re\n')
+        self.assertEqual(self.read([('a,b\t', None)], sep=',', null='NULL'),
+            'a\\,b\\t,NULL\n')
+
+    def test_read_size(self):
+        rows = (('x' * 3, i) for i in range(10))
+        reader = CopyRowsReader(rows, FakeConnection())
+        chunks = []
+        while True:
+            data = reader.read(7)
+            if not data:
+                break
+            self.assertTrue(len(data) <= 7)
+            chunks.append(data)
+        self.assertEqual(''.join(chunks),
+            ''.join(['xxx\t%d\n' % i for i in range(10)]))
+
+    def test_readline(self):
+        reader = CopyRowsReader([(1,), (2,)], FakeConnection())
+        self.assertEqual(reader.readline(), '1\n')
+        self.assertEqual(reader.read(1), '2')
+        self.assertEqual(reader.readline(), '\n')
+        self.assertEqual(reader.readline(), '')
+
+
+class TestTextCopyDecoder(TestCase):
+    oids = [23, 20, 701, 1700, 16, 25, 1082]
+
+    def rows(self):
+        return [
+            (1, 2 ** 40, 1.5, decimal.Decimal('-12345.678'), True,
+                'a\tb\nc\\d\re', datetime.date(2012, 1, 2)),
+            (None,) * 7,
+        ]
+
+    def test_roundtrip(self):
+        data = CopyRowsReader(self.rows(), FakeConnection()).read()
+        decoder = TextCopyDecoder(self.oids, FakeCursor())
+        decoder.write(data)
+        self.assertEqual(decoder.rows, self.rows())
+
+    def test_chunks(self):
+        data = CopyRowsReader(self.rows(), FakeConnection()).read()
+        decoder = TextCopyDecoder(self.oids, FakeCursor())
+        rows = []
+        for i in xrange(len(data)):
+            rows.extend(decoder.feed(data[i]))
+        self.assertEqual(rows, self.rows())
+
+    def test_unescape(self):
+        decoder = TextCopyDecoder([25, 25], FakeCursor(), sep=',', null='')
+        self.assertEqual(decoder.feed('\\101\\x42\\b\\v\\,\\q,\n'),
+            [('AB\b\v,q', None)])
+        self.assertRaises(DataError, decoder.feed, 'a\n')
+
+
+class TestBinaryCopy(TestCase):
+    oids = [23, 20, 701, 1700, 16, 25, 17, 1082, 1114, 1184, 1186, 2950]
+
+    def rows(self):
+        utc = tz.FixedOffsetTimezone(0)
+        return [
+            (1, 2 ** 40, 1.5, decimal.Decimal('-12345.678'), True, 'foo',
+                'a\x00b', datetime.date(2012, 1, 2),
+                datetime.datetime(2012, 1, 2, 3, 4, 5, 6),
+                datetime.datetime(2012, 1, 2, 3, 4, tzinfo=utc),
+                datetime.timedelta(3, 4, 5), uuid.UUID(int=42)),
+            (None,) * 12,
+        ]
+
+    def test_roundtrip(self):
+        data = BinaryCopyRowsReader(
+            self.rows(), self.oids, FakeConnection()).read()
+        decoder = BinaryCopyDecoder(self.oids, FakeCursor())
+        decoder.write(data)
+        self.assertTrue(decoder.done)
+
+        rows = [tuple(isinstance(value, buffer) and str(value) or value
+            for value in row) for row in decoder.rows]
+        self.assertEqual(rows, self.rows())
+
+    def test_chunks(self):
+        data = BinaryCopyRowsReader(
+            self.rows(), self.oids, FakeConnection()).read()
+        decoder = BinaryCopyDecoder(self.oids, FakeCursor())
+        for i in xrange(len(data)):
+            self.assertFalse(decoder.done)
+            decoder.write(data[i])
+        self.assertTrue(decoder.done)
+        self.assertEqual(len(decoder.rows), 2)
+
+    def test_numeric(self):
+        for value in ['0', '0.00', '1', '10000', '-42', '12345.67', '0.001',
+                      '1e10', '123456789.000000001']:
+            data = format_binary_numeric(decimal.Decimal(value), None)
+            result = typecasts.parse_binary_numeric(data, len(data), None)
+            self.assertEqual(result, decimal.Decimal(value))
+            if '.' in value:
+                self.assertEqual(str(result), value)
+
+        data = format_binary_numeric(decimal.Decimal('NaN'), None)
+        self.assertTrue(
+            typecasts.parse_binary_numeric(data, len(data), None).is_nan())
+
+    def test_errors(self):
+        self.assertRaises(NotSupportedError,
+            BinaryCopyRowsReader, [], [600], FakeConnection())
+        reader = BinaryCopyRowsReader([(1, 2)], [23], FakeConnection())
+        self.assertRaises(DataError, reader.read)
+        reader = BinaryCopyRowsReader(
+            [(datetime.datetime(2012, 1, 2),)], [1184], FakeConnection())
+        self.assertRaises(DataError, reader.read)
+
+
+class FailingFile(object):
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.data = []
+
+    def write(self, data):
+        if len(self.data) == self.fail_at:
+            raise IOError("disk full")
+        self.data.append(data)
+
+
+class TestCopyOutSteps(TestCase):
+    def steps(self, file, chunks):
+        cur = Cursor.__new__(Cursor)
+        cur._pgres = None
+        buffers = [create_string_buffer(chunk) for chunk in chunks]
+        self.consumed = consumed = []
+
+        def copy_out_data():
+            for chunk, buf in zip(chunks, buffers):
+                consumed.append(chunk)
+                yield addressof(buf), len(chunk)
+            yield None, consts.POLL_READ
+
+        cur._pq_copy_out_data = copy_out_data
+        return list(cur._copy_out_steps(file, 8))
+
+    def test_write(self):
+        f = FailingFile(-1)
+        states = self.steps(f, ['abc\n', 'defg\n', 'x' * 10])
+        self.assertEqual(states, [consts.POLL_READ])
+        self.assertEqual(f.data, ['abc\n', 'defg\n', 'x' * 10])
+
+    def test_write_error(self):
+        f = FailingFile(0)
+        chunks = ['abc\n', 'defg\n', 'hi\n']
+        try:
+            self.steps(f, chunks)
+        except IOError:
+            pass
+        else:
+            self.fail("IOError not raised")
+        self.assertEqual(f.data, [])
+        # The COPY was read until the end
+        self.assertEqual(self.consumed, chunks)
+
+
+class TestCopyToIter(TestCase):
+    def test_lazy(self):
+        cur = Cursor.__new__(Cursor)
+        cur._closed = False
+        cur._pgres = None
+        cur._conn = FakeConnection()
+        cur._conn.closed = False
+        cur._conn._async = False
+        cur._conn._wait = None
+        cur._get_cast = FakeCursor()._get_cast
+        queries = []
+        data = create_string_buffer('1\ta\n')
+
+        def column_types(table, columns):
+            queries.append("types of %s" % table)
+            return [23, 25]
+
+        def copy_out_data():
+            yield addressof(data), 4
+
+        cur._copy_column_types = column_types
+        cur._pq_execute = queries.append
+        cur._pq_copy_out_data = copy_out_data
+
+        rows = cur.copy_to_iter("test")
+        # Nothing is sent before the iteration starts
+        self.assertEqual(queries, [])
+        self.assertEqual(list(rows), [(1, 'a')])
+        self.assertEqual(queries, ["types of test", "COPY test TO stdout"])
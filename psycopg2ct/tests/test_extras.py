@@ -0,0 +1,365 @@
+import logging
+import socket
+import threading
+from cStringIO import StringIO
+from unittest import TestCase
+
+from psycopg2ct import compat
+compat.register()
+
+import psycopg2
+from psycopg2ct import extras
+from psycopg2ct._impl.cursor import _combine_cmd_params
+from psycopg2ct._impl.util import LRUCache
+from psycopg2ct.extensions import Notify, POLL_OK
+
+
+class FakeConnection(object):
+    encoding = 'UTF8'
+
+    def __init__(self):
+        self._query_cache = LRUCache()
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.queries = []
+
+    def mogrify(self, query, vars):
+        return _combine_cmd_params(query, vars, self.connection)
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return [(len(self.queries),)]
+
+
+class TestExecuteValues(TestCase):
+    def test_pages(self):
+        cur = FakeCursor()
+        result = extras.execute_values(cur,
+            "INSERT INTO t VALUES %s", ((i, None) for i in range(5)),
+            page_size=2)
+        self.assertEqual(result, None)
+        self.assertEqual(cur.queries, [
+            "INSERT INTO t VALUES (0,NULL),(1,NULL)",
+            "INSERT INTO t VALUES (2,NULL),(3,NULL)",
+            "INSERT INTO t VALUES (4,NULL)"])
+
+    def test_template(self):
+        cur = FakeCursor()
+        extras.execute_values(cur,
+            u"INSERT INTO t VALUES %s ON CONFLICT DO NOTHING",
+            [{'a': 1}, {'a': 2}], template=u"(%(a)s, 10)")
+        self.assertEqual(cur.queries, [
+            "INSERT INTO t VALUES (1, 10),(2, 10) ON CONFLICT DO NOTHING"])
+
+    def test_fetch(self):
+        cur = FakeCursor()
+        result = extras.execute_values(cur,
+            "INSERT INTO t VALUES %s RETURNING '%%'", [(1,), (2,), (3,)],
+            page_size=2, fetch=True)
+        self.assertEqual(result, [(1,), (2,)])
+        self.assertEqual(cur.queries[1], "INSERT INTO t VALUES (3) "
+            "RETURNING '%'")
+
+    def test_quote(self):
+        cur = FakeCursor()
+        extras.execute_values(cur, "SELECT '%%' FROM (VALUES %s) v",
+            [(True, 1.5, [1, 2])])
+        self.assertEqual(cur.queries, ["SELECT '%' FROM (VALUES "
+            "(true,1.5,ARRAY[1, 2])) v"])
+
+    def test_bad_query(self):
+        cur = FakeCursor()
+        self.assertRaises(ValueError, extras.execute_values, cur,
+            "INSERT INTO t VALUES (1)", [(1,)])
+        self.assertRaises(ValueError, extras.execute_values, cur,
+            "INSERT INTO t VALUES %s, %s", [(1,)])
+        self.assertRaises(ValueError, extras.execute_values, cur,
+            "INSERT INTO t VALUES %(a)s", [(1,)])
+
+
+class FakeCopyConnection(object):
+    encoding = 'UTF8'
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.data = []
+        self.status = 1
+        self.calls = []
+
+    def cursor(self):
+        return self
+
+    def copy_from(self, file, table, sep, null, size, columns):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            if self.fail:
+                raise psycopg2.DataError('bad data')
+            self.data.append(data)
+
+    def xid(self, format_id, gtrid, bqual):
+        return (format_id, gtrid, bqual)
+
+    def tpc_begin(self, xid):
+        self.calls.append('begin')
+
+    def tpc_prepare(self):
+        self.calls.append('prepare')
+        self.status = 5
+
+    def tpc_commit(self):
+        self.calls.append('tpc_commit')
+
+    def tpc_rollback(self):
+        self.calls.append('tpc_rollback')
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+
+class TestParallelCopy(TestCase):
+    def test_split(self):
+        conns = [FakeCopyConnection() for i in range(3)]
+        lines = ['%d\trow %d\n' % (i, i) for i in range(1000)]
+        rows = extras._parallel_copy(conns, 't',
+            StringIO(''.join(lines) + 'last'), None, '\t', '\\N', 100, False)
+        self.assertEqual(rows, 1001)
+
+        chunks = sum([conn.data for conn in conns], [])
+        self.assertEqual(
+            [chunk for chunk in chunks if not chunk.endswith('\n')], ['last'])
+        chunks.remove('last')
+        self.assertEqual(sorted(''.join(chunks).splitlines(True)),
+            sorted(lines))
+        for conn in conns:
+            self.assertEqual(conn.calls, ['commit'])
+
+    def test_error_two_phase(self):
+        conns = [FakeCopyConnection(), FakeCopyConnection(fail=True)]
+        source = StringIO('1\n' * 10000)
+        try:
+            extras._parallel_copy(conns, 't', source, None, '\t', '\\N',
+                10, True)
+        except extras.ParallelCopyError, e:
+            self.assertEqual(len(e.errors), 1)
+            self.assertEqual(e.errors[0][0], 1)
+            self.assertTrue(isinstance(e.errors[0][1], psycopg2.DataError))
+        else:
+            self.fail("ParallelCopyError not raised")
+
+        self.assertEqual(conns[1].calls, ['begin', 'rollback'])
+        self.assertTrue('tpc_commit' not in conns[0].calls)
+
+
+class FakeListenConnection(object):
+    """Receive the notifications written on the peer socket as lines of
+    'channel payload'."""
+
+    def __init__(self, pid=1):
+        self.pid = pid
+        self.autocommit = False
+        self.queries = []
+        self.notifies = []
+        self.polls = 0
+        self.error = None
+        self._sock, self.peer = socket.socketpair()
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def poll(self):
+        self.polls += 1
+        if self.error is not None:
+            raise self.error
+        for line in self._sock.recv(4096).splitlines():
+            channel, payload = line.split(' ', 1)
+            self.notifies.append(Notify(self.pid, channel, payload))
+        return POLL_OK
+
+    def notify(self, channel, payload):
+        self.peer.send('%s %s\n' % (channel, payload))
+
+
+class TestNotificationHub(TestCase):
+    def setUp(self):
+        self.hub = extras.NotificationHub()
+
+    def tearDown(self):
+        self.hub.close()
+
+    def test_add(self):
+        conn = FakeListenConnection()
+        conn.notifies.append(Notify(1, 'a', 'early'))
+        received = []
+        self.hub.subscribe('a', received.append)
+        self.hub.add(conn, ['a', 'we"ird'])
+        self.assertTrue(conn.autocommit)
+        self.assertEqual(conn.queries, ['LISTEN "a"', 'LISTEN "we""ird"'])
+
+        # Notifications received by the LISTEN are dispatched without
+        # reading the connection
+        self.assertEqual(self.hub.run_once(0), 1)
+        self.assertEqual(received, [[Notify(1, 'a', 'early')]])
+        self.assertEqual(conn.polls, 0)
+
+    def test_dispatch(self):
+        conns = [FakeListenConnection(pid) for pid in (1, 2, 3)]
+        for conn in conns:
+            self.hub.add(conn)
+        self.hub.run_once(0)
+
+        received = []
+        self.hub.subscribe('a', received.append)
+        queue = self.hub.subscribe('b')
+        conns[0].notify('a', '1')
+        conns[0].notify('b', '2')
+        conns[0].notify('a', '3')
+        conns[2].notify('b', '4')
+        received_count = 0
+        while received_count < 4:
+            received_count += self.hub.run_once(1)
+
+        self.assertEqual(received,
+            [[Notify(1, 'a', '1'), Notify(1, 'a', '3')]])
+        batch = queue.get_nowait()
+        self.assertEqual(sorted([(n.pid, n.payload) for n in batch]),
+            [(1, '2'), (3, '4')])
+        self.assertTrue(queue.empty())
+        # Only the readable connections are read
+        self.assertEqual(conns[1].polls, 0)
+        self.assertEqual(conns[1].notifies, [])
+
+    def test_block(self):
+        conn = FakeListenConnection()
+        self.hub.add(conn)
+        queue = self.hub.subscribe('a', maxsize=1)
+        conn.notify('a', '1')
+        self.assertEqual(self.hub.run_once(1), 1)
+        conn.notify('a', '2')
+        self.assertEqual(self.hub.run_once(1), 1)
+        polls = conn.polls
+
+        # The queue is full: the connection is not read until there is room
+        conn.notify('a', '3')
+        self.assertEqual(self.hub.run_once(0.01), 0)
+        self.assertEqual(conn.polls, polls)
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'a', '1')])
+        self.assertEqual(self.hub.run_once(0.01), 0)
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'a', '2')])
+        self.assertEqual(self.hub.run_once(1), 1)
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'a', '3')])
+
+    def test_drop(self):
+        self.hub.close()
+        self.hub = extras.NotificationHub(overflow='drop')
+        conn = FakeListenConnection()
+        self.hub.add(conn)
+        queue = self.hub.subscribe('a', maxsize=1)
+        received = []
+        self.hub.subscribe('a', received.append)
+        for i in range(2):
+            conn.notify('a', str(i))
+            self.assertEqual(self.hub.run_once(1), 1)
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'a', '0')])
+        self.assertEqual(len(received), 2)
+        self.assertEqual(self.hub.dropped, 1)
+
+    def test_error(self):
+        errors = []
+        self.hub.on_error = lambda conn, e: errors.append((conn, e))
+        conns = [FakeListenConnection(), FakeListenConnection()]
+        for conn in conns:
+            self.hub.add(conn)
+        conns[0].error = psycopg2.OperationalError("server closed")
+        conns[0].notify('a', '1')
+        self.hub.run_once(1)
+        self.assertEqual(errors, [(conns[0], conns[0].error)])
+        self.assertEqual(self.hub.connections, [conns[1]])
+
+        self.hub.on_error = None
+        conns[1].error = psycopg2.OperationalError("server closed")
+        conns[1].notify('a', '1')
+        self.assertRaises(psycopg2.OperationalError, self.hub.run_once, 1)
+        self.assertEqual(self.hub.connections, [])
+
+    def test_stop(self):
+        thread = threading.Thread(target=self.hub.run)
+        thread.start()
+        self.hub.stop()
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+
+    def test_wake_nonblocking(self):
+        # Many wake ups while run() is not draining the pipe don't block
+        for i in range(100000):
+            self.hub._wake()
+        self.assertEqual(self.hub.run_once(0), 0)
+        self.assertEqual(self.hub._selector.select(0), [])
+
+    def test_subscriber_error(self):
+        errors = []
+        self.hub.on_error = lambda source, e: errors.append((source, e))
+        conn = FakeListenConnection()
+        self.hub.add(conn)
+
+        def fail(notifies):
+            raise ValueError("bad subscriber")
+
+        received = []
+        self.hub.subscribe('a', fail)
+        self.hub.subscribe('a', received.append)
+        queue = self.hub.subscribe('b')
+        conn.notify('a', '1')
+        conn.notify('b', '2')
+        received_count = 0
+        while received_count < 2:
+            received_count += self.hub.run_once(1)
+
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0][0] is fail)
+        self.assertTrue(isinstance(errors[0][1], ValueError))
+        self.assertEqual(received, [[Notify(1, 'a', '1')]])
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'b', '2')])
+
+    def test_subscriber_error_logged(self):
+        conn = FakeListenConnection()
+        self.hub.add(conn)
+
+        def fail(notifies):
+            raise ValueError("bad subscriber")
+
+        self.hub.subscribe('a', fail)
+        queue = self.hub.subscribe('a')
+        logger = logging.getLogger('psycopg2')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        propagate, logger.propagate = logger.propagate, False
+        try:
+            conn.notify('a', '1')
+            while not self.hub.run_once(1):
+                pass
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = propagate
+        self.assertEqual(len(records), 1)
+        self.assertEqual(queue.get_nowait(), [Notify(1, 'a', '1')])
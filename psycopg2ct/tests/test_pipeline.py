@@ -0,0 +1,236 @@
+import threading
+from unittest import TestCase
+
+from psycopg2ct._impl import consts
+from psycopg2ct._impl import libpq
+from psycopg2ct._impl import pipeline
+from psycopg2ct._impl.exceptions import OperationalError, ProgrammingError
+from psycopg2ct._impl.pipeline import Pipeline
+from psycopg2ct._impl.util import LRUCache
+
+
+class FakeConnection(object):
+    _py_enc = 'utf-8'
+
+    def __init__(self):
+        self._query_cache = LRUCache()
+        self._pgconn = object()
+        self._lock = threading.Lock()
+        self._async = self.autocommit = self.closed = False
+        self.status = consts.STATUS_READY
+
+    def isexecuting(self):
+        return False
+
+    def _have_wait_callback(self):
+        return False
+
+    def _check_pid(self):
+        pass
+
+    def _process_notifies(self):
+        pass
+
+    def _create_exception(self, pgres=None):
+        return OperationalError(pgres and pgres.status or 'failed')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+    binary = False
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self._pgres = None
+
+    def _clear_pgres(self):
+        self._pgres = None
+
+    def _pq_fetch(self):
+        if self._pgres.status == libpq.PGRES_FATAL_ERROR:
+            raise ProgrammingError('syntax error')
+
+
+class FakeResult(object):
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeLibpq(object):
+    """Return the results in sequence, None standing for a NULL"""
+
+    def __init__(self, results, fail_send=None):
+        self.results = [r is not None and FakeResult(r) or None
+            for r in results]
+        self.fail_send = fail_send
+        self.sent = []
+        self.cleared = []
+        self.pipeline = False
+        for name in dir(libpq):
+            if name.startswith(('PGRES_', 'CONNECTION_')):
+                setattr(self, name, getattr(libpq, name))
+
+    def PQsendQuery(self, pgconn, query):
+        self.sent.append(query)
+        return 1
+
+    def PQsendQueryParams(self, pgconn, query, *args):
+        self.sent.append(query)
+        return query != self.fail_send
+
+    def PQenterPipelineMode(self, pgconn):
+        self.pipeline = True
+        return 1
+
+    def PQexitPipelineMode(self, pgconn):
+        if self.results:
+            return 0
+        self.pipeline = False
+        return 1
+
+    def PQpipelineSync(self, pgconn):
+        self.sent.append('sync')
+        return 1
+
+    def PQflush(self, pgconn):
+        return 0
+
+    def PQconsumeInput(self, pgconn):
+        return 1
+
+    def PQisBusy(self, pgconn):
+        return 0
+
+    def PQstatus(self, pgconn):
+        return libpq.CONNECTION_OK
+
+    def PQgetResult(self, pgconn):
+        return self.results and self.results.pop(0) or None
+
+    def PQresultStatus(self, pgres):
+        return pgres.status
+
+    def PQclear(self, pgres):
+        self.cleared.append(pgres)
+
+
+class TestPipeline(TestCase):
+    def test_execute(self):
+        conn = FakeConnection()
+        p = Pipeline(conn)
+        cur = FakeCursor(conn)
+        self.assertTrue(p.execute(cur, "select %s, %s", (1, 2.5)) is cur)
+        p.execute(cur, u"select '\u20ac'")
+        self.assertEqual(len(p), 2)
+        self.assertEqual(p._queue, [(cur, "select 1, 2.5"),
+            (cur, "select '\xe2\x82\xac'")])
+
+    def test_bad_cursor(self):
+        conn = FakeConnection()
+        p = Pipeline(conn)
+        self.assertRaises(ProgrammingError,
+            p.execute, FakeCursor(FakeConnection()), "select 1")
+        self.assertRaises(ProgrammingError,
+            p.execute, FakeCursor(conn, 'named'), "select 1")
+        self.assertEqual(len(p), 0)
+
+    def test_discard_on_error(self):
+        conn = FakeConnection()
+        try:
+            with Pipeline(conn) as p:
+                p.execute(FakeCursor(conn), "select 1")
+                raise ZeroDivisionError
+        except ZeroDivisionError:
+            pass
+        self.assertEqual(len(p), 0)
+        self.assertEqual(p.sync(), [])
+
+
+class TestSteps(TestCase):
+    def setUp(self):
+        self._libpq = pipeline.libpq
+        self._have_pipeline = pipeline.have_pipeline
+
+    def tearDown(self):
+        pipeline.libpq = self._libpq
+        pipeline.have_pipeline = self._have_pipeline
+
+    def sync(self, results, queries, have_pipeline=False, fail_send=None):
+        pipeline.libpq = self.libpq = FakeLibpq(results, fail_send)
+        pipeline.have_pipeline = have_pipeline
+        self.conn = FakeConnection()
+        p = Pipeline(self.conn)
+        self.cursors = [p.execute(FakeCursor(self.conn), query)
+            for query in queries]
+        return p.sync()
+
+    def test_batch(self):
+        ok, tuples = libpq.PGRES_COMMAND_OK, libpq.PGRES_TUPLES_OK
+        self.sync([ok, tuples, ok, None], ["select 1 -- one", "update t"])
+        self.assertEqual(self.libpq.sent,
+            ["BEGIN\n;select 1 -- one\n;update t"])
+        self.assertEqual([c._pgres.status for c in self.cursors],
+            [tuples, ok])
+        self.assertEqual(self.conn.status, consts.STATUS_BEGIN)
+
+    def test_batch_error(self):
+        ok, error = libpq.PGRES_COMMAND_OK, libpq.PGRES_FATAL_ERROR
+        self.assertRaises(ProgrammingError, self.sync,
+            [ok, ok, error, None], ["select 1", "selec 2", "select 3"])
+        self.assertEqual(self.cursors[0]._pgres.status, ok)
+        self.assertEqual(self.cursors[2]._pgres, None)
+
+    def test_begin_error(self):
+        error = libpq.PGRES_FATAL_ERROR
+        self.assertRaises(OperationalError, self.sync, [error, None],
+            ["select 1"])
+        self.assertEqual(self.conn.status, consts.STATUS_READY)
+        self.assertEqual(len(self.libpq.cleared), 1)
+
+    def test_pipeline(self):
+        ok, tuples = libpq.PGRES_COMMAND_OK, libpq.PGRES_TUPLES_OK
+        sync = libpq.PGRES_PIPELINE_SYNC
+        self.sync([ok, None, tuples, None, ok, None, sync],
+            ["select 1", "update t"], have_pipeline=True)
+        self.assertEqual(self.libpq.sent,
+            ["BEGIN", "select 1", "update t", "sync"])
+        self.assertEqual([c._pgres.status for c in self.cursors],
+            [tuples, ok])
+        self.assertFalse(self.libpq.pipeline)
+
+    def test_pipeline_aborted(self):
+        ok, error = libpq.PGRES_COMMAND_OK, libpq.PGRES_FATAL_ERROR
+        aborted = libpq.PGRES_PIPELINE_ABORTED
+        sync = libpq.PGRES_PIPELINE_SYNC
+        try:
+            self.sync([ok, None, error, None, aborted, None, sync],
+                ["selec 1", "select 2"], have_pipeline=True)
+        except ProgrammingError:
+            pass
+        else:
+            self.fail("ProgrammingError not raised")
+        self.assertEqual(self.cursors[1]._pgres, None)
+        self.assertEqual(self.libpq.cleared[-1].status, aborted)
+
+    def test_pipeline_send_error(self):
+        ok, sync = libpq.PGRES_COMMAND_OK, libpq.PGRES_PIPELINE_SYNC
+        # The results pending are read before leaving the pipeline mode
+        self.assertRaises(OperationalError, self.sync,
+            [ok, None, ok, None, sync], ["select 1", "select 2"],
+            have_pipeline=True, fail_send="select 2")
+        self.assertEqual(self.libpq.sent[-1], "sync")
+        self.assertEqual(self.libpq.results, [])
+        self.assertFalse(self.libpq.pipeline)
+        self.assertFalse(self.conn.closed)
+
+    def test_pipeline_stuck(self):
+        ok = libpq.PGRES_COMMAND_OK
+        # No sync result: the connection can't leave the pipeline mode
+        self.assertRaises(OperationalError, self.sync,
+            [ok, None, None, ok], ["select 1", "select 2"],
+            have_pipeline=True, fail_send="select 2")
+        self.assertTrue(self.libpq.pipeline)
+        self.assertTrue(self.conn.closed)
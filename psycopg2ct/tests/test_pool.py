@@ -0,0 +1,547 @@
+import threading
+import time
+from unittest import TestCase
+
+from psycopg2ct import compat
+compat.register()
+
+import psycopg2
+from psycopg2ct import extensions
+from psycopg2ct import pool
+
+
+class FakeCursor(object):
+    def __init__(self, conn, name, withhold=False, lazy=False):
+        self.connection = conn
+        self.name = name
+        self.withhold = withhold
+
+    def execute(self, query, vars=None):
+        self.connection.queries.append(query)
+        if not self.connection.autocommit:
+            self.connection.status = extensions.TRANSACTION_STATUS_INTRANS
+        self.rowcount = 1
+
+
+class FakeConnection(object):
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.readonly = None
+        self.autocommit = False
+        self.queries = []
+        self.closed = False
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.alive = True
+
+    def poll(self):
+        if not self.alive:
+            raise psycopg2.OperationalError("server closed the connection")
+        return extensions.POLL_OK
+
+    def get_transaction_status(self):
+        return self.status
+
+    def set_session(self, isolation_level=None, readonly=None,
+                    deferrable=None):
+        self.readonly = readonly
+
+    def cursor(self, name=None, **kwargs):
+        return FakeCursor(self, name, **kwargs)
+
+    def commit(self):
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class PoolTestCase(TestCase):
+    def setUp(self):
+        self._connect = psycopg2.connect
+        self._connect_many = psycopg2._connect_many
+        self.many = []
+
+        def connect_many(count, *args, **kwargs):
+            self.many.append(count)
+            return [FakeConnection(*args, **kwargs) for i in range(count)]
+
+        psycopg2.connect = FakeConnection
+        psycopg2._connect_many = connect_many
+
+    def tearDown(self):
+        psycopg2.connect = self._connect
+        psycopg2._connect_many = self._connect_many
+
+
+class TestThreadedConnectionPool(PoolTestCase):
+    def test_exhausted(self):
+        p = pool.ThreadedConnectionPool(1, 2)
+        p.getconn()
+        p.getconn()
+        self.assertRaises(pool.PoolError, p.getconn)
+        self.assertRaises(pool.PoolError, p.getconn, timeout=0.01)
+        self.assertEqual(p.timeouts, 1)
+        self.assertEqual(p.waits, 1)
+        self.assertEqual(p.waiting, 0)
+
+    def test_fifo(self):
+        p = pool.ThreadedConnectionPool(0, 1)
+        conn = p.getconn()
+        order = []
+
+        def get(n):
+            c = p.getconn(timeout=None)
+            order.append(n)
+            p.putconn(c)
+
+        threads = []
+        for n in range(5):
+            thread = threading.Thread(target=get, args=(n,))
+            thread.start()
+            threads.append(thread)
+            while p.waiting <= n:
+                time.sleep(0.001)
+
+        p.putconn(conn)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, range(5))
+        self.assertEqual(p.waits, 5)
+        self.assertEqual(p.waiting, 0)
+
+    def test_broken_connection(self):
+        p = pool.ThreadedConnectionPool(0, 1)
+        conn = p.getconn()
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(p.getconn(timeout=5)))
+        thread.start()
+        while not p.waiting:
+            time.sleep(0.001)
+
+        conn.status = extensions.TRANSACTION_STATUS_UNKNOWN
+        p.putconn(conn)
+        thread.join()
+        self.assertTrue(conn.closed)
+        self.assertFalse(result[0].closed)
+        self.assertTrue(result[0] is not conn)
+
+    def test_closeall(self):
+        p = pool.ThreadedConnectionPool(0, 1)
+        p.getconn()
+        errors = []
+
+        def get():
+            try:
+                p.getconn(timeout=None)
+            except pool.PoolError, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=get)
+        thread.start()
+        while not p.waiting:
+            time.sleep(0.001)
+        p.closeall()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+
+class TestLifetime(PoolTestCase):
+    def test_options(self):
+        p = pool.SimpleConnectionPool(1, 2, dsn='x', max_lifetime=60,
+            max_idle=30, health_check_interval=10)
+        self.assertEqual(p.getconn().kwargs, {'dsn': 'x'})
+        self.assertEqual(
+            (p.max_lifetime, p.max_idle, p.health_check_interval),
+            (60, 30, 10))
+
+    def test_max_lifetime(self):
+        p = pool.SimpleConnectionPool(1, 2, max_lifetime=60)
+        conn = p.getconn()
+        p.putconn(conn)
+        self.assertTrue(p.getconn() is conn)
+
+        p._created[id(conn)] -= 61
+        p.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(p._pool, [])
+        self.assertTrue(p.getconn() is not conn)
+
+    def test_max_idle(self):
+        p = pool.SimpleConnectionPool(1, 2, max_idle=60)
+        conn = p._pool[0]
+        p._idle[id(conn)] -= 61
+        self.assertTrue(p.getconn() is not conn)
+        self.assertTrue(conn.closed)
+
+    def test_maintain(self):
+        p = pool.ThreadedConnectionPool(3, 5, max_idle=60,
+            health_check_interval=10)
+        old, dead, fresh = p._pool
+        p._idle[id(old)] -= 61
+        p._idle[id(dead)] -= 11
+        dead.alive = False
+        p._idle[id(fresh)] -= 11
+
+        p._maintain()
+        self.assertTrue(old.closed)
+        self.assertTrue(dead.closed)
+        self.assertFalse(fresh.closed)
+        self.assertEqual(len(p._pool), 3)
+        self.assertTrue(fresh in p._pool)
+        self.assertEqual(p._used, {})
+        p.closeall()
+
+
+class TestWarmUp(PoolTestCase):
+    def test_minconn(self):
+        p = pool.SimpleConnectionPool(5, 10, dsn='x')
+        self.assertEqual(self.many, [5])
+        self.assertEqual(len(p._pool), 5)
+        self.assertEqual(p._pool[0].kwargs, {'dsn': 'x'})
+
+    def test_grow_by(self):
+        p = pool.SimpleConnectionPool(0, 5, grow_by=3)
+        conn = p.getconn()
+        self.assertEqual(self.many, [3])
+        self.assertEqual(len(p._pool), 2)
+        p.getconn()
+        p.getconn()
+        self.assertEqual(self.many, [3])
+
+        # Don't create more than maxconn connections
+        p.getconn()
+        self.assertEqual(self.many, [3, 2])
+        p.getconn()
+        self.assertRaises(pool.PoolError, p.getconn)
+        self.assertEqual(len(p._created), 5)
+
+
+class TestStats(PoolTestCase):
+    def test_stats(self):
+        p = pool.SimpleConnectionPool(1, 2)
+        c1 = p.getconn()
+        c2 = p.getconn(key='k')
+        self.assertRaises(pool.PoolError, p.getconn)
+        p.putconn(c1)
+        p.putconn(c2, close=True)
+
+        stats = p.stats()
+        self.assertEqual((stats['idle'], stats['used']), (1, 0))
+        self.assertEqual(stats['connections_created'], 2)
+        self.assertEqual(stats['connections_closed'], {'putconn': 1})
+        self.assertEqual(stats['exhausted'], 1)
+        self.assertEqual(stats['checkout_time']['count'], 2)
+        self.assertEqual(sorted(stats['hold_time']), [None, 'k'])
+        self.assertEqual(stats['hold_time']['k']['count'], 1)
+        self.assertEqual(
+            sum(n for b, n in stats['hold_time'][None]['buckets']), 1)
+
+    def test_observer(self):
+        p = pool.ThreadedConnectionPool(0, 1, max_lifetime=60)
+        events = []
+        p.add_observer(lambda pool, event, info: events.append((event, info)))
+        conn = p.getconn()
+        self.assertRaises(pool.PoolError, p.getconn, key='k')
+        p._created[id(conn)] -= 61
+        p.putconn(conn)
+        p.closeall()
+
+        self.assertEqual([e for e, info in events],
+            ['connect', 'checkout', 'exhausted', 'checkin', 'close'])
+        self.assertTrue(events[1][1]['conn'] is conn)
+        self.assertEqual(events[1][1]['key'], None)
+        self.assertEqual(events[2][1], {'key': 'k'})
+        self.assertEqual(events[4][1]['reason'], 'lifetime')
+
+    def test_wait_time(self):
+        p = pool.ThreadedConnectionPool(0, 1)
+        conn = p.getconn()
+        thread = threading.Thread(target=p.getconn, kwargs={'timeout': None})
+        thread.start()
+        while not p.waiting:
+            time.sleep(0.001)
+        time.sleep(0.02)
+        p.putconn(conn)
+        thread.join()
+
+        stats = p.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['exhausted'], 1)
+        self.assertTrue(stats['checkout_time']['max'] >= 0.02)
+        self.assertEqual(stats['hold_time'][None]['count'], 1)
+
+
+    def test_exhausted_queued(self):
+        p = pool.ThreadedConnectionPool(0, 2)
+        p.getconn()
+        # A request queued behind another one doesn't exhaust the pool
+        p._waiters.append(pool._Waiter(None, p._lock, time.time()))
+        self.assertRaises(pool.PoolError, p.getconn, timeout=0)
+        self.assertEqual(p.stats()['exhausted'], 0)
+
+    def test_hold_time_keys(self):
+        p = pool.SimpleConnectionPool(0, 1)
+        p._max_stats_keys = 2
+        for key in ['a', 'b', 'c', 'd', 'a']:
+            p.putconn(p.getconn(key=key))
+        stats = p.stats()
+        self.assertEqual(sorted(stats['hold_time']), ['a', 'b'])
+        self.assertEqual(stats['hold_time']['a']['count'], 2)
+        self.assertEqual(stats['hold_time_other']['count'], 2)
+
+
+class TestRoutingConnectionPool(PoolTestCase):
+    def test_route(self):
+        p = pool.RoutingConnectionPool(1, 5, 'primary', ['r1', 'r2'])
+        conn = p.getconn()
+        self.assertEqual(conn.args, ('primary',))
+        self.assertEqual(conn.readonly, None)
+
+        conns = [p.getconn(readonly=True) for i in range(4)]
+        self.assertEqual(sorted(c.args[0] for c in conns),
+            ['r1', 'r1', 'r2', 'r2'])
+        self.assertTrue(conns[0].readonly)
+
+        # least outstanding: the replica with a connection free gets it
+        p.putconn(conns[0])
+        self.assertEqual(p.getconn(readonly=True).args, conns[0].args)
+        p.putconn(conn)
+        self.assertEqual(p.stats()['primary']['idle'], 1)
+
+    def test_round_robin(self):
+        p = pool.RoutingConnectionPool(0, 10, 'primary', ['r1', 'r2'],
+            strategy='round_robin', weights=[2, 1])
+        names = []
+        for i in range(6):
+            conn = p.getconn(readonly=True)
+            names.append(conn.args[0])
+            p.putconn(conn)
+        self.assertEqual(names, ['r1', 'r2', 'r1'] * 2)
+
+    def test_keys(self):
+        p = pool.RoutingConnectionPool(0, 2, 'primary', ['r1'])
+        conn = p.getconn('k', readonly=True)
+        self.assertTrue(p.getconn('k') is conn)
+        p.putconn(conn)
+        self.assertEqual(p.replicas[0]._used, {})
+
+    def test_unhealthy(self):
+        def connect(dsn):
+            if dsn == 'r1':
+                raise psycopg2.OperationalError("could not connect")
+            return FakeConnection(dsn)
+
+        psycopg2.connect = connect
+        p = pool.RoutingConnectionPool(0, 2, 'primary', ['r1', 'r2'])
+        self.assertEqual(p.getconn(readonly=True).args, ('r2',))
+        self.assertEqual(p.stats()['unhealthy'], [0])
+
+        conn = p.getconn(readonly=True)
+        self.assertEqual(conn.args, ('r2',))
+        p.putconn(conn, error=psycopg2.OperationalError())
+        self.assertTrue(conn.closed)
+        self.assertEqual(p.stats()['unhealthy'], [0, 1])
+
+        # no replica available: use the primary
+        self.assertEqual(p.getconn(readonly=True).args, ('primary',))
+
+    def test_unhealthy_at_start(self):
+        down = ['r1']
+
+        def connect(dsn):
+            if dsn in down:
+                raise psycopg2.OperationalError("could not connect")
+            return FakeConnection(dsn)
+
+        psycopg2.connect = connect
+        p = pool.RoutingConnectionPool(1, 2, 'primary', ['r1', 'r2'],
+            retry_interval=0.01)
+        self.assertEqual(p.stats()['unhealthy'], [0])
+        self.assertEqual(p.replicas[0].minconn, 1)
+        self.assertEqual(p.stats()['replicas'][0]['idle'], 0)
+        self.assertEqual(p.getconn(readonly=True).args, ('r2',))
+
+        # the replica is tried again after retry_interval
+        del down[:]
+        time.sleep(0.02)
+        self.assertEqual(p.getconn(readonly=True).args, ('r1',))
+        self.assertEqual(p.stats()['unhealthy'], [])
+
+
+class TestFork(PoolTestCase):
+    def test_threaded(self):
+        p = pool.ThreadedConnectionPool(2, 5)
+        used = p.getconn()
+        idle = p._pool[0]
+        lock = p._lock
+        p._pid = None # as if forked
+
+        p.putconn(used)
+        self.assertTrue(used.closed)
+        self.assertTrue(idle.closed)
+        self.assertTrue(p._lock is not lock)
+        self.assertEqual((p.stats()['idle'], p.stats()['used']), (0, 0))
+
+        conn = p.getconn()
+        self.assertFalse(conn.closed)
+        p.putconn(conn)
+
+    def test_waiter(self):
+        p = pool.ThreadedConnectionPool(0, 1)
+        old = p.getconn()
+        p._pid = None # as if forked
+
+        # A thread of the child waits for the connection it can't have
+        new = p.getconn()
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(p.getconn(timeout=5)))
+        thread.start()
+        while not p.waiting:
+            time.sleep(0.001)
+
+        p.putconn(old)
+        self.assertTrue(old.closed)
+        self.assertEqual(p.waiting, 1)
+        p.putconn(new)
+        thread.join()
+        self.assertTrue(result[0] is new)
+
+    def test_after_fork(self):
+        p1 = pool.ThreadedConnectionPool(2, 5)
+        p2 = pool.RoutingConnectionPool(1, 5, 'primary', ['r1'])
+        old = p1._pool[:] + p2.replicas[0]._pool[:]
+        conn = p2.getconn(readonly=True)
+        p1._pid = p2._pid = p2.primary._pid = p2.replicas[0]._pid = None
+
+        pool.after_fork(p1, p2)
+        for c in old:
+            self.assertTrue(c.closed)
+        self.assertEqual(len(p1._pool), 2)
+        self.assertEqual(len(p2.replicas[0]._pool), 1)
+        self.assertEqual(len(p2.primary._pool), 1)
+
+        p2.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(p2.replicas[0]._used, {})
+
+    def test_threads(self):
+        p = pool.ThreadedConnectionPool(1, 5)
+        calls = []
+        forked = p._forked
+
+        def slow_forked():
+            calls.append(1)
+            time.sleep(0.01)
+            forked()
+
+        p._forked = slow_forked
+        p._pid = None
+        threads = [threading.Thread(target=p.stats) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+
+
+class TestTransactionConnectionPool(PoolTestCase):
+    def test_transaction(self):
+        p = pool.TransactionConnectionPool(1, 1)
+        h1 = p.getconn()
+        h2 = p.getconn()
+        self.assertEqual(h1.connection, None)
+
+        cur = h1.cursor()
+        self.assertEqual(cur.rowcount, -1)
+        cur.execute("select 1")
+        conn = h1.connection
+        self.assertEqual(conn.queries, ["select 1"])
+        self.assertEqual(cur.rowcount, 1)
+        self.assertRaises(pool.PoolError, h2.cursor().execute, "select 2")
+
+        h1.commit()
+        self.assertEqual(h1.connection, None)
+        h2.cursor().execute("select 2")
+        self.assertTrue(h2.connection is conn)
+        h2.rollback()
+
+        # the cursor moves to the connection of the new transaction
+        cur.execute("select 3")
+        self.assertTrue(cur.connection is h1)
+        self.assertEqual(h1.connection.queries[-1], "select 3")
+        p.putconn(h1)
+        p.putconn(h2)
+        self.assertTrue(h1.closed)
+        self.assertEqual(p.stats()['used'], 0)
+
+    def test_autocommit(self):
+        p = pool.TransactionConnectionPool(1, 1)
+        h = p.getconn()
+        h.autocommit = True
+        h.cursor().execute("select 1")
+        self.assertEqual(h.connection, None)
+        self.assertEqual(p.stats()['idle'], 1)
+        self.assertFalse(p._pool[0].autocommit)
+
+    def test_pin(self):
+        p = pool.TransactionConnectionPool(0, 2)
+        h = p.getconn()
+        h.cursor().execute("LISTEN foo")
+        h.commit()
+        self.assertTrue(h.pinned)
+        self.assertTrue(h.connection is not None)
+
+        h = p.getconn()
+        h.cursor().execute("SET LOCAL work_mem TO '1GB'")
+        h.commit()
+        self.assertFalse(h.pinned)
+
+        h.cursor('c', withhold=True)
+        self.assertTrue(h.pinned)
+        p.putconn(h)
+        self.assertEqual(h.connection, None)
+
+        h = p.getconn()
+        h.set_session(readonly=True)
+        self.assertTrue(h.pinned)
+        self.assertTrue(h.connection.readonly)
+
+    def test_named_cursor(self):
+        p = pool.TransactionConnectionPool(1, 1)
+        h1 = p.getconn()
+        cur = h1.cursor('c')
+        self.assertTrue(h1.pinned)
+        cur.execute("select 1")
+        h1.commit()
+        self.assertTrue(h1.connection is not None)
+
+        # The connection given back can't be used through the cursor
+        p.putconn(h1)
+        h2 = p.getconn()
+        h2.cursor().execute("begin")
+        self.assertRaises(psycopg2.InterfaceError, cur.close)
+        self.assertRaises(psycopg2.InterfaceError, iter, cur)
+        self.assertRaises(psycopg2.InterfaceError, getattr, cur, 'fetchone')
+        self.assertEqual(h2.connection.queries, ["select 1", "begin"])
+
+    def test_fresh_cursor(self):
+        p = pool.TransactionConnectionPool(1, 1)
+        h = p.getconn()
+        cur = h.cursor(withhold=False)
+        cur.arraysize = 10
+        self.assertEqual(cur.arraysize, 10)
+        self.assertEqual(cur.withhold, False)
+        self.assertEqual(cur.description, None)
+        self.assertEqual(cur.name, None)
+        self.assertTrue(cur.connection is h)
+        self.assertRaises(psycopg2.ProgrammingError, iter, cur)
+        for method in ('fetchone', 'fetchmany', 'fetchall', 'scroll'):
+            self.assertRaises(psycopg2.ProgrammingError, getattr, cur, method)
+        self.assertEqual(h.connection, None)
+        self.assertEqual(p.stats()['used'], 0)
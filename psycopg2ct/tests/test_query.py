@@ -0,0 +1,311 @@
+from ctypes import POINTER, c_void_p, cast, string_at
+import datetime
+import decimal
+from unittest import TestCase
+
+from psycopg2ct._impl import consts
+from psycopg2ct._impl.connection import Connection
+from psycopg2ct._impl.cursor import Cursor
+from psycopg2ct._impl.cursor import _bind_server_params, _combine_cmd_params
+from psycopg2ct._impl.cursor import _parse_query, _prepare_query
+from psycopg2ct._impl.cursor import _prepared_params, _split_insert_values
+from psycopg2ct._impl.exceptions import ProgrammingError
+from psycopg2ct._impl.util import LRUCache
+
+
+class FakeConnection(object):
+    _py_enc = 'utf-8'
+
+    def __init__(self):
+        self._query_cache = LRUCache()
+
+
+def bind(cmd, params):
+    query, arrays = _bind_server_params(cmd, params, FakeConnection())
+    if arrays is None:
+        return query, None
+    num, oids, values, lengths, formats = arrays
+    pointers = cast(values, POINTER(c_void_p))
+    values = [pointers[i] and string_at(pointers[i], lengths[i])
+        for i in xrange(num)]
+    return query, zip(oids, values, lengths, formats)
+
+
+class TestParseQuery(TestCase):
+    def test_positional(self):
+        self.assertEqual(_parse_query("select %s, %s from x"),
+            (("select ", ", ", " from x"), (0, 1)))
+
+    def test_named(self):
+        self.assertEqual(_parse_query("select %(a)s, %(b)s, %(a)s"),
+            (("select ", ", ", ", ", ""), ("a", "b", "a")))
+
+    def test_escape(self):
+        self.assertEqual(_parse_query("select '%%', %s, '%%%%'"),
+            (("select '%', ", ", '%%'"), (0,)))
+        self.assertEqual(_parse_query("select 1"), (("select 1",), ()))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, _parse_query, "select %s, %(a)s")
+        self.assertRaises(ValueError, _parse_query, "select %(a)s, %s")
+        self.assertRaises(ValueError, _parse_query, "select %d")
+        self.assertRaises(ProgrammingError, _parse_query, "select %(foo")
+        self.assertRaises(ProgrammingError,
+            _parse_query, "select %(foo, %(bar)")
+
+
+class TestCombineCmdParams(TestCase):
+    def test_positional(self):
+        conn = FakeConnection()
+        self.assertEqual(
+            _combine_cmd_params("select %s, '%%', %s", (1, None), conn),
+            "select 1, '%', NULL")
+        self.assertEqual(
+            _combine_cmd_params("select %s, '%%', %s", (2, 3), conn),
+            "select 2, '%', 3")
+        self.assertEqual(conn._query_cache.hits, 1)
+        self.assertEqual(conn._query_cache.misses, 1)
+
+    def test_named(self):
+        conn = FakeConnection()
+        self.assertEqual(_combine_cmd_params(
+            "select %(a)s, %(b)s, %(a)s", {'a': 1, 'b': [2]}, conn),
+            "select 1, ARRAY[2], 1")
+
+    def test_no_placeholders(self):
+        conn = FakeConnection()
+        self.assertEqual(_combine_cmd_params("select 1", (), conn),
+            "select 1")
+        self.assertEqual(_combine_cmd_params("select '%%'", (), conn),
+            "select '%'")
+
+    def test_errors(self):
+        conn = FakeConnection()
+        self.assertRaises(TypeError,
+            _combine_cmd_params, "select %s", (1, 2), conn)
+        self.assertRaises(IndexError,
+            _combine_cmd_params, "select %s, %s", (1,), conn)
+        self.assertRaises(ValueError,
+            _combine_cmd_params, "select %s, %(a)s", (1,), conn)
+        self.assertEqual(len(conn._query_cache), 2)
+
+
+class TestBindServerParams(TestCase):
+    def test_builtin_types(self):
+        query, params = bind("select %s, %s, %s, %s, %s, %s", (
+            1, 2 ** 40, True, 1.5, decimal.Decimal('1.10'), None))
+        self.assertEqual(query, "select $1, $2, $3, $4, $5, $6")
+        self.assertEqual(params, [
+            (23, '1', 1, 0),
+            (20, '1099511627776', 13, 0),
+            (16, 't', 1, 0),
+            (701, '1.5', 3, 0),
+            (1700, '1.10', 4, 0),
+            (0, None, 0, 0)])
+
+    def test_dates(self):
+        query, params = bind("select %s, %s, %s, %s", (
+            datetime.date(2012, 1, 2),
+            datetime.datetime(2012, 1, 2, 3, 4, 5),
+            datetime.time(3, 4, 5, 6),
+            datetime.timedelta(1, 2, 3)))
+        self.assertEqual([(oid, value) for oid, value, _, _ in params], [
+            (1082, '2012-01-02'),
+            (1114, '2012-01-02T03:04:05'),
+            (1083, '03:04:05.000006'),
+            (1186, '1 days 2.000003 seconds')])
+
+    def test_strings(self):
+        query, params = bind("select %s, %s, %s",
+            ('a\'b', u'\u20ac', buffer('a\x00b')))
+        self.assertEqual(params, [
+            (0, 'a\'b', 3, 0),
+            (0, '\xe2\x82\xac', 3, 0),
+            (17, 'a\x00b', 3, 1)])
+
+    def test_named(self):
+        query, params = bind("select %(a)s, %(b)s, %(a)s", {'a': 1, 'b': 2})
+        self.assertEqual(query, "select $1, $2, $1")
+        self.assertEqual([value for _, value, _, _ in params], ['1', '2'])
+
+    def test_literal(self):
+        query, params = bind("select %s, %s = any(%s)", (1, 2, [3, 4]))
+        self.assertEqual(query, "select $1, $2 = any(ARRAY[3, 4])")
+        self.assertEqual(len(params), 2)
+
+        query, params = bind("select %s", ([1],))
+        self.assertEqual(query, "select ARRAY[1]")
+        self.assertEqual(params, None)
+
+    def test_subclass_literal(self):
+        class MyInt(int):
+            pass
+        query, params = bind("select %s", (MyInt(1),))
+        self.assertEqual(query, "select 1")
+
+    def test_wrong_arguments(self):
+        self.assertRaises(TypeError, bind, "select %s", (1, 2))
+        self.assertRaises(IndexError, bind, "select %s, %s", (1,))
+        self.assertRaises(KeyError, bind, "select %(a)s", {'b': 1})
+
+
+class TestPreparedStatements(TestCase):
+    def test_prepare_query(self):
+        conn = FakeConnection()
+        self.assertEqual(_prepare_query("select %s, %s", conn),
+            ("select $1, $2", (0, 1)))
+        self.assertEqual(_prepare_query("select %(b)s, %(a)s, %(b)s", conn),
+            ("select $1, $2, $1", ("b", "a")))
+        self.assertEqual(_prepare_query("select '%%'", conn),
+            ("select '%'", ()))
+
+    def test_prepared_params(self):
+        conn = FakeConnection()
+        self.assertEqual(_prepared_params(("b", "a"), {'a': 1, 'b': 'x'}, conn),
+            [(0, 'x', 0), (23, '1', 0)])
+        self.assertEqual(_prepared_params((0,), ([1],), conn), None)
+        self.assertRaises(TypeError, _prepared_params, (0,), (1, 2), conn)
+
+    def test_auto_statement(self):
+        conn = Connection.__new__(Connection)
+        conn._cancel = conn._pgconn = None
+        conn._query_cache = LRUCache()
+        conn._statement_cache = LRUCache(1)
+        conn._prepare_counts = LRUCache()
+        conn._statement_num = 0
+        conn._prepare_threshold = 1
+
+        commands = []
+        prepared = []
+        status = [consts.TRANSACTION_STATUS_IDLE]
+
+        def prepare_statement(name, sql, oids):
+            prepared.append((name, sql, oids))
+            return (name, sql, (0,))
+
+        conn._prepare_statement = prepare_statement
+        conn._execute_command = commands.append
+        conn.get_transaction_status = lambda: status[0]
+
+        self.assertEqual(conn._get_auto_statement("select %s", (1,)), None)
+        stmt, params = conn._get_auto_statement("select %s", (1,))
+        self.assertEqual(stmt, ("_psycopg2ct_1", "select %s", (0,)))
+        self.assertEqual(params, [(23, '1', 0)])
+        self.assertEqual(prepared, [("_psycopg2ct_1", "select %s", (23,))])
+        self.assertEqual(conn._get_auto_statement("select %s", (2,)),
+            (stmt, [(23, '2', 0)]))
+        self.assertEqual(commands, [])
+
+        # Other parameter types make another statement
+        self.assertEqual(conn._get_auto_statement("select %s", (1.5,)), None)
+        stmt, params = conn._get_auto_statement("select %s", (1.5,))
+        self.assertEqual(prepared[-1], ("_psycopg2ct_2", "select %s", (701,)))
+        self.assertEqual(commands, ['DEALLOCATE "_psycopg2ct_1"'])
+        self.assertEqual(conn._get_auto_statement("select %s", (1,)), None)
+
+    def test_auto_statement_not_prepared(self):
+        conn = Connection.__new__(Connection)
+        conn._cancel = conn._pgconn = None
+        conn._query_cache = LRUCache()
+        conn._statement_cache = LRUCache(1)
+        conn._prepare_counts = LRUCache()
+        conn._statement_num = 0
+        conn._prepare_threshold = 0
+        conn._prepare_statement = None
+        status = [consts.TRANSACTION_STATUS_INERROR]
+        conn.get_transaction_status = lambda: status[0]
+
+        self.assertEqual(conn._get_auto_statement("select %s", (1,)), None)
+        status[0] = consts.TRANSACTION_STATUS_IDLE
+        self.assertEqual(
+            conn._get_auto_statement("select %s; select 1", (1,)), None)
+        self.assertEqual(conn._get_auto_statement("select %s", ([1],)), None)
+        self.assertEqual(len(conn._prepare_counts), 0)
+
+
+class TestSplitInsertValues(TestCase):
+    def test_simple(self):
+        self.assertEqual(
+            _split_insert_values("INSERT INTO t VALUES (%s, %s)"),
+            ("INSERT INTO t VALUES ", "(%s, %s)", ""))
+        self.assertEqual(
+            _split_insert_values("insert into t (a, b) values(%s, 'x)');"),
+            ("insert into t (a, b) values", "(%s, 'x)')", ""))
+        self.assertEqual(
+            _split_insert_values(
+                "INSERT INTO tvalues(a) VALUES (lower(%s)) RETURNING a"),
+            ("INSERT INTO tvalues(a) VALUES ", "(lower(%s))", " RETURNING a"))
+
+    def test_not_simple(self):
+        self.assertEqual(_split_insert_values("UPDATE t SET a = %s"), None)
+        self.assertEqual(_split_insert_values(
+            "INSERT INTO t SELECT * FROM (VALUES (%s)) x"), None)
+        self.assertEqual(_split_insert_values(
+            "INSERT INTO t VALUES (%s), (%s)"), None)
+        self.assertEqual(_split_insert_values(
+            "INSERT INTO t VALUES (%s) ON CONFLICT (a) DO UPDATE SET b = %s"),
+            None)
+        self.assertEqual(_split_insert_values(
+            "INSERT INTO t VALUES (%s); SELECT 1"), None)
+        self.assertEqual(_split_insert_values("INSERT INTO t VALUES (%s"),
+            None)
+
+
+class BatchConnection(FakeConnection):
+    _prepare_threshold = None
+    closed = _async = False
+
+    def _begin_transaction(self):
+        pass
+
+
+class BatchCursor(Cursor):
+    """Record the queries instead of sending them"""
+
+    def __init__(self):
+        Cursor.__init__(self, BatchConnection(), None)
+        self.queries = []
+
+    def execute(self, query, parameters=None):
+        self.queries.append(_combine_cmd_params(query, parameters,
+            self._conn))
+        self._rowcount = 1
+
+    def _pq_execute_batch(self, query):
+        self.queries.append(query)
+        return query.count(';') + 1
+
+
+class TestExecutemanyBatch(TestCase):
+    def test_default(self):
+        cur = BatchCursor()
+        cur.executemany("UPDATE t SET a = %s", [(1,), (2,)])
+        self.assertEqual(cur.queries,
+            ["UPDATE t SET a = 1", "UPDATE t SET a = 2"])
+        self.assertEqual(cur.rowcount, 2)
+
+    def test_pages(self):
+        cur = BatchCursor()
+        cur.executemany("UPDATE t SET a = %s -- note", [(1,), (2,), (3,)],
+            page_size=2)
+        self.assertEqual(cur.queries, [
+            "UPDATE t SET a = 1 -- note\n;UPDATE t SET a = 2 -- note",
+            "UPDATE t SET a = 3 -- note"])
+        self.assertEqual(cur.rowcount, 3)
+
+        cur = BatchCursor()
+        cur.executemany("INSERT INTO t VALUES (%s)", [(1,), (2,)],
+            page_size=2)
+        self.assertEqual(cur.queries, ["INSERT INTO t VALUES (1),(2)"])
+
+    def test_not_batched(self):
+        for attr, conn_attr in (('_binary', None),
+                ('_server_params', None), (None, '_prepare_threshold')):
+            cur = BatchCursor()
+            if attr:
+                setattr(cur, attr, True)
+            else:
+                setattr(cur._conn, conn_attr, 5)
+            cur.executemany("UPDATE t SET a = %s", [(1,), (2,)],
+                page_size=10)
+            self.assertEqual(len(cur.queries), 2)
@@ -0,0 +1,329 @@
+import datetime
+import decimal
+from unittest import TestCase, skipIf
+
+from psycopg2ct._impl import columnar
+from psycopg2ct._impl import cursor as _cursor
+from psycopg2ct._impl import result
+from psycopg2ct._impl import typecasts
+from psycopg2ct._impl.cursor import Column, Cursor
+from psycopg2ct._impl.exceptions import InterfaceError, ProgrammingError
+from psycopg2ct._impl.result import LazyResult, LazyRow
+
+
+class FakePGresult(object):
+    """The values of a query result, None standing for a NULL"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeLibpq(object):
+    def __init__(self):
+        self.cleared = []
+
+    def PQgetisnull(self, pgres, row, col):
+        return pgres.rows[row][col] is None
+
+    def PQclear(self, pgres):
+        self.cleared.append(pgres)
+
+
+def getvalue(pgres, row, col):
+    return pgres.rows[row][col] or ''
+
+
+class FakeConnection(object):
+    closed = False
+    _async = False
+    _py_enc = 'utf-8'
+
+
+class LibpqTestCase(TestCase):
+    def setUp(self):
+        self.libpq = FakeLibpq()
+        self._libpq = result.libpq, _cursor.libpq
+        self._libpq += (columnar.libpq,)
+        result.libpq = _cursor.libpq = columnar.libpq = self.libpq
+        self.cursors = []
+
+    def tearDown(self):
+        # Don't let the real libpq free the fake results
+        for cur in self.cursors:
+            cur._pgres = None
+        result.libpq, _cursor.libpq, columnar.libpq = self._libpq
+
+    def make_cursor(self, rows, casters):
+        cur = Cursor.__new__(Cursor)
+        cur._closed = False
+        cur._conn = FakeConnection()
+        cur._name = None
+        cur._lazy = True
+        cur.row_factory = None
+        cur._pgres = FakePGresult(rows)
+        cur._no_tuples = False
+        cur._rownumber = 0
+        cur._rowcount = len(rows)
+        cur._nfields = len(casters)
+        cur._casters = casters
+        cur._getvalue = getvalue
+        cur._description = [
+            Column('c%d' % i, 25, None, None, None, None, None)
+            for i in range(len(casters))]
+        self.cursors.append(cur)
+        return cur
+
+    def make_typed_cursor(self, rows, oids):
+        """Return a cursor using the default typecasters of the types"""
+        casts = [typecasts.string_types[oid] for oid in oids]
+        cur = self.make_cursor(rows,
+            [typecasts.cast_function(cast) for cast in casts])
+        cur._casts = casts
+        cur._description = [
+            Column('c%d' % i, oid, None, None, None, None, None)
+            for i, oid in enumerate(oids)]
+        return cur
+
+
+class CountingCaster(object):
+    def __init__(self, cast):
+        self.cast = cast
+        self.calls = []
+
+    def __call__(self, value, length, cursor):
+        self.calls.append(value)
+        return self.cast(value)
+
+
+class TestLazyResult(LibpqTestCase):
+    def setUp(self):
+        LibpqTestCase.setUp(self)
+        self.ints = CountingCaster(int)
+        self.cur = self.make_cursor(
+            [('1', 'a'), (None, 'b'), ('3', None)], [self.ints, None])
+
+    def test_cast_on_access(self):
+        rows = self.cur.fetchall()
+        self.assertTrue(isinstance(rows, LazyResult))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(self.ints.calls, [])
+
+        row = rows[-1]
+        self.assertTrue(isinstance(row, LazyRow))
+        self.assertEqual(row[1], None)
+        self.assertEqual(self.ints.calls, [])
+        self.assertEqual(row[0], 3)
+        self.assertEqual(row[0], 3)
+        self.assertEqual(self.ints.calls, ['3'])
+
+        # NULLs are not typecast
+        self.assertEqual(list(rows), [(1, 'a'), (None, 'b'), (3, None)])
+        self.assertEqual(self.ints.calls, ['3', '1'])
+        self.assertEqual(rows[:2], [(1, 'a'), (None, 'b')])
+        self.assertEqual(rows[1][:], (None, 'b'))
+        self.assertRaises(IndexError, rows.__getitem__, 3)
+        self.assertRaises(IndexError, row.__getitem__, 2)
+
+    def test_column(self):
+        rows = self.cur.fetchall()
+        self.assertEqual(rows.column(0), [1, None, 3])
+        self.assertEqual(rows.column('c1'), ['a', 'b', None])
+        self.assertRaises(KeyError, rows.column, 'foo')
+
+    def test_typecaster(self):
+        caster = typecasts.cast_function(typecasts.string_types[23])
+        cur = self.make_cursor([('42',), (None,)], [caster])
+        self.assertEqual(list(cur.fetchall()), [(42,), (None,)])
+
+    def test_handover(self):
+        pgres = self.cur._pgres
+        self.cur.fetchone()
+        rows = self.cur.fetchall()
+
+        # The cursor doesn't own the PGresult anymore
+        self.assertEqual(self.cur._pgres, None)
+        self.assertEqual(self.cur.rownumber, 3)
+        self.assertEqual(list(rows), [(None, 'b'), (3, None)])
+        self.assertRaises(ProgrammingError, self.cur.scroll, 0, 'absolute')
+
+        rows.close()
+        self.assertTrue(rows.closed)
+        self.assertEqual(self.libpq.cleared, [pgres])
+        self.assertRaises(InterfaceError, rows.__getitem__, 0)
+        self.assertRaises(InterfaceError, rows.column, 0)
+        rows.close()
+        self.assertEqual(self.libpq.cleared, [pgres])
+
+    def test_row_factory(self):
+        self.cur.row_factory = lambda cur: [None] * cur._nfields
+        self.assertRaises(ProgrammingError, self.cur.fetchall)
+
+    def test_not_lazy(self):
+        self.cur.lazy = False
+        self.assertEqual(self.cur.fetchall(),
+            [(1, 'a'), (None, 'b'), (3, None)])
+        self.assertEqual(self.libpq.cleared, [])
+        self.cur.scroll(0, 'absolute')
+        self.assertEqual(self.cur.rownumber, 0)
+
+
+class TestBuildRows(LibpqTestCase):
+    def setUp(self):
+        LibpqTestCase.setUp(self)
+        self.casts = [
+            typecasts.string_types[23],
+            typecasts.string_types[25],
+            typecasts.string_types[17],
+            typecasts.string_types[1700],
+            typecasts.string_types[1007],
+            typecasts.UNICODE,
+            typecasts.new_type((23,), 'DOUBLE',
+                lambda value, cursor: value is not None and int(value) * 2),
+        ]
+        self.rows = [
+            ('1', 'a', '\\x00ff', '1.10', '{1,2}', '\xe2\x82\xac', '3'),
+            (None, None, None, None, None, None, None),
+            ('-2', '', '\\x', 'NaN', '{}', '', '0'),
+        ]
+
+    def make_cursor(self, rows, casts):
+        cur = LibpqTestCase.make_cursor(self, rows,
+            [typecasts.cast_function(cast) for cast in casts])
+        cur._casts = casts
+        return cur
+
+    def cast_cells(self, cur):
+        """Typecast the rows one cell at a time, like before the casters
+        were resolved per column"""
+        rows = []
+        for row in self.rows:
+            values = []
+            for val, cast in zip(row, self.casts):
+                if val is not None:
+                    val = typecasts.typecast(cast, val, len(val), cur)
+                values.append(val)
+            rows.append(tuple(values))
+        return rows
+
+    def normalize(self, rows):
+        # Buffers and NaN don't compare equal
+        result = []
+        for row in rows:
+            values = list(row)
+            for i, val in enumerate(values):
+                if isinstance(val, buffer):
+                    values[i] = str(val)
+            result.append(repr(values))
+        return result
+
+    def test_rows(self):
+        cur = self.make_cursor(self.rows, self.casts)
+        expected = self.cast_cells(cur)
+        rows = cur._build_rows(0, 3)
+        self.assertEqual(self.normalize(rows), self.normalize(expected))
+        self.assertTrue(isinstance(rows[0], tuple))
+        self.assertEqual(rows[1], (None,) * 7)
+        self.assertEqual(rows[0][2:], (buffer('\x00\xff'),
+            decimal.Decimal('1.10'), [1, 2], u'\u20ac', 6))
+
+        self.assertEqual(self.normalize([cur._build_row(2)]),
+            self.normalize(expected[2:]))
+        self.assertEqual(self.normalize(cur._build_rows(1, 3)),
+            self.normalize(expected[1:]))
+
+    def test_fetch(self):
+        cur = self.make_cursor(self.rows, self.casts)
+        expected = self.normalize(self.cast_cells(cur))
+        self.assertEqual(self.normalize([cur.fetchone()]), expected[:1])
+        self.assertEqual(self.normalize(cur.fetchmany(1)), expected[1:2])
+        self.assertEqual(self.normalize(cur.fetchall()), expected[2:])
+
+    def test_row_factory(self):
+        cur = self.make_cursor(self.rows, self.casts)
+        expected = self.cast_cells(cur)
+        cur.row_factory = lambda cur: [None] * cur._nfields
+        rows = cur._build_rows(0, 3)
+        self.assertTrue(isinstance(rows[0], list))
+        self.assertEqual(self.normalize(rows), self.normalize(expected))
+
+
+class TestFetchColumns(LibpqTestCase):
+    def test_columns(self):
+        cur = self.make_typed_cursor(
+            [('1', 't', 'a'), (None, 'f', None), ('3', None, 'c')],
+            [23, 16, 25])
+        self.assertEqual(cur.fetch_columns(),
+            [[1, None, 3], [True, False, None], ['a', None, 'c']])
+        self.assertEqual(cur.rownumber, 3)
+        self.assertEqual(cur.fetch_columns(), [[], [], []])
+
+
+@skipIf(columnar.numpy is None, "numpy not available")
+class TestFetchNumpy(LibpqTestCase):
+    def fetch(self, rows, oids):
+        return self.make_typed_cursor(rows, oids).fetchnumpy()
+
+    def test_types(self):
+        ints, floats, bools, dates, stamps = self.fetch([
+            ('1', '1.5', 't', '2012-01-02', '2012-01-02 03:04:05.5'),
+            ('-2', '-inf', 'f', '1970-01-01', '1970-01-01 00:00:00'),
+        ], [20, 701, 16, 1082, 1114])
+        self.assertEqual(ints.dtype, columnar.numpy.int64)
+        self.assertEqual(ints.tolist(), [1, -2])
+        self.assertEqual(floats.dtype, columnar.numpy.float64)
+        self.assertEqual(floats.tolist(), [1.5, float('-inf')])
+        self.assertEqual(bools.dtype, columnar.numpy.bool_)
+        self.assertEqual(bools.tolist(), [True, False])
+        self.assertEqual(str(dates.dtype), 'datetime64[D]')
+        self.assertEqual(dates.tolist(),
+            [datetime.date(2012, 1, 2), datetime.date(1970, 1, 1)])
+        self.assertEqual(str(stamps.dtype), 'datetime64[us]')
+        self.assertEqual(stamps[0],
+            columnar.numpy.datetime64('2012-01-02T03:04:05.500000'))
+
+    def test_nulls(self):
+        ints, bools, dates, texts = self.fetch([
+            (None, None, None, None),
+            ('2', 't', '2012-01-02', 'b'),
+        ], [23, 16, 1082, 25])
+        self.assertEqual(ints.dtype, columnar.numpy.int32)
+        self.assertEqual(str(dates.dtype), 'datetime64[D]')
+        for array in ints, bools, dates, texts:
+            self.assertEqual(array.mask.tolist(), [True, False])
+        self.assertEqual(ints.tolist(), [None, 2])
+        self.assertEqual(bools.tolist(), [None, True])
+        self.assertEqual(texts.dtype, object)
+        self.assertEqual(texts.tolist(), [None, 'b'])
+
+    def test_native_array(self):
+        self.assertEqual(columnar._native_array(
+            ['2012-01-02', 'x'], [False, True], 'datetime64[D]', None
+            ).tolist(), [datetime.date(2012, 1, 2), None])
+        # Values numpy can't represent
+        for value in 'infinity', '-infinity', '0044-03-15 BC':
+            self.assertEqual(columnar._native_array(
+                [value], [False], 'datetime64[D]', None), None)
+        self.assertEqual(columnar._native_array(
+            ['infinity'], [False], 'datetime64[us]', None), None)
+
+    def test_object_fallback(self):
+        dates, stamps = self.fetch([
+            ('infinity', '-infinity'),
+            ('2012-01-02', None),
+        ], [1082, 1114])
+        # The columns are typecast by the default typecasters instead
+        self.assertEqual(dates.dtype, object)
+        self.assertEqual(dates.tolist(),
+            [datetime.date.max, datetime.date(2012, 1, 2)])
+        self.assertEqual(stamps.dtype, object)
+        self.assertEqual(stamps.mask.tolist(), [False, True])
+        self.assertEqual(stamps[0], datetime.datetime.min)
+
+    def test_custom_caster(self):
+        cur = self.make_typed_cursor([('1',), ('2',)], [23])
+        # Another typecaster than the default one disables the native path
+        cur._casts = [typecasts.LONGINTEGER]
+        cur._casters = [lambda value, length, cursor: 'x' + value]
+        array = cur.fetchnumpy()[0]
+        self.assertEqual(array.dtype, object)
+        self.assertEqual(array.tolist(), ['x1', 'x2'])
@@ -0,0 +1,114 @@
+import datetime
+import struct
+import uuid
+from unittest import TestCase
+
+from psycopg2ct import tz
+from psycopg2ct._impl import typecasts
+
+
+class FakeCursor(object):
+    tzinfo_factory = tz.FixedOffsetTimezone
+
+
+def cast(oid, value):
+    caster = typecasts.binary_types[oid]
+    return caster.cast(value, FakeCursor(), len(value))
+
+
+class TestBinaryTypecasts(TestCase):
+    def test_integers(self):
+        self.assertEqual(cast(21, struct.pack('!h', -2)), -2)
+        self.assertEqual(cast(23, struct.pack('!i', 2 ** 31 - 1)), 2 ** 31 - 1)
+        self.assertEqual(cast(20, struct.pack('!q', -2 ** 40)), -2 ** 40)
+        self.assertEqual(cast(26, struct.pack('!I', 2 ** 32 - 1)), 2 ** 32 - 1)
+
+    def test_floats(self):
+        self.assertEqual(cast(700, struct.pack('!f', 1.5)), 1.5)
+        self.assertEqual(cast(701, struct.pack('!d', -0.1)), -0.1)
+
+    def test_boolean(self):
+        self.assertEqual(cast(16, '\x01'), True)
+        self.assertEqual(cast(16, '\x00'), False)
+
+    def test_bytea(self):
+        self.assertEqual(str(cast(17, 'a\x00b')), 'a\x00b')
+
+    def test_string(self):
+        self.assertEqual(cast(25, 'hello'), 'hello')
+
+    def test_date(self):
+        self.assertEqual(cast(1082, struct.pack('!i', 0)),
+            datetime.date(2000, 1, 1))
+        self.assertEqual(cast(1082, struct.pack('!i', -1)),
+            datetime.date(1999, 12, 31))
+        self.assertEqual(cast(1082, struct.pack('!i', 2 ** 31 - 1)),
+            datetime.date.max)
+        self.assertEqual(cast(1082, struct.pack('!i', -2 ** 31)),
+            datetime.date.min)
+
+    def test_time(self):
+        micros = ((13 * 60 + 14) * 60 + 15) * 1000000 + 16
+        self.assertEqual(cast(1083, struct.pack('!q', micros)),
+            datetime.time(13, 14, 15, 16))
+
+        value = cast(1266, struct.pack('!qi', micros, -3600))
+        self.assertEqual(value.replace(tzinfo=None),
+            datetime.time(13, 14, 15, 16))
+        self.assertEqual(value.utcoffset(), datetime.timedelta(hours=1))
+
+    def test_timestamp(self):
+        micros = 86400 * 1000000 + 5
+        self.assertEqual(cast(1114, struct.pack('!q', micros)),
+            datetime.datetime(2000, 1, 2, 0, 0, 0, 5))
+        self.assertEqual(cast(1114, struct.pack('!q', 2 ** 63 - 1)),
+            datetime.datetime.max)
+
+        value = cast(1184, struct.pack('!q', micros))
+        self.assertEqual(value.utcoffset(), datetime.timedelta(0))
+        self.assertEqual(value.replace(tzinfo=None),
+            datetime.datetime(2000, 1, 2, 0, 0, 0, 5))
+
+    def test_interval(self):
+        self.assertEqual(cast(1186, struct.pack('!qii', 1000001, 3, 14)),
+            datetime.timedelta(365 + 60 + 3, 1, 1))
+        self.assertEqual(cast(1186, struct.pack('!qii', 0, 0, -1)),
+            datetime.timedelta(-30))
+
+    def test_numeric(self):
+        def numeric(weight, sign, dscale, *digits):
+            return struct.pack('!hhHH%dH' % len(digits),
+                len(digits), weight, sign, dscale, *digits)
+
+        self.assertEqual(str(cast(1700, numeric(1, 0, 2, 1, 2345, 6700))),
+            '12345.67')
+        self.assertEqual(str(cast(1700, numeric(0, 0x4000, 0, 42))), '-42')
+        self.assertEqual(str(cast(1700, numeric(-1, 0, 3, 10))), '0.001')
+        self.assertEqual(str(cast(1700, numeric(1, 0, 0, 1))), '10000')
+        self.assertEqual(str(cast(1700, numeric(0, 0, 2))), '0.00')
+        self.assertTrue(cast(1700, numeric(0, 0xC000, 0)).is_nan())
+
+    def test_uuid(self):
+        value = uuid.uuid4()
+        self.assertEqual(cast(2950, value.bytes), value)
+
+    def test_array(self):
+        def array(oid, dims, items):
+            data = struct.pack('!iiI', len(dims), 0, oid)
+            for dim in dims:
+                data += struct.pack('!ii', dim, 1)
+            for item in items:
+                if item is None:
+                    data += struct.pack('!i', -1)
+                else:
+                    data += struct.pack('!i', len(item)) + item
+            return data
+
+        int4 = lambda i: struct.pack('!i', i)
+        self.assertEqual(cast(1007, array(23, [3], [int4(1), None, int4(3)])),
+            [1, None, 3])
+        self.assertEqual(
+            cast(1007, array(23, [2, 2], [int4(i) for i in range(4)])),
+            [[0, 1], [2, 3]])
+        self.assertEqual(cast(1009, array(25, [1], ['foo'])), ['foo'])
+        self.assertEqual(cast(1007, array(23, [], [])), [])
@@ -0,0 +1,64 @@
+import threading
+from unittest import TestCase
+
+from psycopg2ct._impl.util import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_get(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.set('a', 1), [])
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_discard(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        self.assertEqual(cache.set('c', 3), [('b', 2)])
+        self.assertEqual(cache.items(), [('a', 1), ('c', 3)])
+        self.assertFalse('b' in cache)
+
+        cache.set('a', 4)
+        self.assertEqual(cache.items(), [('c', 3), ('a', 4)])
+
+        cache.maxsize = 1
+        self.assertEqual(cache.set('d', 5), [('c', 3), ('a', 4)])
+        self.assertEqual(len(cache), 1)
+
+        cache.maxsize = 0
+        self.assertEqual(cache.set('e', 6), [('e', 6)])
+        self.assertEqual(cache.items(), [('d', 5)])
+
+    def test_pop_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        self.assertEqual(cache.items(), [('b', 2)])
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.items(), [])
+
+    def test_threads(self):
+        cache = LRUCache(10)
+
+        def work(n):
+            for i in range(2000):
+                key = (i * n) % 15
+                if cache.get(key) is None:
+                    cache.set(key, i)
+
+        threads = [threading.Thread(target=work, args=(n,))
+            for n in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache.items()), len(cache))
+        self.assertEqual(sorted(cache._links),
+            sorted([key for key, value in cache.items()]))